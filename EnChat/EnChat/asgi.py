@@ -7,13 +7,14 @@ django.setup()  # Ensure this is called before importing any Django components
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from chat.routing import websocket_urlpatterns
+from users.auth import CachedAuthMiddlewareStack
+from utils.staticfiles import StaticFiles
 
 
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
-        "websocket": AuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        "http": StaticFiles(get_asgi_application()),
+        "websocket": CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
     }
 )
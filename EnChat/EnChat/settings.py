@@ -27,14 +27,16 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 MIDDLEWARE = [
+    'utils.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.auth.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -65,6 +67,72 @@ CHANNEL_LAYERS = {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
     },
 }
+# Share groups between worker processes and hosts through PostgreSQL
+if os.getenv("CHANNEL_LAYER", "memory").lower() == "postgres":
+    CHANNEL_LAYERS["default"] = {"BACKEND": "chat.layers.PostgresChannelLayer"}
+
+# Group-commit incoming WebSocket messages, see chat/writebehind.py
+CHAT_GROUP_COMMIT = os.getenv("CHAT_GROUP_COMMIT", "false").lower() == "true"
+CHAT_GROUP_COMMIT_INTERVAL = 0.005  # Seconds to collect messages before a flush
+CHAT_GROUP_COMMIT_BATCH_SIZE = 100  # Flush early once this many are waiting
+# Seconds outbound WebSocket events wait to share a frame, 0 sends at once
+CHAT_COALESCE_WINDOW = 0.01
+# Serve the polled chat views from chat/async_views.py, for ASGI servers.
+# Off until benchmark_chat --pollers shows a gain, it measured parity so far.
+CHAT_ASYNC_VIEWS = os.getenv("CHAT_ASYNC_VIEWS", "false").lower() == "true"
+# WebSocket limits, see chat/throttle.py. Client frames per second and
+# burst, per connection and per user (over all their connections)
+CHAT_CONNECTION_RATE = 5
+CHAT_CONNECTION_BURST = 20
+CHAT_USER_RATE = 10
+CHAT_USER_BURST = 40
+CHAT_THROTTLE_DISCONNECT_AFTER = 100  # Throttled frames in a row before closing
+CHAT_MAX_FRAME_SIZE = 16384  # Characters or bytes, larger frames are refused
+# Frames waiting to be handled and events waiting to be sent, per socket,
+# and what happens when they overflow: "drop", "coalesce" or "disconnect"
+CHAT_INBOUND_QUEUE = 100
+CHAT_INBOUND_OVERFLOW = "drop"
+CHAT_OUTBOUND_QUEUE = 200
+CHAT_OUTBOUND_OVERFLOW = "coalesce"
+# Months of messages kept by expire_messages, None keeps everything
+CHAT_RETENTION_MONTHS = (
+    int(os.environ["CHAT_RETENTION_MONTHS"]) if os.getenv("CHAT_RETENTION_MONTHS") else None
+)
+# Message encryption keys by one byte id, as "id:base64 key,...", and the
+# id of the key new messages are encrypted with. Key 0 is the built-in key
+# of messages stored before key ids (see utils.Keyring and rotate_keys).
+CHAT_ENCRYPTION_KEYS = dict(
+    item.split(":", 1) for item in os.getenv("CHAT_ENCRYPTION_KEYS", "").split(",") if item
+)
+CHAT_ENCRYPTION_KEY_ID = int(os.getenv("CHAT_ENCRYPTION_KEY_ID", "0"))
+# Base64 secret of the blind search index (see utils.blind_token), derived
+# from SECRET_KEY when unset. Changing either orphans the index entries:
+# rebuild them with build_search_index --rebuild.
+CHAT_SEARCH_KEY = os.getenv("CHAT_SEARCH_KEY")
+
+# Caches: "default" is per process, "shared" is seen by every worker.
+# Without CACHE_URL (a Redis URL) the shared tier is disabled.
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+}
+if os.getenv("CACHE_URL"):
+    CACHES["shared"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("CACHE_URL"),
+    }
+SHARED_CACHE_ALIAS = "shared"
+
+# Sessions and request.user come from the shared cache when there is one,
+# see users/auth.py. Cached users are checked against a shared generation
+# on every request, the TTL only bounds their memory.
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = SHARED_CACHE_ALIAS
+AUTH_USER_CACHE_TTL = 10
+
+# /metrics requires "Authorization: Bearer <token>", without a token it is
+# only served when DEBUG is on
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -116,6 +184,15 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
 STATIC_URL = 'static/'
+# collectstatic writes fingerprinted and compressed copies here, which the
+# ASGI application serves itself (see utils/staticfiles.py)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+# The images and sounds of the app, as static/assets/<name>
+STATICFILES_DIRS = [('assets', BASE_DIR / 'assests')]
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "utils.staticfiles.CompressedManifestStaticFilesStorage"},
+}
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 # Default primary key field type
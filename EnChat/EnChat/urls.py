@@ -2,10 +2,12 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from utils.metrics import metrics
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("auth/", include("users.urls")),
     path("chat/", include("chat.urls")),
+    path("metrics", metrics, name="metrics"),
 ]
 
 if settings.DEBUG:
@@ -0,0 +1,204 @@
+"""
+Async versions of the chat views polled the most, served when
+CHAT_ASYNC_VIEWS is on (see chat/urls.py). Same URLs and responses as
+their counterparts in chat/views.py.
+
+Under ASGI a sync view costs a hop to the thread that runs sync code,
+and concurrent polls queue up for it. These views stay on the event
+loop: reads go through the async ORM, large batches are decrypted in a
+worker thread, and only the writes that need a transaction go to a
+thread.
+"""
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import Http404, JsonResponse
+from django.shortcuts import render
+from . import serializers
+from .events import message_event, publish, read_event, unread_event
+from .models import PrivateMessage, Conversation, UnreadCounter
+from .pagination import PAGE_SIZE, afind, after, apage_before, decode_cursor
+from .views import last_received, next_poll_cursor
+from users.cache import aget_user_summary
+from utils import decrypt_many
+
+
+async def aget_user_summary_or_404(slug):
+    summary = await aget_user_summary(slug)
+    if summary is None:
+        raise Http404("No user matches the given query.")
+    return summary
+
+
+async def mark_read(user, other, up_to, since=None):
+    """Move the read watermark of ``user`` and tell both users when it moved"""
+    if not up_to:
+        return
+    read_at = await sync_to_async(Conversation.objects.mark_read)(
+        user, other, up_to, since
+    )
+    if read_at is not None:
+        await publish(
+            get_channel_layer(),
+            read_event(up_to, read_at, other, user),
+            user.slug,
+            other.slug,
+        )
+        await publish_unread(user)
+
+
+async def read_up_to(user, other, up_to):
+    """
+    The conversation of ``user`` with ``other`` once everything received up
+    to ``up_to`` is read. A watermark already there costs no write nor
+    thread hop, which is the steady state of a polling client.
+    """
+    conversation = await Conversation.objects.abetween(user.pk, other.pk)
+    if conversation is None or conversation.watermark(user.pk)[0] >= (up_to or 0):
+        return conversation
+    await mark_read(user, other, up_to)
+    return await Conversation.objects.abetween(user.pk, other.pk)
+
+
+async def publish_unread(user):
+    """Send the unread totals of ``user`` to all of their sockets"""
+    totals = await UnreadCounter.objects.atotals(user.pk)
+    await publish(get_channel_layer(), unread_event(totals), user.slug)
+
+
+@login_required
+async def conversations(request):
+    """
+    Retrieve the user's conversations with properly formatted latest messages
+    """
+    user = await request.auser()
+
+    conversations = [
+        conversation async for conversation in Conversation.objects.for_user(user)
+    ]
+    previews = iter(
+        await sync_to_async(decrypt_many, thread_sensitive=False)(
+            [conversation.preview for conversation in conversations if conversation.preview]
+        )
+    )
+    for conversation in conversations:
+        conversation.other = conversation.other_user(user)
+        conversation.unread = conversation.unread_for(user)
+        conversation.message = next(previews) if conversation.preview else ""
+    return render(
+        request,
+        "chat/conversations.html",
+        {
+            "conversations": conversations,
+            "no_conversations": not conversations,
+        },
+    )
+
+
+@login_required
+async def chat(request, slug):
+    """Retrieve the latest page of messages between the user and the selected user"""
+    user = await request.auser()
+    receiver = await aget_user_summary_or_404(slug)
+
+    page, older_cursor = await apage_before(
+        serializers.conversation_messages(user.pk, receiver.pk)
+    )
+    # the latest page is on screen, everything received up to its end is read
+    conversation = await read_up_to(user, receiver, last_received(page, user))
+    messages = await serializers.aserialize(page, conversation)
+
+    return render(
+        request,
+        "chat/chat.html",
+        {"receiver": receiver, "messages": messages, "older_cursor": older_cursor},
+    )
+
+
+async def apoll_cursor(request, messages):
+    """views.poll_cursor() for async views"""
+    cursor = decode_cursor(request.GET.get("after", ""))
+    if cursor is None:
+        last_id = request.GET.get("last_id", "")
+        last = await afind(messages, int(last_id)) if last_id.isdigit() else None
+        cursor = (last.timestamp, last.id) if last is not None else None
+    return cursor
+
+
+@login_required
+async def get_messages(request, slug):
+    """
+    AJAX endpoint for getting messages, after the ``after`` cursor that the
+    previous poll returned (or, for older clients, after message ``last_id``)
+    """
+    user = await request.auser()
+    receiver = await aget_user_summary_or_404(slug)
+    conversation_messages = serializers.conversation_messages(user.pk, receiver.pk)
+
+    # Get at most one page of messages after the cursor, the client polls
+    # again from the returned one
+    cursor = await apoll_cursor(request, conversation_messages)
+    polled = after(conversation_messages, cursor) if cursor else conversation_messages
+    messages = [
+        message async for message in polled.order_by("timestamp", "id")[:PAGE_SIZE]
+    ]
+
+    # Everything received up to the last message served is read
+    conversation = await read_up_to(user, receiver, last_received(messages, user))
+    return serializers.json_response(
+        {
+            "messages": await serializers.aserialize(messages, conversation),
+            "cursor": next_poll_cursor(cursor, messages),
+        }
+    )
+
+
+def save_message(sender, receiver, text):
+    # Create and save message, keeping the inbox row in the same transaction
+    with transaction.atomic():
+        message = PrivateMessage.objects.create(
+            sender=sender, receiver_id=receiver.pk, encrypted_message=text
+        )
+        Conversation.objects.record_message(message, text)
+    return message
+
+
+@login_required
+async def send_message(request, slug):
+    """Handle message sending via AJAX"""
+    if request.method != "POST":
+        return JsonResponse({"success": False}, status=405)
+    user = await request.auser()
+    receiver = await aget_user_summary_or_404(slug)
+    message_text = request.POST.get("message", "").strip()
+
+    message = await sync_to_async(save_message)(user, receiver, message_text)
+    record = serializers.serialize_new(message, user, receiver, message_text)
+    await publish(
+        get_channel_layer(),
+        message_event(record, user, receiver, getattr(message, "conversation_id", None)),
+        user.slug,
+        receiver.slug,
+    )
+    await publish_unread(receiver)
+
+    # Return created message data
+    return serializers.json_response({"success": True, "message": record})
+
+
+@login_required
+async def read_message(request, message_id):
+    """Mark a message, and every message before it, as read"""
+    user = await request.auser()
+    message = await afind(PrivateMessage.objects.select_related("sender"), message_id)
+    if message is None:
+        raise Http404("No message matches the given query.")
+    if message.receiver_id == user.pk:
+        await mark_read(user, message.sender, message.id, message.timestamp)
+        return JsonResponse({"success": True, "is_read": True})
+    conversation = await Conversation.objects.abetween(
+        message.sender_id, message.receiver_id
+    )
+    is_read = conversation is not None and conversation.is_read(message)
+    return JsonResponse({"success": True, "is_read": is_read})
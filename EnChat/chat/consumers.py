@@ -1,101 +1,482 @@
-import json
+import asyncio
+import logging
+import time
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import channel_layers
 from django.contrib.auth.models import AnonymousUser
-from django.contrib.auth import get_user_model
-from .models import PrivateMessage
-from django.utils import timezone
-from utils import decrypt_message
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from . import presence, protocol, serializers, throttle
+from .events import (
+    message_event,
+    presence_group,
+    publish,
+    read_event,
+    unread_event,
+    user_group,
+)
+from .models import PrivateMessage, Conversation, UnreadCounter
+from .pagination import afind
+from .writebehind import get_writer
+from users.cache import aget_user_summary
+from utils import metrics
 
-User = get_user_model()
+logger = logging.getLogger(__name__)
 
+MAX_SUBSCRIPTIONS = 500  # Presence subscriptions per socket
+deliveries = set()  # Messages being saved and published, see handle_message
+
+
+def layer_queue_depth():
+    """
+    Messages waiting in the channel-layer queues of this process, for the
+    layers that queue in memory (the in-memory and PostgreSQL ones)
+    """
+    return {
+        (alias,): sum(queue.qsize() for queue in list(layer.channels.values()))
+        for alias, layer in list(channel_layers.backends.items())
+        if isinstance(getattr(layer, "channels", None), dict)
+    }
+
+
+ws_connections = metrics.Counter(
+    "enchat_ws_connections_total", "WebSocket connections", ["outcome"]
+)
+ws_disconnections = metrics.Counter(
+    "enchat_ws_disconnections_total", "Closed WebSocket connections"
+)
+ws_open = metrics.Gauge("enchat_ws_open", "Open WebSocket connections")
+ws_received = metrics.Counter(
+    "enchat_ws_received_total", "Client events received", ["type"]
+)
+ws_frame_events = metrics.Histogram(
+    "enchat_ws_frame_events",
+    "Events coalesced into an outgoing frame",
+    buckets=metrics.COUNT_BUCKETS,
+)
+# Length of the queue of a socket each time it grows, overflows are counted
+# in enchat_ws_dropped_total
+ws_queue_depth = metrics.Histogram(
+    "enchat_ws_queue_depth",
+    "Events waiting in a WebSocket inbox or outbox",
+    ["queue"],
+    buckets=metrics.QUEUE_BUCKETS,
+)
+metrics.Gauge(
+    "enchat_channel_layer_queue_depth",
+    "Messages waiting for consumers",
+    ["layer"],
+    layer_queue_depth,
+)
+
+
+class UserConsumer(AsyncWebsocketConsumer):
+    """
+    One socket per user carrying all of their conversations. Outgoing
+    messages name their conversation (``c``) or, for a first message, the
+    receiver's slug (``to``).
+    """
+
+    # Inbound event type -> handler, see chat/protocol.py
+    handlers = {
+        "message": "handle_message",
+        "read": "handle_read",
+        "ping": "handle_ping",
+        "subscribe": "handle_subscribe",
+    }
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope.get("user", AnonymousUser())
-        self.receiver_id = self.scope["url_route"]["kwargs"].get("slug", None)
-
-        if not self.user.is_authenticated or not self.receiver_id:
+        if not self.user.is_authenticated:
+            ws_connections.inc("rejected")
             await self.close()
             return
 
-        self.room_name = "_".join(sorted([self.user.slug, self.receiver_id]))
-        await self.channel_layer.group_add(self.room_name, self.channel_name)
-        await self.accept()
+        self.codec = protocol.negotiate(self.scope.get("subprotocols", []))
+        self.outbox = []  # (protocol event, raw event for legacy clients)
+        self.outbox_timer = None
+        self.flushing = False
+        self.closing = False
+        self.coalesce_window = getattr(settings, "CHAT_COALESCE_WINDOW", 0.01)
+        self.outbox_limit = getattr(settings, "CHAT_OUTBOUND_QUEUE", 200)
+        self.outbox_policy = getattr(settings, "CHAT_OUTBOUND_OVERFLOW", throttle.COALESCE)
+        self.max_frame_size = getattr(settings, "CHAT_MAX_FRAME_SIZE", 16384)
+        self.connection_bucket = throttle.connection_bucket()
+        self.strikes = 0  # Throttled frames in a row
+        # frames are handled by a task of their own, in order, so that slow
+        # handlers never hold up the events sent to this socket
+        self.inbox = asyncio.Queue(getattr(settings, "CHAT_INBOUND_QUEUE", 100))
+        self.inbox_policy = getattr(settings, "CHAT_INBOUND_OVERFLOW", throttle.DROP)
+        self.inbox_task = asyncio.ensure_future(self.drain_inbox())
+        self.conversations = {}  # Conversation id -> other user, resolved lazily
+        self.subscriptions = set()
+        self.last_heartbeat = time.monotonic()
+        self.groups_joined = [user_group(self.user.slug)]
+        await self.channel_layer.group_add(self.groups_joined[0], self.channel_name)
+        await self.accept(subprotocol=self.codec.subprotocol)
+        ws_connections.inc("accepted")
+        ws_open.inc()
+
+        state = await database_sync_to_async(presence.connect)(self.user)
+        if state is not None:
+            await self.channel_layer.group_send(
+                presence_group(self.user.slug), {"type": "presence", **state}
+            )
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        if not hasattr(self, "groups_joined"):
+            return
+        ws_disconnections.inc()
+        ws_open.dec()
+        self.inbox_task.cancel()
+        if self.outbox_timer is not None:
+            self.outbox_timer.cancel()
+        for group in self.groups_joined:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        state = await database_sync_to_async(presence.disconnect)(self.user)
+        if state is not None:
+            await self.channel_layer.group_send(
+                presence_group(self.user.slug), {"type": "presence", **state}
+            )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_text = data.get("message")
-        # print("Received WebSocket Data:", text_data)
-        if not message_text:
+    async def receive(self, text_data=None, bytes_data=None):
+        # heartbeats are handled without decoding the frame
+        if text_data == protocol.PING or text_data == protocol.LEGACY_PING:
+            ws_received.inc("ping")
+            await self.handle_ping({})
+            return
+        # refused before decoding, neither a flood nor a huge frame is parsed
+        frame = text_data if text_data is not None else bytes_data
+        if len(frame) > self.max_frame_size:
+            ws_received.inc("too_large")
+            throttle.dropped.inc("too_large")
+            await self.refuse("too_large")
+            return
+        scope = self.take_token()
+        if scope is not None:
+            throttle.throttled.inc(scope)
+            self.strikes += 1
+            if self.strikes >= getattr(settings, "CHAT_THROTTLE_DISCONNECT_AFTER", 100):
+                self.closing = True
+                await self.close(code=1008)  # Policy violation
+            elif self.strikes == 1:
+                await self.refuse("throttled")
+            return
+        self.strikes = 0
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except protocol.ProtocolError:
+            ws_received.inc("malformed")
+            await self.refuse("malformed")
             return
+        handler = self.handlers.get(data["t"])
+        ws_received.inc(data["t"] if handler is not None else "unknown")
+        if handler is None:
+            return
+        try:
+            self.inbox.put_nowait((handler, data))
+            ws_queue_depth.observe(self.inbox.qsize(), "inbox")
+        except asyncio.QueueFull:
+            throttle.dropped.inc("inbound")
+            if self.inbox_policy == throttle.DISCONNECT:
+                self.closing = True
+                await self.close(code=1013)  # Try again later
+            else:
+                await self.refuse("overloaded", data.get("ref"))
+
+    def take_token(self):
+        """
+        Charge a frame to the rate limits of the connection and of the user,
+        return the scope of the limit it is over, or None
+        """
+        if not self.connection_bucket.take():
+            return "connection"
+        # looked up every time: the bucket of the user is shared with their
+        # other connections, and the lookup keeps it from being evicted
+        if not throttle.user_bucket(self.user.pk).take():
+            return "user"
+        return None
+
+    async def refuse(self, reason, ref=None):
+        """Tell a versioned client that a frame was not handled"""
+        if not self.codec.legacy:
+            event = {"t": "error", "error": reason}
+            if ref is not None:
+                event["ref"] = ref
+            await self.push(event)
+
+    async def drain_inbox(self):
+        while True:
+            handler, data = await self.inbox.get()
+            try:
+                await getattr(self, handler)(data)
+            except Exception:
+                logger.exception("WebSocket %s frame failed", data["t"])
 
-        receiver = await self.get_user(self.receiver_id)
-        if not receiver:
+    async def resolve_receiver(self, data):
+        """The other user of the conversation a frame is about, or None"""
+        conversation_id = data.get("c")
+        if isinstance(conversation_id, int):
+            if conversation_id not in self.conversations:
+                self.conversations[conversation_id] = await self.get_other_user(
+                    conversation_id, self.user
+                )
+            return self.conversations[conversation_id]
+        if isinstance(data.get("to"), str):
+            return await aget_user_summary(data["to"])
+        return None
+
+    async def handle_message(self, data):
+        message_text = data.get("text")
+        if not message_text or not isinstance(message_text, str):
             return
 
-        msg = await self.save_message(self.user, receiver, message_text)
+        receiver = await self.resolve_receiver(data)
+        if receiver is None:
+            return
 
-        await self.channel_layer.group_send(
-            self.room_name,
-            {
-                "type": "chat_message",
-                "message_id": msg.id,
-                "sender": self.user.username,
-                "message": message_text,
-                "timestamp": str(msg.timestamp),
-            },
+        # a disconnect cancels the handler, not the delivery: once saved, a
+        # message always reaches the room
+        delivery = asyncio.ensure_future(
+            self.deliver_message(data, receiver, message_text)
         )
-        # print(
-        #     f"Message saved: {message_text} from {self.user.username} to {receiver.username}"
-        # )
-    async def chat_message(self, event):
-        # print("Chat message event received:", event)
-        await self.send(text_data=json.dumps(event))
-
-    async def read_message(self, text_data):
-        data = json.loads(text_data)
-        # print("Read message data:", data)
-        message_id = data["message_id"]
-        message = await self.get_message(message_id)
-
-        if message and message.receiver == self.user and not message.is_read:
-            message.is_read = True
-            message.read_at = timezone.now()
-            await message.asave()
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    "type": "read_receipt",
-                    "message_id": message_id,
-                    "read_at": str(message.read_at),
-                },
+        deliveries.add(delivery)
+        delivery.add_done_callback(deliveries.discard)
+        await asyncio.shield(delivery)
+
+    async def deliver_message(self, data, receiver, message_text):
+        """Save a message, acknowledge it and publish it to both users"""
+        writer = get_writer()
+        if writer is not None:
+            msg = await writer.submit(self.user, receiver, message_text)
+        else:
+            msg = await self.save_message(self.user, receiver, message_text)
+
+        if not self.codec.legacy and "ref" in data:
+            await self.push({"t": "ack", "ref": data["ref"], "id": msg.id})
+        record = serializers.serialize_new(msg, self.user, receiver, message_text)
+        await publish(
+            self.channel_layer,
+            message_event(
+                record, self.user, receiver, getattr(msg, "conversation_id", None)
+            ),
+            self.user.slug,
+            receiver.slug,
+        )
+        await self.publish_unread(receiver)
+
+    async def handle_read(self, data):
+        """Move the read watermark of the user up to message ``id``"""
+        up_to = data.get("id")
+        if not isinstance(up_to, int):
+            return
+        other = await self.resolve_receiver(data)
+        since = None
+        if other is None:
+            # v1 clients without watermarks only name the message
+            message = await self.get_message(up_to)
+            if message is None or message.receiver_id != self.user.pk:
+                return
+            other, since = message.sender, message.timestamp
+
+        read_at = await database_sync_to_async(Conversation.objects.mark_read)(
+            self.user, other, up_to, since
+        )
+        if read_at is not None:
+            await publish(
+                self.channel_layer,
+                read_event(up_to, read_at, other, self.user),
+                self.user.slug,
+                other.slug,
             )
+            await self.publish_unread(self.user)
+
+    async def publish_unread(self, user):
+        """Send the unread totals of ``user`` to all of their sockets"""
+        totals = await database_sync_to_async(UnreadCounter.objects.totals)(user.pk)
+        await publish(self.channel_layer, unread_event(totals), user.slug)
+
+    async def handle_ping(self, data):
+        # heartbeats keep the presence alive, written at most every third of
+        # the timeout
+        if time.monotonic() - self.last_heartbeat > presence.PRESENCE_TIMEOUT / 3:
+            self.last_heartbeat = time.monotonic()
+            await database_sync_to_async(presence.heartbeat)(self.user)
+        if not self.codec.legacy:
+            await self.send(text_data=protocol.PONG)
+
+    async def handle_subscribe(self, data):
+        """
+        Follow the presence of a list of users, answered with their state.
+        Only public users and conversation partners can be followed.
+        """
+        slugs = data.get("users")
+        if not isinstance(slugs, list):
+            return
+        candidates = {}
+        for slug in slugs[: MAX_SUBSCRIPTIONS - len(self.subscriptions)]:
+            if not isinstance(slug, str) or slug in self.subscriptions:
+                continue
+            user = await aget_user_summary(slug)
+            if user is not None:
+                candidates[slug] = user
+        # users that may not be followed are skipped like unknown ones
+        users = await database_sync_to_async(presence.followable)(
+            self.user, list(candidates.values())
+        )
+        for user in users:
+            self.subscriptions.add(user.slug)
+            self.groups_joined.append(presence_group(user.slug))
+            await self.channel_layer.group_add(
+                presence_group(user.slug), self.channel_name
+            )
+        if users:
+            for state in await database_sync_to_async(presence.snapshot)(users):
+                await self.push_event({"type": "presence", **state})
+
+    def accepts(self, event):
+        """Whether a group event is forwarded to this socket"""
+        return True
+
+    async def chat_message(self, event):
+        if self.accepts(event):
+            await self.push_event(event)
 
     async def read_receipt(self, event):
-        await self.send(text_data=json.dumps(event))
+        if self.accepts(event):
+            await self.push_event(event)
+
+    async def presence(self, event):
+        if self.accepts(event):
+            await self.push_event(event)
+
+    async def unread(self, event):
+        # totals are only understood by versioned clients
+        if not self.codec.legacy:
+            await self.push_event(event)
+
+    async def push_event(self, event):
+        """Forward a group event, raw to legacy clients"""
+        await self.push(protocol.to_event(event), event if self.codec.legacy else None)
+
+    async def push(self, event, raw=None):
+        """
+        Queue an event, events queued within the coalesce window share a
+        frame. A client reading slower than its events arrive overflows the
+        outbox, which is then handled by the CHAT_OUTBOUND_OVERFLOW policy.
+        """
+        if self.closing:
+            return
+        self.outbox.append((event, raw))
+        ws_queue_depth.observe(len(self.outbox), "outbox")
+        if len(self.outbox) > self.outbox_limit:
+            await self.overflow()
+            if self.closing:
+                return
+        if self.flushing:
+            return  # the running flush sends it next
+        if not self.coalesce_window:
+            await self.flush_outbox()
+        elif self.outbox_timer is None:
+            loop = asyncio.get_running_loop()
+            self.outbox_timer = loop.call_later(
+                self.coalesce_window,
+                lambda: asyncio.ensure_future(self.flush_outbox()),
+            )
+
+    async def overflow(self):
+        if self.outbox_policy == throttle.DISCONNECT:
+            throttle.dropped.inc("slow_client", amount=len(self.outbox))
+            self.outbox = []
+            self.closing = True
+            await self.close(code=1013)  # Try again later
+            return
+        if self.outbox_policy == throttle.COALESCE:
+            self.outbox = throttle.coalesce(self.outbox)
+            excess = len(self.outbox) - self.outbox_limit
+            if excess > 0:
+                throttle.dropped.inc("overflow", amount=excess)
+                del self.outbox[:excess]
+        else:
+            throttle.dropped.inc("overflow")
+            self.outbox.pop()
+
+    async def flush_outbox(self):
+        self.outbox_timer = None
+        if self.flushing:
+            return
+        # one flush at a time, events queued meanwhile go out with the next
+        # frame instead of piling up in concurrent sends
+        self.flushing = True
+        try:
+            while self.outbox and not self.closing:
+                events, self.outbox = self.outbox, []
+                ws_frame_events.observe(len(events))
+                if self.codec.legacy:
+                    for _, raw in events:
+                        if raw is not None:
+                            await self.send(text_data=serializers.dumps(raw))
+                else:
+                    await self.send(**self.codec.encode([event for event, _ in events]))
+        finally:
+            self.flushing = False
 
     @staticmethod
-    async def save_message(sender, receiver, message):
-        # print(sender, receiver, message)
-        return await PrivateMessage.objects.acreate(
-            sender=sender, receiver=receiver, encrypted_message=message
-        )
+    @database_sync_to_async
+    def save_message(sender, receiver, message):
+        with transaction.atomic():
+            msg = PrivateMessage.objects.create(
+                sender=sender, receiver_id=receiver.pk, encrypted_message=message
+            )
+            Conversation.objects.record_message(msg, message)
+        return msg
 
     @staticmethod
-    async def get_user(user_id):
-        try:
-            return await User.objects.aget(slug=user_id)
-        except User.DoesNotExist:
+    async def get_other_user(conversation_id, user):
+        conversation = (
+            await Conversation.objects.filter(Q(user_a=user) | Q(user_b=user))
+            .select_related("user_a", "user_b")
+            .filter(id=conversation_id)
+            .afirst()
+        )
+        if conversation is None:
             return None
+        return await aget_user_summary(conversation.other_user(user).slug)
 
     @staticmethod
     async def get_message(message_id):
-        try:
-            msg = await PrivateMessage.objects.aget(id=message_id)
-            msg.encrypted_message = decrypt_message(msg.encrypted_message)
-            return msg
-        except PrivateMessage.DoesNotExist:
-            return None
+        return await afind(PrivateMessage.objects.select_related("sender"), message_id)
+
+
+class ChatConsumer(UserConsumer):
+    """
+    Socket bound to a single conversation, kept for clients of
+    ``ws/chat/<slug>/``. It shares the user's group and only forwards the
+    events of its conversation.
+    """
+
+    async def connect(self):
+        self.receiver_id = self.scope["url_route"]["kwargs"].get("slug", None)
+        if not self.receiver_id:
+            ws_connections.inc("rejected")
+            await self.close()
+            return
+
+        # resolve the receiver once for the lifetime of the connection
+        self.receiver = await aget_user_summary(self.receiver_id)
+        if self.receiver is None:
+            ws_connections.inc("rejected")
+            await self.close()
+            return
+        await super().connect()
+
+    async def resolve_receiver(self, data):
+        return self.receiver
+
+    def accepts(self, event):
+        if event["type"] == "presence":
+            return event["user"] == self.receiver.slug
+        pair = {event["sender_slug"], event["receiver_slug"]}
+        return pair == {self.user.slug, self.receiver.slug}
@@ -0,0 +1,64 @@
+"""
+Channel-layer groups used to fan out chat events.
+
+Every WebSocket of a user joins that user's group, so an event about a
+conversation is sent to exactly two groups (one for a chat with oneself)
+no matter how many conversations or tabs are open. Presence changes of a
+user go to a separate group joined by the sockets that subscribed to them.
+"""
+import time
+from utils import metrics
+
+fanout_seconds = metrics.Histogram(
+    "enchat_group_send_seconds", "Time to fan an event out to its groups", ["event"]
+)
+
+
+def user_group(slug):
+    return f"user_{slug}"
+
+
+def presence_group(slug):
+    return f"presence_{slug}"
+
+
+async def publish(channel_layer, event, *slugs):
+    """Send ``event`` to the groups of the given users"""
+    start = time.perf_counter()
+    for slug in dict.fromkeys(slugs):
+        await channel_layer.group_send(user_group(slug), event)
+    fanout_seconds.observe(time.perf_counter() - start, event["type"])
+
+
+def message_event(record, sender, receiver, conversation_id=None):
+    """New message event, ``record`` is its chat.serializers dict"""
+    return {
+        "type": "chat_message",
+        "message_id": record["id"],
+        "conversation": conversation_id,
+        "sender": record["sender"],
+        "sender_slug": sender.slug,
+        "receiver_slug": receiver.slug,
+        "message": record["message"],
+        "timestamp": str(record["timestamp"]),
+    }
+
+
+def read_event(up_to, read_at, sender, reader):
+    """Watermark event: ``reader`` read every message of ``sender`` up to ``up_to``"""
+    return {
+        "type": "read_receipt",
+        "message_id": up_to,
+        "sender_slug": sender.slug,
+        "receiver_slug": reader.slug,
+        "read_at": str(read_at),
+    }
+
+
+def unread_event(totals):
+    """Unread totals of the user whose group it is sent to"""
+    return {
+        "type": "unread",
+        "messages": totals["messages"],
+        "conversations": totals["conversations"],
+    }
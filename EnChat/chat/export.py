@@ -0,0 +1,150 @@
+"""
+Streaming export of a conversation or of a whole mailbox as NDJSON or
+CSV, optionally gzipped on the fly.
+
+Rows come from a server-side cursor and are decrypted a chunk at a time
+in a worker thread while the next chunk is fetched, so memory stays flat
+whatever the size of the history. Under ASGI the export runs in a thread
+of its own, with its own database connection, because a server-side
+cursor cannot survive the connection shared by the other requests.
+"""
+import asyncio
+import csv
+import io
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections
+from django.db.models import Q
+from users.models import User
+from utils import decrypt_many
+from .models import PrivateMessage
+
+CHUNK_SIZE = 2000  # Rows fetched, decrypted and written at a time
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+FIELDS = ["id", "timestamp", "sender", "receiver", "message"]
+
+
+def mailbox(user_id, other_id=None):
+    """The messages of a user, or of their conversation with ``other_id``"""
+    if other_id is None:
+        messages = PrivateMessage.objects.filter(
+            Q(sender_id=user_id) | Q(receiver_id=user_id)
+        )
+    else:
+        messages = PrivateMessage.objects.filter(
+            Q(sender_id=user_id, receiver_id=other_id)
+            | Q(sender_id=other_id, receiver_id=user_id)
+        )
+    return messages.order_by("timestamp", "id").values_list(
+        "id", "timestamp", "sender_id", "receiver_id", "ciphertext", "encrypted_message"
+    )
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def records(rows, chunk_size=CHUNK_SIZE):
+    """
+    Lists of message dicts, one per chunk of ``rows``. A chunk is decrypted
+    in a worker thread while the next one is fetched.
+    """
+    usernames = {}
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="export") as executor:
+        pending = None
+        for chunk in _chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+            encrypted = [
+                legacy if ciphertext is None else ciphertext
+                for *_, ciphertext, legacy in chunk
+            ]
+            decrypting = executor.submit(decrypt_many, encrypted)
+            if pending is not None:
+                yield _records(*pending, usernames)
+            pending = (chunk, decrypting)
+        if pending is not None:
+            yield _records(*pending, usernames)
+
+
+def _records(chunk, decrypting, usernames):
+    # a mailbox has few distinct correspondents, look each up once
+    missing = {row[2] for row in chunk} | {row[3] for row in chunk}
+    missing -= usernames.keys()
+    if missing:
+        usernames.update(
+            User.objects.filter(id__in=missing).values_list("id", "username")
+        )
+    return [
+        {
+            "id": message_id,
+            "timestamp": timestamp.isoformat(),
+            "sender": usernames.get(sender_id),
+            "receiver": usernames.get(receiver_id),
+            "message": text,
+        }
+        for (message_id, timestamp, sender_id, receiver_id, *_), text in zip(
+            chunk, decrypting.result()
+        )
+    ]
+
+
+def render(chunks, file_format):
+    """Encoded blocks of NDJSON or CSV, one per chunk of records"""
+    if file_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, FIELDS)
+        writer.writeheader()
+        yield buffer.getvalue().encode()
+        for chunk in chunks:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode()
+    else:
+        for chunk in chunks:
+            yield "".join(
+                json.dumps(record, ensure_ascii=False) + "\n" for record in chunk
+            ).encode()
+
+
+def gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(user_id, other_id=None, file_format="ndjson", compress=False):
+    """The export as an iterator of bytes"""
+    blocks = render(records(mailbox(user_id, other_id)), file_format)
+    return gzipped(blocks) if compress else blocks
+
+
+async def astream(user_id, other_id=None, file_format="ndjson", compress=False):
+    """stream() for ASGI responses, run in a dedicated thread"""
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export-stream")
+    blocks = stream(user_id, other_id, file_format, compress)
+    try:
+        while True:
+            block = await loop.run_in_executor(executor, next, blocks, None)
+            if block is None:
+                break
+            yield block
+    finally:
+        await loop.run_in_executor(executor, _close, blocks)
+        executor.shutdown(wait=False)
+
+
+def _close(blocks):
+    blocks.close()
+    connections.close_all()  # This thread's connections only
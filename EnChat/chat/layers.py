@@ -0,0 +1,445 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import string
+import time
+from copy import deepcopy
+import psycopg
+from psycopg import sql
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+# Connection parameters of Django's that are not conninfo keywords
+DJANGO_ONLY_PARAMS = {"context", "cursor_factory", "prepare_threshold"}
+
+
+class LoopState:
+    """The connections of a channel layer in one event loop"""
+
+    def __init__(self):
+        self.ready = None  # task opening the writer
+        self.writer = None
+        self.listening = None  # task opening the listener
+        self.listener = None
+        self.listen_task = None
+        self.routes = set()  # routes LISTENed on
+        self.pending_listens = set()
+        self.reconnecting = None  # task replacing both connections
+
+    def _tasks(self):
+        tasks = (self.ready, self.listening, self.listen_task, self.reconnecting)
+        return [task for task in tasks if task]
+
+    async def close(self):
+        for task in self._tasks():
+            task.cancel()
+        for connection in (self.listener, self.writer):
+            if connection is not None:
+                await connection.close()
+
+    def discard(self):
+        """Close without the loop, which may be closed already"""
+        for task in self._tasks():
+            if not task.get_loop().is_closed():
+                task.cancel()
+        for connection in (self.listener, self.writer):
+            if connection is not None and not connection.closed:
+                connection.pgconn.finish()
+
+
+class PostgresChannelLayer(BaseChannelLayer):
+    """
+    Channel layer on top of PostgreSQL LISTEN/NOTIFY, so group_send reaches
+    consumers in every worker process and host sharing the database.
+
+    Every layer instance LISTENs on one PostgreSQL channel for all of its
+    process-specific channels. A group_send looks up the group members once
+    and sends a single NOTIFY per remote process, members in the same
+    process are served from memory. Envelopes too large for a NOTIFY
+    payload are spilled to a table and fetched by the receiving process.
+    Group memberships expire after ``group_expiry`` seconds.
+
+    Once a connection fails both are replaced, retrying with exponential
+    backoff, and every route is LISTENed on again. Notifications sent in
+    between are lost.
+
+    Plain (non process-specific) channel names are LISTENed on by every
+    process that receives on them, so each of those processes gets a copy.
+    """
+
+    extensions = ["groups", "flush"]
+    # NOTIFY payloads are limited to 8000 bytes
+    spill_threshold = 7500
+    listen_poll = 0.5
+    cleanup_interval = 60
+    # Seconds between reconnection attempts, doubling up to the maximum
+    reconnect_delay = 0.5
+    reconnect_max_delay = 30
+
+    def __init__(
+        self,
+        conninfo=None,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        table_prefix="channels",
+        **kwargs,
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs,
+        )
+        self.conninfo = conninfo
+        self.group_expiry = group_expiry
+        self.table_prefix = table_prefix
+        self.groups_table = sql.Identifier(f"{table_prefix}_group_membership")
+        self.payloads_table = sql.Identifier(f"{table_prefix}_payload")
+        self.client_prefix = "".join(random.choices(string.hexdigits.lower(), k=24))
+        self.own_route = f"{table_prefix}_{self.client_prefix}"
+        self.channels = {}
+        self._loops = {}  # event loop: LoopState
+        self._next_cleanup = 0
+
+    # Connection management
+
+    def get_conninfo(self):
+        """The conninfo of the layer, else that of the default database"""
+        if self.conninfo:
+            return self.conninfo
+        # Django's parameters include OPTIONS (sslmode and the like), minus
+        # the ones for its own connection class
+        params = connections["default"].get_connection_params()
+        return psycopg.conninfo.make_conninfo(
+            **{
+                key: value
+                for key, value in params.items()
+                if key not in DJANGO_ONLY_PARAMS and value is not None
+            }
+        )
+
+    async def _state(self, listen=False):
+        """
+        The connections for the running event loop, started if needed, with
+        the listener when ``listen``. Each loop gets its own: async_to_sync
+        runs every call in a new loop, and a connection only works in the
+        loop it was opened in.
+        """
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            self._discard_closed_loops()
+            state = self._loops[loop] = LoopState()
+            state.ready = loop.create_task(self._start(state))
+        if listen and state.listening is None:
+            state.listening = loop.create_task(self._start_listener(state))
+        try:
+            await asyncio.shield(state.ready)
+            if listen:
+                await asyncio.shield(state.listening)
+        except Exception:
+            # started over by the next call
+            self._loops.pop(loop, None)
+            state.discard()
+            raise
+        return state
+
+    async def _connection(self):
+        state = await self._state()
+        if state.writer.closed:
+            await self._reconnect(state)
+        return state.writer
+
+    def _discard_closed_loops(self):
+        """Close the connections of loops that were closed without close()"""
+        for loop, state in list(self._loops.items()):
+            if loop.is_closed():
+                del self._loops[loop]
+                state.discard()
+
+    async def _start(self, state):
+        state.writer = await psycopg.AsyncConnection.connect(
+            self.get_conninfo(), autocommit=True
+        )
+        await state.writer.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "group_name varchar(100) NOT NULL, "
+                "channel varchar(100) NOT NULL, "
+                "expires timestamptz NOT NULL, "
+                "PRIMARY KEY (group_name, channel))"
+            ).format(self.groups_table)
+        )
+        await state.writer.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "id bigserial PRIMARY KEY, "
+                "envelope text NOT NULL, "
+                "expires timestamptz NOT NULL)"
+            ).format(self.payloads_table)
+        )
+
+    async def _start_listener(self, state):
+        """LISTEN for this process, in loops that receive only"""
+        await asyncio.shield(state.ready)
+        state.listener = await psycopg.AsyncConnection.connect(
+            self.get_conninfo(), autocommit=True
+        )
+        state.pending_listens.add(self.own_route)
+        await self._listen_pending(state)
+        state.listen_task = asyncio.get_running_loop().create_task(self._listen(state))
+
+    async def _listen_pending(self, state):
+        while state.pending_listens:
+            route = next(iter(state.pending_listens))
+            await state.listener.execute(
+                sql.SQL("LISTEN {}").format(sql.Identifier(route))
+            )
+            state.pending_listens.discard(route)
+            state.routes.add(route)
+
+    async def _listen(self, state):
+        while True:
+            try:
+                await self._listen_pending(state)
+                async for notify in state.listener.notifies(timeout=self.listen_poll):
+                    await self._dispatch(state, notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except psycopg.OperationalError:
+                logger.warning("Channel layer lost its connection, reconnecting")
+                # cancels this task and starts another one on the new listener
+                await self._reconnect(state)
+            except Exception:
+                logger.exception("Channel layer listener failed")
+                await asyncio.sleep(self.listen_poll)
+
+    async def _reconnect(self, state):
+        """
+        Replace the writer, and the listener of loops that receive, after a
+        connection error. Concurrent callers share one attempt.
+        """
+        if state.reconnecting is None:
+            state.reconnecting = asyncio.get_running_loop().create_task(
+                self._reopen(state)
+            )
+        await asyncio.shield(state.reconnecting)
+
+    async def _reopen(self, state):
+        if state.listen_task is not None:
+            state.listen_task.cancel()
+        # LISTEN again on every route once the listener is back
+        state.pending_listens |= state.routes
+        delay = self.reconnect_delay
+        try:
+            while True:
+                for connection in (state.listener, state.writer):
+                    if connection is not None and not connection.closed:
+                        await connection.close()
+                try:
+                    await self._start(state)
+                    if state.listening is not None:
+                        await self._start_listener(state)
+                    return
+                except psycopg.OperationalError:
+                    logger.warning(
+                        "Channel layer reconnection failed, retrying in %.1fs", delay
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.reconnect_max_delay)
+        finally:
+            state.reconnecting = None
+
+    async def _dispatch(self, state, payload):
+        data = json.loads(payload)
+        if "p" in data:
+            # spilled envelope, exactly one process is notified about each
+            cursor = await state.writer.execute(
+                sql.SQL("DELETE FROM {} WHERE id = %s RETURNING envelope").format(
+                    self.payloads_table
+                ),
+                (data["p"],),
+            )
+            row = await cursor.fetchone()
+            if row is None:
+                return
+            data = json.loads(row[0])
+        message = data["m"]
+        for index, channel in enumerate(data["c"]):
+            self._deliver(channel, deepcopy(message) if index else message)
+
+    def _deliver(self, channel, message, raise_full=False):
+        queue = self.channels.setdefault(
+            channel, asyncio.Queue(maxsize=self.get_capacity(channel))
+        )
+        try:
+            queue.put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            if raise_full:
+                raise ChannelFull(channel)
+
+    async def _notify(self, routes, message):
+        """Send ``message`` to the channels of each remote route in one round trip"""
+        body = json.dumps(message, separators=(",", ":"))
+        names, payloads, spilled = [], [], []
+        for route, channels in routes.items():
+            envelope = '{"c":%s,"m":%s}' % (json.dumps(channels), body)
+            if len(envelope.encode()) > self.spill_threshold:
+                spilled.append((route, envelope))
+            else:
+                names.append(route)
+                payloads.append(envelope)
+
+        writer = await self._connection()
+        for route, envelope in spilled:
+            cursor = await writer.execute(
+                sql.SQL(
+                    "INSERT INTO {} (envelope, expires) "
+                    "VALUES (%s, now() + make_interval(secs => %s)) RETURNING id"
+                ).format(self.payloads_table),
+                (envelope, self.expiry),
+            )
+            (payload_id,) = await cursor.fetchone()
+            names.append(route)
+            payloads.append(json.dumps({"p": payload_id}))
+        if names:
+            await writer.execute(
+                "SELECT pg_notify(route, payload) "
+                "FROM unnest(%s::text[], %s::text[]) AS t(route, payload)",
+                (names, payloads),
+            )
+
+    def route(self, channel):
+        """PostgreSQL channel LISTENed on by the receivers of ``channel``"""
+        if "!" in channel:
+            process = self.non_local_name(channel)[:-1].rsplit(".", 1)[-1]
+            return f"{self.table_prefix}_{process}"
+        digest = hashlib.blake2b(channel.encode(), digest_size=12).hexdigest()
+        return f"{self.table_prefix}_{digest}"
+
+    async def _cleanup(self):
+        if time.monotonic() < self._next_cleanup:
+            return
+        self._next_cleanup = time.monotonic() + self.cleanup_interval
+        writer = await self._connection()
+        for table in (self.groups_table, self.payloads_table):
+            await writer.execute(
+                sql.SQL("DELETE FROM {} WHERE expires < now()").format(table)
+            )
+
+    def _clean_expired(self):
+        for channel, queue in list(self.channels.items()):
+            while not queue.empty() and queue._queue[0][0] < time.time():
+                queue.get_nowait()
+                if queue.empty():
+                    self.channels.pop(channel, None)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """Send a message onto a (general or specific) channel"""
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        route = self.route(channel)
+        if route == self.own_route:
+            self._deliver(channel, deepcopy(message), raise_full=True)
+        else:
+            await self._notify({route: [channel]}, message)
+
+    async def receive(self, channel):
+        """Receive the first message that arrives on the channel"""
+        self.require_valid_channel_name(channel)
+        state = await self._state(listen=True)
+        self._clean_expired()
+        route = self.route(channel)
+        if route not in state.routes:
+            state.pending_listens.add(route)
+
+        queue = self.channels.setdefault(
+            channel, asyncio.Queue(maxsize=self.get_capacity(channel))
+        )
+        try:
+            _, message = await queue.get()
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+        return message
+
+    async def new_channel(self, prefix="specific."):
+        """Returns a new channel name that is received on by this process"""
+        return "%s.%s!%s" % (
+            prefix,
+            self.client_prefix,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    async def flush(self):
+        writer = await self._connection()
+        for table in (self.groups_table, self.payloads_table):
+            await writer.execute(sql.SQL("DELETE FROM {}").format(table))
+        self.channels = {}
+
+    async def close(self):
+        """Close the connections of the running loop, and those of closed loops"""
+        self._discard_closed_loops()
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """Adds the channel name to a group"""
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        writer = await self._connection()
+        await writer.execute(
+            sql.SQL(
+                "INSERT INTO {} (group_name, channel, expires) "
+                "VALUES (%s, %s, now() + make_interval(secs => %s)) "
+                "ON CONFLICT (group_name, channel) "
+                "DO UPDATE SET expires = EXCLUDED.expires"
+            ).format(self.groups_table),
+            (group, channel, self.group_expiry),
+        )
+        await self._cleanup()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        writer = await self._connection()
+        await writer.execute(
+            sql.SQL("DELETE FROM {} WHERE group_name = %s AND channel = %s").format(
+                self.groups_table
+            ),
+            (group, channel),
+        )
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        writer = await self._connection()
+        cursor = await writer.execute(
+            sql.SQL(
+                "SELECT channel FROM {} WHERE group_name = %s AND expires > now()"
+            ).format(self.groups_table),
+            (group,),
+        )
+        routes = {}
+        for (channel,) in await cursor.fetchall():
+            routes.setdefault(self.route(channel), []).append(channel)
+
+        for channel in routes.pop(self.own_route, []):
+            self._deliver(channel, deepcopy(message))
+        if routes:
+            await self._notify(routes, message)
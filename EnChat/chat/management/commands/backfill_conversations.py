@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Max, Q
+from django.db.models.functions import Coalesce, Greatest, Least
+from chat.models import PrivateMessage, Conversation, PREVIEW_LENGTH
+from utils import encrypt_many, decrypt_many
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the Conversation inbox table from existing PrivateMessage rows, "
+        "carrying PrivateMessage.is_read over to the read watermarks. "
+        "Run reconcile_unread afterwards for the per-user unread totals."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        pairs = (
+            PrivateMessage.objects.annotate(
+                a=Least("sender_id", "receiver_id"),
+                b=Greatest("sender_id", "receiver_id"),
+            )
+            .values("a", "b")
+            .annotate(
+                last_id=Max("id"),
+                unread_a=Count("id", filter=Q(is_read=False, receiver_id=F("a"))),
+                unread_b=Count("id", filter=Q(is_read=False, receiver_id=F("b"))),
+                last_read_a=Coalesce(
+                    Max("id", filter=Q(is_read=True, receiver_id=F("a"))), 0
+                ),
+                last_read_b=Coalesce(
+                    Max("id", filter=Q(is_read=True, receiver_id=F("b"))), 0
+                ),
+                read_at_a=Max("read_at", filter=Q(receiver_id=F("a"))),
+                read_at_b=Max("read_at", filter=Q(receiver_id=F("b"))),
+            )
+            .order_by()
+        )
+
+        total = 0
+        batch = []
+        for pair in pairs.iterator(chunk_size=batch_size):
+            batch.append(pair)
+            if len(batch) >= batch_size:
+                total += self.write_batch(batch)
+                batch = []
+        if batch:
+            total += self.write_batch(batch)
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {total} conversations"))
+
+    def write_batch(self, batch):
+        last_messages = PrivateMessage.objects.in_bulk([p["last_id"] for p in batch])
+        lasts = [last_messages[pair["last_id"]] for pair in batch]
+        previews = encrypt_many(
+            text[:PREVIEW_LENGTH]
+            for text in decrypt_many(last.encrypted for last in lasts)
+        )
+        conversations = []
+        for pair, last, preview in zip(batch, lasts, previews):
+            conversations.append(
+                Conversation(
+                    user_a_id=pair["a"],
+                    user_b_id=pair["b"],
+                    last_message=last,
+                    last_timestamp=last.timestamp,
+                    preview=preview,
+                    unread_a=pair["unread_a"],
+                    unread_b=pair["unread_b"],
+                    last_read_a=pair["last_read_a"],
+                    last_read_b=pair["last_read_b"],
+                    read_at_a=pair["read_at_a"],
+                    read_at_b=pair["read_at_b"],
+                )
+            )
+        Conversation.objects.bulk_create(
+            conversations,
+            update_conflicts=True,
+            unique_fields=["user_a", "user_b"],
+            update_fields=[
+                "last_message",
+                "last_timestamp",
+                "preview",
+                "unread_a",
+                "unread_b",
+                "last_read_a",
+                "last_read_b",
+                "read_at_a",
+                "read_at_b",
+            ],
+        )
+        return len(conversations)
@@ -0,0 +1,71 @@
+import asyncio
+import statistics
+import time
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from chat.layers import PostgresChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare group_send throughput and latency of the in-memory and the "
+        "PostgreSQL channel layers"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--members", type=int, default=2)
+        parser.add_argument("--conninfo", default=None)
+
+    def handle(self, *args, **options):
+        messages, members = options["messages"], options["members"]
+        capacity = messages + 1
+        memory = InMemoryChannelLayer(capacity=capacity)
+        self.report("in-memory", asyncio.run(self.run([memory], messages, members)))
+
+        # two layer instances stand in for two worker processes, so half of
+        # the group members are reached through NOTIFY
+        postgres = [
+            PostgresChannelLayer(conninfo=options["conninfo"], capacity=capacity)
+            for _ in range(2)
+        ]
+        self.report("postgres", asyncio.run(self.run(postgres, messages, members)))
+
+    async def run(self, layers, messages, members):
+        group = "benchmark"
+        await layers[0].flush()
+        channels = []
+        for index in range(members):
+            layer = layers[index % len(layers)]
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            channels.append((layer, channel))
+
+        latencies = []
+
+        async def consume(layer, channel):
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message["sent"])
+
+        consumers = [asyncio.create_task(consume(*member)) for member in channels]
+        await asyncio.sleep(1)  # let every layer start listening
+        start = time.perf_counter()
+        for _ in range(messages):
+            await layers[0].group_send(group, {"type": "benchmark", "sent": time.perf_counter()})
+        await asyncio.wait_for(asyncio.gather(*consumers), timeout=120)
+        elapsed = time.perf_counter() - start
+
+        await layers[0].flush()
+        for layer in layers:
+            await layer.close()
+        return messages, len(latencies), elapsed, latencies
+
+    def report(self, name, result):
+        messages, delivered, elapsed, latencies = result
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{name:>10}: {messages / elapsed:9.0f} group_send/s "
+            f"{delivered / elapsed:9.0f} deliveries/s "
+            f"p50 {quantiles[49] * 1000:7.2f} ms p99 {quantiles[98] * 1000:7.2f} ms"
+        )
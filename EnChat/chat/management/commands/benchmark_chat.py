@@ -0,0 +1,457 @@
+import asyncio
+import json
+import platform
+import random
+import statistics
+import time
+import types
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import AsyncClient, Client
+from django.test.utils import (
+    CaptureQueriesContext,
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+from django.urls import include, path
+from chat import async_views, urls as chat_urls, views
+from chat.models import PrivateMessage, Conversation
+from users.models import User, DEFAULT_PROFILE_PICS
+from utils import (
+    decrypt_cache,
+    decrypt_message,
+    decrypt_many,
+    encrypt_message,
+    encrypt_many,
+    seal_many,
+)
+
+WORDS = (
+    "hey there how are you doing today did you see the game last night "
+    "let me know when you are free we should grab lunch sounds good see you"
+).split()
+
+# metric -> True when a higher value is better, for the baseline comparison
+METRICS = {
+    "messages_per_second": True,
+    "requests_per_second": True,
+    "latency_p50_ms": False,
+    "latency_p95_ms": False,
+    "latency_p99_ms": False,
+    "p50_ms": False,
+    "p95_ms": False,
+    "queries_mean": False,
+    "queries_max": False,
+    "encrypt_us": False,
+    "decrypt_us": False,
+    "encrypt_many_us": False,
+    "decrypt_many_us": False,
+    "seal_many_us": False,
+    "open_many_us": False,
+}
+
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end chat benchmark on a throwaway test database: seeds users "
+        "and message history, drives ChatConsumer with concurrent WebSocket "
+        "clients and the chat views with the test client, and reports "
+        "messages/s, send-to-receive latency, queries per request and crypto "
+        "time per message as JSON, optionally compared to a baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=40, help="WebSocket clients")
+        parser.add_argument(
+            "--history", type=int, default=500, help="Seeded messages per conversation"
+        )
+        parser.add_argument(
+            "--messages", type=int, default=50, help="Messages sent per client"
+        )
+        parser.add_argument(
+            "--window",
+            type=int,
+            default=1,
+            help="Undelivered messages a client keeps in flight",
+        )
+        parser.add_argument(
+            "--requests", type=int, default=50, help="Requests per view"
+        )
+        parser.add_argument(
+            "--pollers",
+            type=int,
+            default=20,
+            help="Clients polling get_messages concurrently, with sync then async views",
+        )
+        parser.add_argument("--polls", type=int, default=20, help="Requests per poller")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--baseline", help="Compare with the results of a previous run")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=None,
+            help="Fail when a metric is this many percent worse than the baseline",
+        )
+        parser.add_argument(
+            "--keepdb", action="store_true", help="Keep the test database afterwards"
+        )
+
+    def handle(self, *args, **options):
+        if options["users"] < 2 or options["users"] % 2:
+            raise CommandError("--users must be an even number of at least 2")
+        self.rng = random.Random(options["seed"])
+
+        # never touch the real data: everything runs on test_<NAME>
+        setup_test_environment()
+        old_config = setup_databases(
+            verbosity=0, interactive=False, keepdb=options["keepdb"]
+        )
+        try:
+            results = self.run(options)
+        finally:
+            connection.close()
+            teardown_databases(old_config, verbosity=0, keepdb=options["keepdb"])
+            teardown_test_environment()
+
+        self.stdout.write(json.dumps(results, indent=2))
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["tolerance"])
+
+    def run(self, options):
+        started = time.perf_counter()
+        users, texts = self.seed(options["users"], options["history"])
+        seeded = time.perf_counter() - started
+        return {
+            "environment": {
+                "python": platform.python_version(),
+                "database": connection.vendor,
+                "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+                "group_commit": getattr(settings, "CHAT_GROUP_COMMIT", False),
+                "coalesce_window": getattr(settings, "CHAT_COALESCE_WINDOW", 0.01),
+            },
+            "parameters": {
+                key: options[key]
+                for key in (
+                    "users",
+                    "history",
+                    "messages",
+                    "window",
+                    "requests",
+                    "pollers",
+                    "polls",
+                    "seed",
+                )
+            },
+            "seed_seconds": round(seeded, 3),
+            "websocket": self.run_websocket_unthrottled(
+                users,
+                [self.session_cookie(user) for user in users],
+                options["messages"],
+                options["window"],
+            ),
+            "views": self.run_views(users, options["requests"]),
+            "polling": self.run_polling(users, options["pollers"], options["polls"]),
+            "crypto": self.run_crypto(texts),
+        }
+
+    def seed(self, count, history):
+        """
+        ``count`` users paired into conversations of ``history`` messages
+        each, written in bulk the way the group-commit writer does
+        """
+        password = make_password(None)
+        slugs = User.slugify_many(count)
+        users = User.objects.bulk_create(
+            User(
+                username=f"bench{index}",
+                email=f"bench{index}@example.com",
+                password=password,
+                slug=slug,
+                profile_picture=DEFAULT_PROFILE_PICS[index % len(DEFAULT_PROFILE_PICS)],
+            )
+            for index, slug in enumerate(slugs)
+        )
+        texts = []
+        for a, b in zip(users[::2], users[1::2]):
+            batch = [sentence(self.rng) for _ in range(history)]
+            messages = [
+                PrivateMessage(
+                    sender=(a, b)[index % 2],
+                    receiver_id=(b, a)[index % 2].pk,
+                    ciphertext=sealed,
+                )
+                for index, sealed in enumerate(seal_many(batch))
+            ]
+            with transaction.atomic():
+                messages = PrivateMessage.objects.bulk_create(messages)
+                Conversation.objects.record_messages(messages, batch)
+            texts.extend(batch)
+        return users, texts
+
+    def session_cookie(self, user):
+        client = Client()
+        client.force_login(user)
+        return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def run_websocket_unthrottled(self, *args):
+        # measure the server, not the rate limits of chat.throttle
+        unlimited = 10**9
+        with override_settings(
+            CHAT_CONNECTION_RATE=unlimited,
+            CHAT_CONNECTION_BURST=unlimited,
+            CHAT_USER_RATE=unlimited,
+            CHAT_USER_BURST=unlimited,
+        ):
+            return asyncio.run(self.run_websocket(*args))
+
+    async def run_websocket(self, users, cookies, per_client, window):
+        """
+        Every user opens ws/chat/<partner>/ and sends ``per_client``
+        messages, keeping at most ``window`` undelivered; latency runs
+        from the send to the partner's frame
+        """
+        from EnChat.asgi import application
+
+        partners = {}
+        for a, b in zip(users[::2], users[1::2]):
+            partners[a.pk], partners[b.pk] = b, a
+
+        clients = []
+        for user, cookie in zip(users, cookies):
+            communicator = WebsocketCommunicator(
+                application,
+                f"/ws/chat/{partners[user.pk].slug}/",
+                headers=[
+                    (b"cookie", f"{settings.SESSION_COOKIE_NAME}={cookie}".encode()),
+                    (b"host", b"testserver"),
+                ],
+                subprotocols=["enchat.v1.json"],
+            )
+            connected, _ = await communicator.connect(timeout=10)
+            if not connected:
+                raise CommandError(f"WebSocket connection refused for {user.username}")
+            clients.append((user, communicator))
+
+        sent = {}
+        latencies = []
+        expected = len(users) * per_client
+        # each client keeps at most ``window`` messages in flight, until the
+        # server echoes them back (acks come before delivery and would let
+        # senders outrun the consumers)
+        windows = {user.pk: asyncio.Semaphore(window) for user in users}
+
+        async def send(user, communicator):
+            for index in range(per_client):
+                await windows[user.pk].acquire()
+                text = f"{user.slug}:{index} {sentence(self.rng)}"
+                sent[text] = time.perf_counter()
+                await communicator.send_json_to(
+                    {"v": 1, "t": "message", "text": text, "ref": index}
+                )
+
+        async def receive(user, communicator):
+            received = echoed = 0
+            while received < per_client or echoed < per_client:
+                frame = await communicator.receive_from(timeout=60)
+                if frame == "pong":
+                    continue
+                for event in json.loads(frame)["events"]:
+                    if event["t"] != "message":
+                        continue
+                    if event["sender"] == user.username:
+                        windows[user.pk].release()
+                        echoed += 1
+                    else:
+                        latencies.append(time.perf_counter() - sent.pop(event["text"]))
+                        received += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(send(*client) for client in clients),
+            *(receive(*client) for client in clients),
+        )
+        elapsed = time.perf_counter() - start
+        for _, communicator in clients:
+            await communicator.disconnect()
+        # the consumers' connection lives in the sync thread, release it
+        await database_sync_to_async(connections.close_all)()
+
+        latencies = [latency * 1000 for latency in latencies]
+        return {
+            "clients": len(clients),
+            "messages": expected,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(expected / elapsed, 1),
+            "latency_p50_ms": round(percentile(latencies, 50), 2),
+            "latency_p95_ms": round(percentile(latencies, 95), 2),
+            "latency_p99_ms": round(percentile(latencies, 99), 2),
+        }
+
+    def run_views(self, users, count):
+        """Wall time and queries of the HTTP chat views at the seeded history"""
+        user, partner = users[0], users[1]
+        client = Client()
+        client.force_login(user)
+        views = {
+            "conversations": lambda: client.get("/chat/"),
+            "chat": lambda: client.get(f"/chat/chat/{partner.slug}/"),
+            "get_messages": lambda: client.get(
+                f"/chat/get_messages/{partner.slug}/", {"last_id": 0}
+            ),
+            "send_message": lambda: client.post(
+                f"/chat/send_message/{partner.slug}/", {"message": sentence(self.rng)}
+            ),
+        }
+        results = {}
+        for name, request in views.items():
+            request()  # warm up caches, as in a running server
+            timings, queries = [], []
+            for _ in range(count):
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = request()
+                    timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f"{name} returned {response.status_code}")
+                queries.append(len(captured))
+            results[name] = {
+                "p50_ms": round(percentile(timings, 50), 2),
+                "p95_ms": round(percentile(timings, 95), 2),
+                "queries_mean": round(statistics.mean(queries), 2),
+                "queries_max": max(queries),
+            }
+        return results
+
+    def run_polling(self, users, pollers, polls):
+        """
+        ``pollers`` clients polling get_messages at once through the ASGI
+        handler, served by the sync views then by the async ones
+        """
+        results = {}
+        for name, module in (("sync", views), ("async", async_views)):
+            urlconf = types.ModuleType(f"benchmark_{name}_urls")
+            urlconf.urlpatterns = [path("chat/", include(chat_urls.patterns(module)))]
+            with override_settings(ROOT_URLCONF=urlconf):
+                results[name] = asyncio.run(self.poll(users, pollers, polls))
+        results["async_speedup"] = round(
+            results["async"]["requests_per_second"]
+            / results["sync"]["requests_per_second"],
+            2,
+        )
+        return results
+
+    async def poll(self, users, pollers, polls):
+        partners = {}
+        for a, b in zip(users[::2], users[1::2]):
+            partners[a.pk], partners[b.pk] = b, a
+        clients = []
+        for index in range(pollers):
+            user = users[index % len(users)]
+            client = AsyncClient()
+            await client.aforce_login(user)
+            clients.append((client, f"/chat/get_messages/{partners[user.pk].slug}/"))
+
+        latencies = []
+
+        async def poller(client, url):
+            for _ in range(polls):
+                start = time.perf_counter()
+                response = await client.get(url, {"last_id": 0})
+                latencies.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f"get_messages returned {response.status_code}")
+
+        await clients[0][0].get(clients[0][1])  # warm up caches
+        latencies.clear()
+        start = time.perf_counter()
+        await asyncio.gather(*(poller(*client) for client in clients))
+        elapsed = time.perf_counter() - start
+        await database_sync_to_async(connections.close_all)()
+        return {
+            "requests": pollers * polls,
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(pollers * polls / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+        }
+
+    def run_crypto(self, texts):
+        """Microseconds per message, one at a time and batched"""
+        texts = texts[:5000]
+        results = {}
+        start = time.perf_counter()
+        encrypted = [encrypt_message(text) for text in texts]
+        results["encrypt_us"] = time.perf_counter() - start
+        # encryption warms the plaintext cache, measure real decryption
+        decrypt_cache.clear()
+        start = time.perf_counter()
+        for value in encrypted:
+            decrypt_message(value)
+        results["decrypt_us"] = time.perf_counter() - start
+        start = time.perf_counter()
+        encrypted = encrypt_many(texts)
+        results["encrypt_many_us"] = time.perf_counter() - start
+        decrypt_cache.clear()
+        start = time.perf_counter()
+        decrypt_many(encrypted)
+        results["decrypt_many_us"] = time.perf_counter() - start
+        start = time.perf_counter()
+        sealed = seal_many(texts)
+        results["seal_many_us"] = time.perf_counter() - start
+        decrypt_cache.clear()
+        start = time.perf_counter()
+        decrypt_many(sealed)
+        results["open_many_us"] = time.perf_counter() - start
+        return {
+            key: round(seconds * 1e6 / max(len(texts), 1), 2)
+            for key, seconds in results.items()
+        }
+
+    def compare(self, results, path, tolerance):
+        """Print the change of every metric against ``path``"""
+        with open(path) as source:
+            baseline = json.load(source)
+        regressions = []
+        for section, current, previous in self.walk(results, baseline):
+            for metric, higher_is_better in METRICS.items():
+                if metric not in current or not previous.get(metric):
+                    continue
+                change = (current[metric] - previous[metric]) / previous[metric] * 100
+                worse = -change if higher_is_better else change
+                self.stdout.write(
+                    f"{section:>24} {metric:<20} {previous[metric]:>10} -> "
+                    f"{current[metric]:<10} {change:+7.1f}%"
+                )
+                if tolerance is not None and worse > tolerance:
+                    regressions.append(f"{section} {metric} {change:+.1f}%")
+        if regressions:
+            raise CommandError("Regressed beyond tolerance: " + ", ".join(regressions))
+
+    def walk(self, results, baseline, prefix=""):
+        """(section, current, baseline) for every dict of metrics in both runs"""
+        for key, value in results.items():
+            if isinstance(value, dict) and isinstance(baseline.get(key), dict):
+                name = f"{prefix}{key}"
+                yield name, value, baseline[key]
+                yield from self.walk(value, baseline[key], f"{name}.")
@@ -0,0 +1,85 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Greatest, Least
+from chat.models import PrivateMessage, Conversation, MessageToken
+from utils import decrypt_many
+
+
+class Command(BaseCommand):
+    help = (
+        "Add existing messages to the blind search index, streaming them in "
+        "id order. Safe to interrupt and resume with --start-after. After "
+        "CHAT_SEARCH_KEY or SECRET_KEY changed, --rebuild replaces the entries "
+        "made under the old key."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--start-after", type=int, default=0, help="Last message id indexed"
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Replace the existing index entries, batch by batch",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = options["start_after"]
+        conversation = Conversation.objects.filter(
+            user_a=Least(OuterRef("sender_id"), OuterRef("receiver_id")),
+            user_b=Greatest(OuterRef("sender_id"), OuterRef("receiver_id")),
+        ).values("id")[:1]
+
+        indexed = skipped = 0
+        started = time.monotonic()
+        while True:
+            rows = list(
+                PrivateMessage.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .annotate(conversation_id=Subquery(conversation))
+                .values_list(
+                    "id", "conversation_id", "ciphertext", "encrypted_message"
+                )[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            messages, texts = [], []
+            for (message_id, conversation_id, *_), text in zip(
+                rows,
+                decrypt_many(
+                    legacy if ciphertext is None else ciphertext
+                    for _, _, ciphertext, legacy in rows
+                ),
+            ):
+                if conversation_id is None:
+                    # run backfill_conversations first
+                    skipped += 1
+                    continue
+                message = PrivateMessage(id=message_id)
+                message.conversation_id = conversation_id
+                messages.append(message)
+                texts.append(text)
+            with transaction.atomic():
+                if options["rebuild"]:
+                    MessageToken.objects.filter(
+                        message_id__gte=rows[0][0], message_id__lte=last_id
+                    ).delete()
+                MessageToken.objects.index(messages, texts)
+
+            indexed += len(messages)
+            rate = indexed / max(time.monotonic() - started, 1e-9)
+            self.stdout.write(
+                f"Indexed up to message {last_id}: {indexed} messages, {rate:.0f}/s"
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {indexed} messages, skipped {skipped} without a conversation"
+            )
+        )
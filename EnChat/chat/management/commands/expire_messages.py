@@ -0,0 +1,136 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Exists, Min, OuterRef
+from django.utils import timezone
+from chat import partitions
+from chat.models import Conversation, MessageToken, PrivateMessage, UnreadCounter
+
+
+class Command(BaseCommand):
+    help = (
+        "Drop the message partitions older than the retention period "
+        "(CHAT_RETENTION_MONTHS), optionally archiving them first, then clean "
+        "up the search tokens and conversations left behind. Whole partitions "
+        "go at once, no row is deleted from the message table. Run "
+        "reconcile_unread afterwards to recount partly expired conversations."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=settings.CHAT_RETENTION_MONTHS,
+            help="Months of messages to keep, besides the current one",
+        )
+        parser.add_argument(
+            "--archive-dir",
+            help="Write each partition to a gzipped COPY file here before dropping it",
+        )
+        parser.add_argument(
+            "--detach-only",
+            action="store_true",
+            help="Detach the partitions but keep their tables",
+        )
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options["months"] is None:
+            raise CommandError("No retention period, set CHAT_RETENTION_MONTHS or pass --months")
+        if not partitions.is_partitioned():
+            raise CommandError(
+                f"{partitions.TABLE} is not partitioned, run partition_messages --convert"
+            )
+        cutoff = partitions.add_months(
+            partitions.month_start(timezone.now()), -options["months"]
+        )
+        expired = [
+            (name, start, end)
+            for name, start, end in partitions.partitions()
+            if end is not None and end <= cutoff
+        ]
+        self.stdout.write(f"Expiring messages before {cutoff:%Y-%m-%d}")
+        if options["archive_dir"]:
+            os.makedirs(options["archive_dir"], exist_ok=True)
+
+        last_expired = None  # highest message id expired
+        for name, start, end in expired:
+            if options["dry_run"]:
+                self.stdout.write(f"Would expire {name}")
+                continue
+            partitions.detach(name)
+            last_id = partitions.last_id(name)
+            if last_id is not None:
+                last_expired = max(last_id, last_expired or 0)
+            if options["archive_dir"]:
+                path = os.path.join(options["archive_dir"], f"{name}.copy.gz")
+                rows = partitions.archive(name, start, end, path)
+                self.stdout.write(f"Archived {rows} messages of {name} to {path}")
+            if options["detach_only"]:
+                self.stdout.write(f"Detached {name}")
+            else:
+                partitions.drop(name)
+                self.stdout.write(f"Dropped {name}")
+        if options["dry_run"]:
+            return
+
+        tokens = self.purge_tokens(last_expired, options["batch_size"])
+        conversations = self.purge_conversations(cutoff, options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Expired {len(expired)} partitions, {tokens} search tokens and "
+                f"{conversations} conversations"
+            )
+        )
+
+    def purge_tokens(self, last_expired, batch_size):
+        """
+        Delete the search tokens of messages that are gone, by message id
+        range up to the last expired one. The range starts at the oldest
+        token, which also catches those a previous, interrupted run left.
+        """
+        if last_expired is None:
+            return 0
+        orphans = MessageToken.objects.exclude(
+            Exists(PrivateMessage.objects.filter(id=OuterRef("message_id")))
+        )
+        first = MessageToken.objects.aggregate(first=Min("message_id"))["first"]
+        deleted = 0
+        started = time.monotonic()
+        for low in range(first or 0, last_expired + 1, batch_size):
+            count, _ = orphans.filter(
+                message_id__gte=low, message_id__lt=low + batch_size
+            ).delete()
+            deleted += count
+        if deleted:
+            self.stdout.write(
+                f"Deleted {deleted} search tokens in {time.monotonic() - started:.1f}s"
+            )
+        return deleted
+
+    def purge_conversations(self, cutoff, batch_size):
+        """Delete the conversations whose every message expired"""
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    Conversation.objects.select_for_update()
+                    .filter(last_timestamp__lt=cutoff)
+                    .order_by("id")
+                    .values_list("id", "user_a_id", "user_b_id", "unread_a", "unread_b")[
+                        :batch_size
+                    ]
+                )
+                if not batch:
+                    return deleted
+                deltas = {}
+                for _, user_a, user_b, unread_a, unread_b in batch:
+                    for user_id, unread in ((user_a, unread_a), (user_b, unread_b)):
+                        messages, conversations = deltas.get(user_id, (0, 0))
+                        deltas[user_id] = (messages - unread, conversations - (unread > 0))
+                Conversation.objects.filter(id__in=[row[0] for row in batch]).delete()
+                UnreadCounter.objects.add(deltas)
+            deleted += len(batch)
@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from chat import export
+from users.models import User
+
+
+def export_to_file(user_id, other_id, path, file_format, compress):
+    """Write one export to ``path``, through a temporary file; returns its size"""
+    partial = f"{path}.partial"
+    with open(partial, "wb") as output:
+        for block in export.stream(user_id, other_id, file_format, compress):
+            output.write(block)
+    os.replace(partial, path)
+    return os.path.getsize(path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream the messages of users to NDJSON or CSV files, one file per "
+        "user (or per conversation with --with), several users in parallel"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "users", nargs="*", help="Usernames or slugs, see --all for everyone"
+        )
+        parser.add_argument("--all", action="store_true", help="Export every user")
+        parser.add_argument(
+            "--with", dest="other", help="Only the conversation with this user"
+        )
+        parser.add_argument("--format", choices=sorted(export.FORMATS), default="ndjson")
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("--output-dir", default=".")
+        parser.add_argument(
+            "--workers", type=int, default=1, help="Users exported in parallel"
+        )
+
+    def handle(self, *args, **options):
+        if not options["users"] and not options["all"]:
+            raise CommandError("Name some users or pass --all")
+        other = self.lookup(options["other"]) if options["other"] else None
+        os.makedirs(options["output_dir"], exist_ok=True)
+        self.options = options
+        self.exported = self.size = 0
+        self.started = time.monotonic()
+
+        users = (
+            self.all_users()
+            if options["all"]
+            else ((user.pk, user.slug) for user in map(self.lookup, options["users"]))
+        )
+        jobs = (self.job(user_id, slug, other) for user_id, slug in users)
+        if options["workers"] <= 1:
+            for job in jobs:
+                self.done(job[2], export_to_file(*job))
+        else:
+            self.run_parallel(jobs, options["workers"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Exported {self.exported} files, {self.size} bytes in "
+                f"{time.monotonic() - self.started:.1f}s"
+            )
+        )
+
+    def lookup(self, name):
+        user = User.objects.filter(Q(username=name) | Q(slug=name)).first()
+        if user is None:
+            raise CommandError(f"No such user: {name}")
+        return user
+
+    def all_users(self, batch_size=1000):
+        last_id = 0
+        while True:
+            batch = list(
+                User.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "slug")[:batch_size]
+            )
+            if not batch:
+                return
+            yield from batch
+            last_id = batch[-1][0]
+
+    def job(self, user_id, slug, other):
+        name = "-".join(["enchat", slug] + ([other.slug] if other else []))
+        name += f".{self.options['format']}" + (".gz" if self.options["gzip"] else "")
+        path = os.path.join(self.options["output_dir"], name)
+        return (
+            user_id,
+            other.pk if other else None,
+            path,
+            self.options["format"],
+            self.options["gzip"],
+        )
+
+    def run_parallel(self, jobs, workers):
+        # forked workers must not share the parent's database connections:
+        # fork them all now, while none is open
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            executor.submit(int).result()
+            running = {}
+            for job in jobs:
+                if len(running) >= workers * 2:
+                    self.collect(running, FIRST_COMPLETED)
+                running[executor.submit(export_to_file, *job)] = job[2]
+            self.collect(running)
+
+    def collect(self, running, return_when="ALL_COMPLETED"):
+        finished, _ = wait(running, return_when=return_when)
+        for future in finished:
+            self.done(running.pop(future), future.result())
+
+    def done(self, path, size):
+        self.exported += 1
+        self.size += size
+        self.stdout.write(f"{path}: {size} bytes")
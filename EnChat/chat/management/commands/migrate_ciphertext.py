@@ -0,0 +1,71 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.models import PrivateMessage
+from utils import decrypt_many, seal_many
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages from the legacy base64 encrypted_message column to the "
+        "binary ciphertext envelope, in keyset-ordered batches of short "
+        "transactions. Safe to interrupt and rerun: migrated rows are skipped. "
+        "VACUUM the table afterwards to reclaim the space."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--start-after", type=int, default=0, help="Resume after this message id"
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to pause between batches, to spare the I/O of a live server",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = options["start_after"]
+        migrated = before = after = 0
+        started = time.monotonic()
+        while True:
+            rows = list(
+                PrivateMessage.objects.filter(id__gt=last_id, ciphertext__isnull=True)
+                .order_by("id")
+                .values_list("id", "encrypted_message")[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            messages = [
+                PrivateMessage(id=message_id, ciphertext=sealed, encrypted_message="")
+                for (message_id, _), sealed in zip(
+                    rows, seal_many(decrypt_many(text for _, text in rows))
+                )
+            ]
+            # messages are never edited, so nothing can change a row between
+            # the read and this single short UPDATE
+            with transaction.atomic():
+                PrivateMessage.objects.bulk_update(
+                    messages, ["ciphertext", "encrypted_message"]
+                )
+
+            migrated += len(messages)
+            before += sum(len(text) for _, text in rows)
+            after += sum(len(message.ciphertext) for message in messages)
+            rate = migrated / max(time.monotonic() - started, 1e-9)
+            self.stdout.write(
+                f"Migrated up to message {last_id}: {migrated} messages, "
+                f"{before} -> {after} bytes, {rate:.0f}/s"
+            )
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Migrated {migrated} messages, ciphertext {before} -> {after} bytes"
+            )
+        )
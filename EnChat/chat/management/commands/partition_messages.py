@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
+from django.utils import timezone
+from chat import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the monthly partitions of the message table for the coming "
+        "months. Run it from cron, well ahead of the last partition. With "
+        "--convert, first turn the existing table into the partitioned one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=3,
+            help="Months after the current one to create partitions for",
+        )
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="Partition the existing table, which holds everything before next month",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning needs PostgreSQL")
+        this_month = partitions.month_start(timezone.now())
+
+        if not partitions.is_partitioned():
+            if not options["convert"]:
+                raise CommandError(
+                    f"{partitions.TABLE} is not partitioned yet, rerun with --convert"
+                )
+            cutover = partitions.add_months(this_month, 1)
+            self.stdout.write(f"Converting {partitions.TABLE}, cutover at {cutover:%Y-%m-%d}")
+            partitions.convert(cutover)
+            self.stdout.write(f"Messages before the cutover are in {partitions.LEGACY}")
+
+        covered = [end for _, _, end in partitions.partitions() if end is not None]
+        start = max(covered, default=this_month)
+        last = partitions.add_months(this_month, options["months_ahead"])
+        created = 0
+        while start <= last:
+            name = partitions.partition_name(start)
+            try:
+                moved = partitions.create(start)
+            except DatabaseError as e:
+                raise CommandError(f"Cannot create {name}: {e}")
+            if moved is not None:
+                created += 1
+                self.stdout.write(f"Created {name}")
+            if moved:
+                self.stdout.write(
+                    f"Moved {moved} messages of {name} out of {partitions.DEFAULT}"
+                )
+            start = partitions.add_months(start, 1)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Created {created} partitions, covered up to {start:%Y-%m-%d}")
+        )
@@ -0,0 +1,144 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+from chat.models import PrivateMessage, Conversation, UnreadCounter
+from users.models import User
+
+
+def unread_after(receiver, sender, last_read):
+    """Messages of a conversation side past its read watermark"""
+    count = Coalesce(
+        Subquery(
+            PrivateMessage.objects.filter(
+                receiver_id=OuterRef(receiver),
+                sender_id=OuterRef(sender),
+                id__gt=OuterRef(last_read),
+            )
+            .order_by()
+            .values("receiver_id")
+            .annotate(count=Count("id"))
+            .values("count")
+        ),
+        0,
+    )
+    if receiver == "user_b":
+        # a chat with oneself only counts on the user_a side
+        return Case(When(user_a=F("user_b"), then=0), default=count)
+    return count
+
+
+def recount():
+    return {
+        "unread_a": unread_after("user_a", "user_b", "last_read_a"),
+        "unread_b": unread_after("user_b", "user_a", "last_read_b"),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the unread counters of conversations from their read "
+        "watermarks and rebuild the per-user totals, fixing any drift"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        # conversations, in keyset-ordered batches of short transactions
+        conversations = 0
+        last_id = 0
+        while True:
+            ids = list(
+                Conversation.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            drifted = (
+                Conversation.objects.filter(id__in=ids)
+                .annotate(**{f"expected_{k}": v for k, v in recount().items()})
+                .filter(
+                    ~Q(unread_a=F("expected_unread_a"))
+                    | ~Q(unread_b=F("expected_unread_b"))
+                )
+                .values_list("id", flat=True)
+            )
+            conversations += Conversation.objects.filter(id__in=list(drifted)).update(
+                **recount()
+            )
+
+        # per-user totals, summed from the conversation rows
+        users = 0
+        last_id = 0
+        while True:
+            ids = list(
+                User.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            users += self.reconcile_users(ids)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Fixed {conversations} conversations and {users} user totals"
+            )
+        )
+
+    def reconcile_users(self, ids):
+        totals = {user_id: [0, 0] for user_id in ids}
+        with transaction.atomic():
+            # concurrent messages bump the locked counters once we commit
+            existing = {
+                counter.user_id: counter
+                for counter in UnreadCounter.objects.select_for_update().filter(
+                    user_id__in=ids
+                )
+            }
+            for side in ("a", "b"):
+                rows = (
+                    Conversation.objects.filter(
+                        **{f"user_{side}__in": ids, f"unread_{side}__gt": 0}
+                    )
+                    .values(f"user_{side}")
+                    .annotate(
+                        messages=Sum(f"unread_{side}"),
+                        conversations=Count("id"),
+                    )
+                    .order_by()
+                )
+                if side == "b":
+                    rows = rows.exclude(user_a=F("user_b"))
+                for row in rows:
+                    total = totals[row[f"user_{side}"]]
+                    total[0] += row["messages"]
+                    total[1] += row["conversations"]
+
+            changed = []
+            for user_id, (messages, conversations) in totals.items():
+                counter = existing.get(user_id)
+                if counter is None:
+                    if not messages:
+                        continue
+                    counter = UnreadCounter(user_id=user_id)
+                elif (counter.messages, counter.conversations) == (
+                    messages,
+                    conversations,
+                ):
+                    continue
+                counter.messages, counter.conversations = messages, conversations
+                changed.append(counter)
+            UnreadCounter.objects.bulk_create(
+                changed,
+                update_conflicts=True,
+                unique_fields=["user"],
+                update_fields=["messages", "conversations"],
+            )
+        return len(changed)
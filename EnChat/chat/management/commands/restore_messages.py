@@ -0,0 +1,29 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+from chat import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Load message partitions archived by expire_messages --archive-dir "
+        "and attach them to the message table again. Conversations and "
+        "search tokens deleted along with them are not restored: run "
+        "backfill_conversations and build_search_index afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("archives", nargs="+", help="*.copy.gz files")
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError(f"{partitions.TABLE} is not partitioned")
+        for path in options["archives"]:
+            if not os.path.exists(f"{path}.json"):
+                raise CommandError(f"{path}.json is missing")
+            try:
+                meta = partitions.restore(path)
+            except DatabaseError as e:
+                raise CommandError(f"Cannot restore {path}: {e}")
+            self.stdout.write(f"Restored {meta['rows']} messages into {meta['table']}")
+        self.stdout.write(self.style.SUCCESS(f"Restored {len(options['archives'])} partitions"))
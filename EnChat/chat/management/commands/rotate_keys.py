@@ -0,0 +1,253 @@
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Max, Min
+from chat.models import Conversation, PrivateMessage
+from utils import decrypt_many, encrypt_many, key_id_of, keyring, seal_many
+
+RETRIES = 3  # Attempts of a batch that hit the lock timeout
+
+
+def _update_messages(rows, sealed, lock_timeout):
+    """Store the envelopes of (id, timestamp, ...) rows in one short transaction"""
+    values = ", ".join(["(%s, %s::bytea)"] * len(rows))
+    params = [
+        value
+        for (message_id, *_), envelope in zip(rows, sealed)
+        for value in (message_id, envelope)
+    ]
+    # the timestamp range lets a partitioned table skip the other months
+    timestamps = [row[1] for row in rows]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SET LOCAL lock_timeout = %s", [lock_timeout])
+        cursor.execute(
+            f"UPDATE {PrivateMessage._meta.db_table} AS m "
+            "SET ciphertext = v.ciphertext, encrypted_message = '' "
+            f"FROM (VALUES {values}) AS v (id, ciphertext) "
+            "WHERE m.id = v.id AND m.timestamp BETWEEN %s AND %s",
+            [*params, min(timestamps), max(timestamps)],
+        )
+
+
+def _update_previews(rows, previews):
+    """
+    Store the new previews of (id, preview) rows, except where a new
+    message replaced the preview in the meantime. Returns the rows updated.
+    """
+    values = ", ".join(["(%s, %s, %s)"] * len(rows))
+    params = [
+        value
+        for (conversation_id, preview), rotated in zip(rows, previews)
+        for value in (conversation_id, preview, rotated)
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {Conversation._meta.db_table} AS c SET preview = v.rotated "
+            f"FROM (VALUES {values}) AS v (id, preview, rotated) "
+            "WHERE c.id = v.id AND c.preview = v.preview",
+            params,
+        )
+        return cursor.rowcount
+
+
+def rotate_chunk(low, high, batch_size, seconds_per_row, lock_timeout):
+    """
+    Re-encrypt under the active key the messages with low < id <= high that
+    are not already, in batches. Runs in a worker process and paces itself
+    to ``seconds_per_row``. Returns the (scanned, rotated) message counts.
+    """
+    active = keyring.active
+    scanned = rotated = 0
+    started = time.monotonic()
+    while low < high:
+        rows = list(
+            PrivateMessage.objects.filter(id__gt=low, id__lte=high)
+            .order_by("id")
+            .values_list("id", "timestamp", "ciphertext", "encrypted_message")[:batch_size]
+        )
+        if not rows:
+            break
+        low = rows[-1][0]
+        scanned += len(rows)
+
+        stale = [
+            row for row in rows if row[2] is None or key_id_of(row[2]) != active
+        ]
+        if stale:
+            sealed = seal_many(
+                decrypt_many(
+                    legacy if ciphertext is None else ciphertext
+                    for *_, ciphertext, legacy in stale
+                )
+            )
+            for attempt in range(RETRIES):
+                try:
+                    _update_messages(stale, sealed, lock_timeout)
+                    break
+                except OperationalError:
+                    if attempt == RETRIES - 1:
+                        raise
+                    time.sleep(2**attempt)
+            rotated += len(stale)
+        if seconds_per_row:
+            time.sleep(max(0, started + scanned * seconds_per_row - time.monotonic()))
+    return scanned, rotated
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt every message and conversation preview under the active "
+        "key (CHAT_ENCRYPTION_KEY_ID). Deploy the new keyring to every server "
+        "first so that new messages use the new key. Messages go in chunks of "
+        "ids to a pool of worker processes, which work through them in "
+        "keyset-ordered batches of one short UPDATE each. Progress is "
+        "checkpointed to a file: rerun to resume, already rotated rows are "
+        "skipped. Retire the old key only after a complete run, and not while "
+        "archives of expire_messages still need it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument(
+            "--chunk-size", type=int, default=100000, help="Message ids per worker task"
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Messages per second to scan across all workers, 0 for no limit",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default="rotate_keys.checkpoint.json",
+            help="File recording the progress of the rotation",
+        )
+        parser.add_argument(
+            "--restart", action="store_true", help="Ignore the checkpoint, start over"
+        )
+        parser.add_argument(
+            "--lock-timeout",
+            default="2s",
+            help="Give up on a batch waiting longer than this for a row lock, and retry",
+        )
+
+    def handle(self, *args, **options):
+        active = keyring.active
+        state = self.load_checkpoint(options["checkpoint"], active, options["restart"])
+        self.stdout.write(f"Rotating to key {active} after message {state['last_id']}")
+        self.rotate_messages(state, options)
+        rotated = self.rotate_previews(options["batch_size"], active)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rotated {state['rotated']} of {state['scanned']} messages and "
+                f"{rotated} conversation previews to key {active}"
+            )
+        )
+
+    def load_checkpoint(self, path, active, restart):
+        fresh = {"key_id": active, "last_id": 0, "scanned": 0, "rotated": 0}
+        if restart or not os.path.exists(path):
+            return fresh
+        with open(path) as checkpoint:
+            state = json.load(checkpoint)
+        if state.get("key_id") != active:
+            self.stdout.write(
+                f"Checkpoint is for key {state.get('key_id')}, starting over"
+            )
+            return fresh
+        return state
+
+    def save_checkpoint(self, path, state):
+        with open(f"{path}.tmp", "w") as checkpoint:
+            json.dump(state, checkpoint)
+        os.replace(f"{path}.tmp", path)
+
+    def rotate_messages(self, state, options):
+        bounds = PrivateMessage.objects.filter(id__gt=state["last_id"]).aggregate(
+            first=Min("id"), last=Max("id")
+        )
+        if bounds["first"] is None:
+            return
+        # messages past the last id were sent with the active key already
+        start, end = bounds["first"] - 1, bounds["last"]
+        chunk_size = options["chunk_size"]
+        chunks = range(start, end, chunk_size)
+        workers = max(options["workers"], 1)
+        seconds_per_row = workers / options["rate"] if options["rate"] else 0
+
+        # forked workers must not share the connection of this process
+        connections.close_all()
+        done = set()
+        pending = {}
+        next_chunk = iter(enumerate(chunks))
+        contiguous = 0  # chunks done from the start, without gaps
+        started = time.monotonic()
+        error = None
+        with ProcessPoolExecutor(workers, initializer=django.setup) as pool:
+            while True:
+                # a couple of tasks per worker keep them busy between chunks
+                while error is None and len(pending) < 2 * workers:
+                    index, low = next(next_chunk, (None, None))
+                    if index is None:
+                        break
+                    future = pool.submit(
+                        rotate_chunk,
+                        low,
+                        min(low + chunk_size, end),
+                        options["batch_size"],
+                        seconds_per_row,
+                        options["lock_timeout"],
+                    )
+                    pending[future] = index
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = pending.pop(future)
+                    try:
+                        scanned, rotated = future.result()
+                    except Exception as exc:
+                        error = error or exc
+                        continue
+                    done.add(index)
+                    state["scanned"] += scanned
+                    state["rotated"] += rotated
+                while contiguous in done:
+                    done.discard(contiguous)
+                    contiguous += 1
+                # resume from the end of the last chunk with none left behind it
+                state["last_id"] = min(start + contiguous * chunk_size, end)
+                self.save_checkpoint(options["checkpoint"], state)
+                rate = state["scanned"] / max(time.monotonic() - started, 1e-9)
+                self.stdout.write(
+                    f"Rotated up to message {state['last_id']}: {state['rotated']} "
+                    f"of {state['scanned']} messages, {rate:.0f}/s"
+                )
+        if error is not None:
+            raise CommandError(
+                f"Rotation stopped after message {state['last_id']}, "
+                f"rerun to resume: {error}"
+            )
+
+    def rotate_previews(self, batch_size, active):
+        """Re-encrypt the previews of conversations, unless a new message replaced them"""
+        last_id = rotated = 0
+        while True:
+            rows = list(
+                Conversation.objects.filter(id__gt=last_id)
+                .exclude(preview="")
+                .order_by("id")
+                .values_list("id", "preview")[:batch_size]
+            )
+            if not rows:
+                return rotated
+            last_id = rows[-1][0]
+            stale = [row for row in rows if key_id_of(row[1]) != active]
+            if stale:
+                previews = encrypt_many(decrypt_many(preview for _, preview in stale))
+                rotated += _update_previews(stale, previews)
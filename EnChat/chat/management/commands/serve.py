@@ -0,0 +1,379 @@
+import asyncio
+import gc
+import importlib.util
+import os
+import random
+import select
+import signal
+import socket
+import time
+import traceback
+from contextlib import contextmanager
+from channels.routing import get_default_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+from django.urls import get_resolver, reverse
+from utils import decrypt_many, metrics, seal_many, staticfiles
+
+startup_seconds = metrics.Gauge(
+    "enchat_startup_seconds", "Seconds spent in each startup phase", ["phase"]
+)
+
+
+@contextmanager
+def timed(phases, name):
+    start = time.perf_counter()
+    yield
+    phases[name] = time.perf_counter() - start
+    startup_seconds.set(phases[name], name)
+
+
+def warm_urls():
+    """Import every view and build the reverse lookup tables"""
+    resolver = get_resolver()
+    resolver.url_patterns
+    resolver.reverse_dict
+
+
+def warm_templates():
+    """Compile every template into the cached loaders, return how many"""
+    compiled = 0
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if not name.endswith(".html"):
+                        continue
+                    try:
+                        engine.get_template(
+                            os.path.relpath(os.path.join(root, name), directory)
+                        )
+                    except (TemplateDoesNotExist, TemplateSyntaxError):
+                        continue
+                    compiled += 1
+    return compiled
+
+
+def warm_database():
+    """
+    Connect once: the driver, its type adapters and the type lookups of
+    django.contrib.postgres are set up for good and inherited by workers.
+    The connection itself is closed, workers must not share it.
+    """
+    try:
+        for connection in connections.all():
+            connection.ensure_connection()
+    except DatabaseError as exc:
+        return str(exc).strip()
+    finally:
+        connections.close_all()
+
+
+def warm_server():
+    """
+    Import the bulk of daphne, Twisted and autobahn, but not daphne.server:
+    that one installs the reactor, which every worker needs its own of
+    """
+    importlib.import_module("daphne.http_protocol")
+    importlib.import_module("daphne.ws_protocol")
+
+
+async def warm_request(application, path):
+    """
+    GET ``path`` through the whole stack: middleware, view, form rendering
+    and the thread pools of sync code are set up before a client waits
+    for them. Returns the response status.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    body = [{"type": "http.request", "body": b""}]
+    response = {}
+
+    async def receive():
+        if body:
+            return body.pop()
+        # the client stays connected until the response is sent
+        return await asyncio.get_running_loop().create_future()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+
+    await application(scope, receive, send)
+    return response.get("status")
+
+
+def bind(host, port, backlog):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # lets the next deploy bind the port while this one drains
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class MaxRequests:
+    """ASGI middleware calling ``retire`` once ``limit`` connections came in"""
+
+    def __init__(self, application, limit, retire):
+        self.application = application
+        self.limit = limit
+        self.retire = retire
+        self.count = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            self.count += 1
+            if self.count == self.limit:
+                self.retire()
+        return await self.application(scope, receive, send)
+
+
+def run_worker(application, sock, notify, options, forked):
+    """
+    Serve ``application`` on the inherited socket until told to stop, then
+    stop accepting and give open connections ``graceful_timeout`` seconds to
+    finish. Workers tell the supervisor through ``notify`` when they are
+    ready, and when they reached their request limit so that their
+    replacement starts right away.
+    """
+    # Importing daphne.server installs the Twisted reactor and its event
+    # loop, they must belong to this process only
+    from daphne.server import Server
+    from twisted.internet import reactor
+
+    if options["warm_up_path"]:
+        asyncio.run(warm_request(application, options["warm_up_path"]))
+
+    class WorkerServer(Server):
+        def listen_success(self, port):
+            self.ports.append(port)
+            super().listen_success(port)
+
+    def drain():
+        if server.draining:
+            return
+        server.draining = True
+        for port in server.ports:
+            port.stopListening()
+        deadline = time.monotonic() + options["graceful_timeout"]
+
+        def check():
+            busy = any(
+                "disconnected" not in details for details in server.connections.values()
+            )
+            if not busy or time.monotonic() > deadline:
+                server.stop()
+            else:
+                reactor.callLater(0.1, check)
+
+        check()
+
+    def retire():
+        os.write(notify, f"retire {os.getpid()}\n".encode())
+        reactor.callFromThread(drain)
+
+    def ready():
+        seconds = time.perf_counter() - forked
+        startup_seconds.set(seconds, "worker")
+        os.write(notify, f"ready {os.getpid()} {seconds}\n".encode())
+
+    limit = options["max_requests"]
+    if limit:
+        limit += random.randint(0, options["max_requests_jitter"])
+        application = MaxRequests(application, limit, retire)
+    proxy = options["proxy_headers"]
+    server = WorkerServer(
+        application=application,
+        endpoints=[f"fd:fileno={sock.fileno()}"],
+        signal_handlers=False,
+        proxy_forwarded_address_header="X-Forwarded-For" if proxy else None,
+        proxy_forwarded_port_header="X-Forwarded-Port" if proxy else None,
+        proxy_forwarded_proto_header="X-Forwarded-Proto" if proxy else None,
+        verbosity=options["verbosity"],
+    )
+    server.ports = []
+    server.draining = False
+    signal.signal(signal.SIGTERM, lambda *_: reactor.callFromThread(drain))
+    reactor.callWhenRunning(ready)
+    server.run()
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve the ASGI application with pre-forked daphne workers. The "
+        "application is imported and warmed up once (URLconfs, templates, "
+        "database driver, crypto, static files, server modules) before forking, so new and "
+        "restarted workers start warm and share that memory. Each worker then "
+        "serves itself one request before accepting. Workers accept from one "
+        "listening socket, bound with SO_REUSEPORT so that the next deploy "
+        "can bind it too before this one stops. SIGTERM or SIGINT drains "
+        "and stops. Startup time is reported per phase, and exported as "
+        "enchat_startup_seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="IPv4 address")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--backlog", type=int, default=2048)
+        parser.add_argument(
+            "--max-requests",
+            type=int,
+            default=0,
+            help="Restart a worker after this many requests, 0 never does",
+        )
+        parser.add_argument(
+            "--max-requests-jitter",
+            type=int,
+            default=0,
+            help="Up to this many more requests per worker, so they restart apart",
+        )
+        parser.add_argument(
+            "--graceful-timeout",
+            type=float,
+            default=30,
+            help="Seconds a stopping worker waits for open connections",
+        )
+        parser.add_argument(
+            "--warm-up-path",
+            help="Page each worker requests itself before accepting, the login "
+            "page by default, an empty string skips it",
+        )
+        parser.add_argument(
+            "--proxy-headers",
+            action="store_true",
+            help="Trust X-Forwarded-For, -Port and -Proto from a reverse proxy",
+        )
+
+    def handle(self, *args, **options):
+        if not hasattr(os, "fork"):
+            raise CommandError("serve needs os.fork, run daphne on this platform")
+        if importlib.util.find_spec("daphne") is None:
+            raise CommandError("serve runs its workers on daphne: pip install daphne")
+        # daphne adopts inherited sockets as IPv4 only
+        if ":" in options["host"]:
+            raise CommandError("serve binds IPv4 addresses, use a proxy for IPv6")
+
+        # interpreter start, imports and django.setup(), in CPU seconds
+        phases = {"boot": time.process_time()}
+        startup_seconds.set(phases["boot"], "boot")
+        with timed(phases, "application"):
+            application = get_default_application()
+        with timed(phases, "urls"):
+            warm_urls()
+        with timed(phases, "templates"):
+            templates = warm_templates()
+        with timed(phases, "database"):
+            error = warm_database()
+        if error:
+            self.stderr.write(
+                f"Database warm-up failed, workers connect on demand: {error}"
+            )
+        with timed(phases, "crypto"):
+            decrypt_many(seal_many(["warm up"]))
+        with timed(phases, "static"):
+            static = staticfiles.preload()
+        with timed(phases, "server"):
+            warm_server()
+        if options["warm_up_path"] is None:
+            options["warm_up_path"] = reverse("login")
+        with timed(phases, "bind"):
+            sock = bind(options["host"], options["port"], options["backlog"])
+        # workers share the warmed heap until they write to it, keep the
+        # collector from touching (and so copying) it
+        gc.collect()
+        gc.freeze()
+
+        timings = ", ".join(
+            f"{name} {seconds * 1000:.1f} ms" for name, seconds in phases.items()
+        )
+        self.stdout.write(f"Warmed up: {timings} ({templates} templates, {static} static files)")
+        self.stdout.write(
+            f"Listening on {options['host']}:{options['port']} "
+            f"with {options['workers']} workers"
+        )
+        self.stdout.flush()
+        self.supervise(application, sock, options)
+
+    def supervise(self, application, sock, options):
+        """Keep ``workers`` processes running until SIGTERM or SIGINT"""
+        notices, notify = os.pipe()
+        workers = {}  # pid: whether it is retiring
+        stopping = False
+
+        def spawn():
+            forked = time.perf_counter()
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                # Ctrl-C reaches the whole process group, the supervisor relays it
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                os.close(notices)
+                code = 0
+                try:
+                    run_worker(application, sock, notify, options, forked)
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    os._exit(code)
+            workers[pid] = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for _ in range(options["workers"]):
+            spawn()
+
+        buffer = b""
+        while workers:
+            readable, _, _ = select.select([notices], [], [], 1.0)
+            if readable:
+                buffer += os.read(notices, 4096)
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    notice, pid, *seconds = line.decode().split()
+                    pid = int(pid)
+                    if notice == "ready" and options["verbosity"] > 1:
+                        self.stdout.write(
+                            f"Worker {pid} accepting "
+                            f"{float(seconds[0]) * 1000:.1f} ms after fork"
+                        )
+                    elif notice == "retire" and pid in workers and not stopping:
+                        if not workers[pid]:
+                            workers[pid] = True
+                            spawn()
+            while workers:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                if workers.pop(pid, True) or stopping:
+                    continue
+                # replace a worker that died, without spinning on a crash loop
+                code = os.waitstatus_to_exitcode(status)
+                self.stderr.write(f"Worker {pid} exited with status {code}")
+                time.sleep(1)
+                spawn()
+        self.stdout.write("Stopped")
@@ -0,0 +1,30 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # built without blocking new messages, which needs to run outside of a
+    # transaction
+    atomic = False
+
+    dependencies = [
+        ("chat", "0002_initial"),
+    ]
+
+    operations = [
+        # Keyset pagination of a conversation in both directions
+        AddIndexConcurrently(
+            model_name="privatemessage",
+            index=models.Index(
+                fields=["sender", "receiver", "timestamp", "id"],
+                name="chat_privat_sender__7e622a_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="privatemessage",
+            index=models.Index(
+                fields=["receiver", "sender", "timestamp", "id"],
+                name="chat_privat_receive_a5b766_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0003_message_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Conversation",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("last_timestamp", models.DateTimeField(null=True)),
+                ("preview", models.TextField(blank=True)),
+                ("unread_a", models.PositiveIntegerField(default=0)),
+                ("unread_b", models.PositiveIntegerField(default=0)),
+                ("last_read_a", models.PositiveBigIntegerField(default=0)),
+                ("last_read_b", models.PositiveBigIntegerField(default=0)),
+                ("read_at_a", models.DateTimeField(null=True)),
+                ("read_at_b", models.DateTimeField(null=True)),
+                ("last_message", models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="chat.privatemessage")),
+                ("user_a", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="+", to=settings.AUTH_USER_MODEL)),
+                ("user_b", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="+", to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["user_a", "-last_timestamp"], name="chat_conver_user_a__c3db59_idx"),
+                    models.Index(fields=["user_b", "-last_timestamp"], name="chat_conver_user_b__8bd309_idx"),
+                ],
+                "constraints": [
+                    models.UniqueConstraint(fields=("user_a", "user_b"), name="unique_conversation_pair"),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="UnreadCounter",
+            fields=[
+                ("user", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name="unread_counter", serialize=False, to=settings.AUTH_USER_MODEL)),
+                ("messages", models.PositiveIntegerField(default=0)),
+                ("conversations", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
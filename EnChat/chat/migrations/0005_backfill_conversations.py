@@ -0,0 +1,162 @@
+from django.db import migrations
+from django.db.models import Case, Count, F, Max, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import Coalesce, Greatest, Least
+from utils import decrypt_many, encrypt_many
+
+BATCH_SIZE = 1000
+PREVIEW_LENGTH = 50
+
+
+def backfill(apps, schema_editor):
+    """
+    One Conversation per user pair of the existing messages, its read
+    watermarks carried over from PrivateMessage.is_read and what lies past
+    them counted as unread, then the unread totals of every user
+    """
+    PrivateMessage = apps.get_model("chat", "PrivateMessage")
+    Conversation = apps.get_model("chat", "Conversation")
+    UnreadCounter = apps.get_model("chat", "UnreadCounter")
+
+    pairs = (
+        PrivateMessage.objects.annotate(
+            a=Least("sender_id", "receiver_id"),
+            b=Greatest("sender_id", "receiver_id"),
+        )
+        .values("a", "b")
+        .annotate(
+            last_id=Max("id"),
+            last_read_a=Coalesce(Max("id", filter=Q(is_read=True, receiver_id=F("a"))), 0),
+            last_read_b=Coalesce(Max("id", filter=Q(is_read=True, receiver_id=F("b"))), 0),
+            read_at_a=Max("read_at", filter=Q(receiver_id=F("a"))),
+            read_at_b=Max("read_at", filter=Q(receiver_id=F("b"))),
+        )
+        .order_by()
+    )
+    batch = []
+    for pair in pairs.iterator(chunk_size=BATCH_SIZE):
+        batch.append(pair)
+        if len(batch) >= BATCH_SIZE:
+            write_conversations(PrivateMessage, Conversation, batch)
+            batch = []
+    write_conversations(PrivateMessage, Conversation, batch)
+
+    last_id = 0
+    while True:
+        ids = list(
+            Conversation.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:BATCH_SIZE]
+        )
+        if not ids:
+            break
+        last_id = ids[-1]
+        Conversation.objects.filter(id__in=ids).update(
+            unread_a=unread_after(PrivateMessage, "user_a", "user_b", "last_read_a"),
+            unread_b=Case(
+                When(user_a=F("user_b"), then=0),
+                default=unread_after(PrivateMessage, "user_b", "user_a", "last_read_b"),
+            ),
+        )
+
+    totals = {}
+    for side in ("a", "b"):
+        rows = Conversation.objects.filter(**{f"unread_{side}__gt": 0})
+        if side == "b":
+            # a chat with oneself only counts on the user_a side
+            rows = rows.exclude(user_a=F("user_b"))
+        rows = (
+            rows.values(f"user_{side}")
+            .annotate(messages=Sum(f"unread_{side}"), conversations=Count("id"))
+            .order_by()
+        )
+        for row in rows.iterator(chunk_size=BATCH_SIZE):
+            total = totals.setdefault(row[f"user_{side}"], [0, 0])
+            total[0] += row["messages"]
+            total[1] += row["conversations"]
+    UnreadCounter.objects.bulk_create(
+        [
+            UnreadCounter(user_id=user_id, messages=messages, conversations=conversations)
+            for user_id, (messages, conversations) in totals.items()
+        ],
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=["messages", "conversations"],
+    )
+
+
+def unread_after(PrivateMessage, receiver, sender, last_read):
+    """Messages of a conversation side past its read watermark"""
+    return Coalesce(
+        Subquery(
+            PrivateMessage.objects.filter(
+                receiver_id=OuterRef(receiver),
+                sender_id=OuterRef(sender),
+                id__gt=OuterRef(last_read),
+            )
+            .order_by()
+            .values("receiver_id")
+            .annotate(count=Count("id"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def write_conversations(PrivateMessage, Conversation, batch):
+    if not batch:
+        return
+    lasts = PrivateMessage.objects.in_bulk([pair["last_id"] for pair in batch])
+    previews = encrypt_many(
+        text[:PREVIEW_LENGTH]
+        for text in decrypt_many(lasts[pair["last_id"]].encrypted_message for pair in batch)
+    )
+    conversations = []
+    for pair, preview in zip(batch, previews):
+        last = lasts[pair["last_id"]]
+        if pair["a"] == pair["b"]:
+            # messages to oneself are received on the user_a side
+            pair["last_read_b"], pair["read_at_b"] = 0, None
+        conversations.append(
+            Conversation(
+                user_a_id=pair["a"],
+                user_b_id=pair["b"],
+                last_message_id=last.id,
+                last_timestamp=last.timestamp,
+                preview=preview,
+                last_read_a=pair["last_read_a"],
+                last_read_b=pair["last_read_b"],
+                read_at_a=pair["read_at_a"],
+                read_at_b=pair["read_at_b"],
+            )
+        )
+    Conversation.objects.bulk_create(
+        conversations,
+        update_conflicts=True,
+        unique_fields=["user_a", "user_b"],
+        update_fields=[
+            "last_message",
+            "last_timestamp",
+            "preview",
+            "last_read_a",
+            "last_read_b",
+            "read_at_a",
+            "read_at_b",
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+    # one short statement per batch rather than a transaction over the
+    # whole message table, rerunning is safe
+    atomic = False
+
+    dependencies = [
+        ("chat", "0004_conversation"),
+    ]
+
+    operations = [
+        # the Conversation and UnreadCounter tables are dropped on the way
+        # back, leaving nothing to undo
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0005_backfill_conversations"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Presence",
+            fields=[
+                ("user", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name="presence", serialize=False, to=settings.AUTH_USER_MODEL)),
+                ("connections", models.PositiveIntegerField(default=0)),
+                ("last_seen", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0006_presence"),
+    ]
+
+    # existing messages are added to the index by build_search_index, which
+    # can run while the server is up
+    operations = [
+        migrations.CreateModel(
+            name="MessageToken",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("token", models.BigIntegerField()),
+                ("conversation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="+", to="chat.conversation")),
+                ("message", models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name="+", to="chat.privatemessage")),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["conversation", "token", "-message"], name="chat_messag_convers_55c36b_idx"),
+                ],
+                "constraints": [
+                    models.UniqueConstraint(fields=("message", "token"), name="unique_message_token"),
+                ],
+            },
+        ),
+    ]
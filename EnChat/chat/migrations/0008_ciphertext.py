@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0007_messagetoken"),
+    ]
+
+    operations = [
+        # a new nullable column and a default are metadata-only changes,
+        # the table is not rewritten
+        migrations.AddField(
+            model_name="privatemessage",
+            name="ciphertext",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="privatemessage",
+            name="encrypted_message",
+            field=models.TextField(blank=True, default=""),
+        ),
+    ]
@@ -0,0 +1,68 @@
+import base64
+from django.db import migrations
+from utils import decrypt_many, seal_many
+
+BATCH_SIZE = 1000
+
+
+def seal(apps, schema_editor):
+    """Move base64 encrypted_message texts to binary ciphertext envelopes"""
+    PrivateMessage = apps.get_model("chat", "PrivateMessage")
+    last_id = 0
+    while True:
+        rows = list(
+            PrivateMessage.objects.filter(id__gt=last_id, ciphertext__isnull=True)
+            .order_by("id")
+            .values_list("id", "encrypted_message")[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        sealed = seal_many(decrypt_many(text for _, text in rows))
+        PrivateMessage.objects.bulk_update(
+            [
+                PrivateMessage(id=message_id, ciphertext=envelope, encrypted_message="")
+                for (message_id, _), envelope in zip(rows, sealed)
+            ],
+            ["ciphertext", "encrypted_message"],
+        )
+
+
+def unseal(apps, schema_editor):
+    """Back to base64 text, which decrypt_many reads in envelope form too"""
+    PrivateMessage = apps.get_model("chat", "PrivateMessage")
+    last_id = 0
+    while True:
+        rows = list(
+            PrivateMessage.objects.filter(id__gt=last_id, ciphertext__isnull=False)
+            .order_by("id")
+            .values_list("id", "ciphertext")[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        PrivateMessage.objects.bulk_update(
+            [
+                PrivateMessage(
+                    id=message_id,
+                    ciphertext=None,
+                    encrypted_message=base64.b64encode(envelope).decode(),
+                )
+                for message_id, envelope in rows
+            ],
+            ["ciphertext", "encrypted_message"],
+        )
+
+
+class Migration(migrations.Migration):
+    # one short UPDATE per batch, an interrupted run resumes where it
+    # stopped; migrate_ciphertext does the same with throttling
+    atomic = False
+
+    dependencies = [
+        ("chat", "0008_ciphertext"),
+    ]
+
+    operations = [
+        migrations.RunPython(seal, unseal),
+    ]
@@ -1,8 +1,21 @@
-from django.db import models
+from datetime import timedelta
+from django.db import models, transaction
+from django.utils import timezone
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
 from django.contrib.auth import get_user_model
-from utils import encrypt_message, decrypt_message
+from .pagination import TIMESTAMP_SLACK, find
+from utils import (
+    blind_tokens,
+    decrypt_message,
+    encrypt_message,
+    encrypt_many,
+    seal_message,
+)
 User = get_user_model()
 
+PREVIEW_LENGTH = 50
+
 
 class PrivateMessage(models.Model):
     sender = models.ForeignKey(
@@ -11,14 +24,382 @@ class PrivateMessage(models.Model):
     receiver = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name="received_messages"
     )
-    encrypted_message = models.TextField()
+    # Binary envelope of the message (see utils.seal_many). Rows written
+    # before it keep base64 text in encrypted_message until migration
+    # 0009_move_ciphertext (or migrate_ciphertext) moves them over.
+    ciphertext = models.BinaryField(null=True, blank=True)
+    encrypted_message = models.TextField(blank=True, default="")
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)  # Track if message is read
-    read_at = models.DateTimeField(null=True, blank=True)  # Timestamp of read event
+    # Superseded by the read watermarks of Conversation, carried over by
+    # migration 0005_backfill_conversations
+    is_read = models.BooleanField(default=False)
+    read_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a conversation in both directions
+            models.Index(fields=["sender", "receiver", "timestamp", "id"]),
+            models.Index(fields=["receiver", "sender", "timestamp", "id"]),
+        ]
 
     def save(self, *args, **kwargs):
-        self.encrypted_message = encrypt_message(self.encrypted_message)
+        # new messages come in with their plaintext in encrypted_message
+        if self._state.adding and self.ciphertext is None:
+            self.ciphertext = seal_message(self.encrypted_message)
+            self.encrypted_message = ""
         super().save(*args, **kwargs)
 
+    @property
+    def encrypted(self):
+        """The stored ciphertext, in whichever format the row is in"""
+        if self.ciphertext is not None:
+            return self.ciphertext
+        return self.encrypted_message
+
     def get_message(self):
-        return decrypt_message(self.encrypted_message)
+        return decrypt_message(self.encrypted)
+
+
+class ConversationManager(models.Manager):
+    @staticmethod
+    def pair(user_id, other_id):
+        """Return the (user_a, user_b) ids of a conversation in stored order"""
+        return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+    def for_user(self, user):
+        """Inbox of a user, most recently active conversation first"""
+        return (
+            self.filter(Q(user_a=user) | Q(user_b=user))
+            .select_related("user_a", "user_b")
+            .order_by("-last_timestamp")
+        )
+
+    def record_message(self, message, text):
+        """
+        Update the conversation row of a freshly saved message.
+        Must run inside the transaction that created the message.
+        """
+        self.record_messages([message], [text])
+
+    def record_messages(self, messages, texts):
+        """
+        Update the conversation rows of a batch of freshly saved messages,
+        once per conversation. Must run inside the transaction that created
+        the messages, which are expected in chronological order. Each message
+        gets its ``conversation_id`` set for routing, the unread counters of
+        the receivers are bumped along and the messages are added to the
+        search index.
+        """
+        latest = {}
+        for message, text in zip(messages, texts):
+            user_a, user_b = self.pair(message.sender_id, message.receiver_id)
+            entry = latest.setdefault((user_a, user_b), {"unread_a": 0, "unread_b": 0})
+            entry["message"], entry["text"] = message, text
+            entry["unread_a" if message.receiver_id == user_a else "unread_b"] += 1
+
+        # lock rows in a fixed order so concurrent batches cannot deadlock
+        pairs = sorted(latest)
+        previews = encrypt_many(latest[pair]["text"][:PREVIEW_LENGTH] for pair in pairs)
+        counters = {}
+        for (user_a, user_b), preview in zip(pairs, previews):
+            entry = latest[(user_a, user_b)]
+            conversation, _ = self.select_for_update().get_or_create(
+                user_a_id=user_a, user_b_id=user_b
+            )
+            for side, user_id in (("a", user_a), ("b", user_b)):
+                added = entry[f"unread_{side}"]
+                if added:
+                    counter = counters.setdefault(user_id, [0, 0])
+                    counter[0] += added
+                    # the conversation starts counting as unread
+                    counter[1] += getattr(conversation, f"unread_{side}") == 0
+            conversation.last_message = entry["message"]
+            conversation.last_timestamp = entry["message"].timestamp
+            conversation.preview = preview
+            conversation.unread_a = F("unread_a") + entry["unread_a"]
+            conversation.unread_b = F("unread_b") + entry["unread_b"]
+            conversation.save()
+            latest[(user_a, user_b)]["id"] = conversation.id
+        UnreadCounter.objects.add(counters)
+        for message in messages:
+            pair = self.pair(message.sender_id, message.receiver_id)
+            message.conversation_id = latest[pair]["id"]
+        MessageToken.objects.index(messages, texts)
+
+    def between(self, user_id, other_id):
+        """The conversation of two users, or None before their first message"""
+        user_a, user_b = self.pair(user_id, other_id)
+        return self.filter(user_a_id=user_a, user_b_id=user_b).first()
+
+    async def abetween(self, user_id, other_id):
+        user_a, user_b = self.pair(user_id, other_id)
+        return await self.filter(user_a_id=user_a, user_b_id=user_b).afirst()
+
+    def mark_read(self, user, other, up_to, since=None):
+        """
+        Move the read watermark of ``user`` in the conversation with ``other``
+        up to message id ``up_to``, recounting what stays unread. ``since``,
+        the timestamp of that message when the caller has it, bounds the
+        recount to the partitions from its month on. Returns the read time,
+        or None when the watermark did not move, in which case nothing was
+        written.
+        """
+        user_a, user_b = self.pair(user.pk, other.pk)
+        side = "a" if user.pk == user_a else "b"
+        with transaction.atomic():
+            conversation = (
+                self.select_for_update()
+                .filter(
+                    user_a_id=user_a,
+                    user_b_id=user_b,
+                    # never past the last message, so future messages stay unread
+                    last_message_id__gte=up_to,
+                    **{f"last_read_{side}__lt": up_to},
+                )
+                .first()
+            )
+            if conversation is None:
+                return None
+            before = getattr(conversation, f"unread_{side}")
+            if conversation.last_message_id == up_to:
+                unread = 0
+            else:
+                received = PrivateMessage.objects.filter(
+                    sender_id=other.pk, receiver_id=user.pk
+                )
+                if since is None:
+                    message = find(received, up_to)
+                    since = message.timestamp if message is not None else None
+                if since is not None:
+                    received = received.filter(timestamp__gte=since - TIMESTAMP_SLACK)
+                unread = received.filter(id__gt=up_to).count()
+            now = timezone.now()
+            self.filter(pk=conversation.pk).update(
+                **{
+                    f"last_read_{side}": up_to,
+                    f"read_at_{side}": now,
+                    f"unread_{side}": unread,
+                }
+            )
+            UnreadCounter.objects.add(
+                {user.pk: (unread - before, (unread > 0) - (before > 0))}
+            )
+        return now
+
+    def discount_unread(self, message):
+        """
+        Take a message about to be deleted off the unread counters. Must run
+        inside the transaction that deletes it.
+        """
+        user_a, user_b = self.pair(message.sender_id, message.receiver_id)
+        side = "a" if message.receiver_id == user_a else "b"
+        conversation = (
+            self.select_for_update().filter(user_a_id=user_a, user_b_id=user_b).first()
+        )
+        if conversation is not None:
+            unread = getattr(conversation, f"unread_{side}")
+            if unread and message.id > getattr(conversation, f"last_read_{side}"):
+                self.filter(pk=conversation.pk).update(
+                    **{f"unread_{side}": F(f"unread_{side}") - 1}
+                )
+                UnreadCounter.objects.add({message.receiver_id: (-1, -(unread == 1))})
+
+    def refresh(self, user_id, other_id):
+        """Recompute the last message of a conversation, e.g. after a delete"""
+        user_a, user_b = self.pair(user_id, other_id)
+        last = (
+            PrivateMessage.objects.filter(
+                Q(sender_id=user_a, receiver_id=user_b)
+                | Q(sender_id=user_b, receiver_id=user_a)
+            )
+            .order_by("-timestamp", "-id")
+            .first()
+        )
+        if last is None:
+            self.filter(user_a_id=user_a, user_b_id=user_b).delete()
+            return
+        self.filter(user_a_id=user_a, user_b_id=user_b).update(
+            last_message=last,
+            last_timestamp=last.timestamp,
+            preview=encrypt_message(last.get_message()[:PREVIEW_LENGTH]),
+        )
+
+
+class Conversation(models.Model):
+    """One row per user pair, kept up to date on every message for the inbox"""
+
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    # Not enforced by the database, the message table is partitioned (see
+    # chat.partitions)
+    last_message = models.ForeignKey(
+        PrivateMessage,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name="+",
+        db_constraint=False,
+    )
+    last_timestamp = models.DateTimeField(null=True)
+    preview = models.TextField(blank=True)  # Encrypted like PrivateMessage
+    unread_a = models.PositiveIntegerField(default=0)  # Unread for user_a
+    unread_b = models.PositiveIntegerField(default=0)  # Unread for user_b
+    # Read watermarks, every message up to this id was read by user_a/user_b
+    last_read_a = models.PositiveBigIntegerField(default=0)
+    last_read_b = models.PositiveBigIntegerField(default=0)
+    read_at_a = models.DateTimeField(null=True)
+    read_at_b = models.DateTimeField(null=True)
+    objects = ConversationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user_a", "user_b"], name="unique_conversation_pair"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["user_a", "-last_timestamp"]),
+            models.Index(fields=["user_b", "-last_timestamp"]),
+        ]
+
+    def other_user(self, user):
+        return self.user_b if self.user_a_id == user.pk else self.user_a
+
+    def unread_for(self, user):
+        return self.unread_a if self.user_a_id == user.pk else self.unread_b
+
+    def watermark(self, user_id):
+        """(last read message id, read time) of one of the two users"""
+        if self.user_a_id == user_id:
+            return self.last_read_a, self.read_at_a
+        return self.last_read_b, self.read_at_b
+
+    def is_read(self, message):
+        return message.id <= self.watermark(message.receiver_id)[0]
+
+    def get_preview(self):
+        return decrypt_message(self.preview) if self.preview else ""
+
+
+class MessageTokenManager(models.Manager):
+    def index(self, messages, texts):
+        """Add messages with a ``conversation_id`` to the search index"""
+        self.bulk_create(
+            [
+                MessageToken(
+                    conversation_id=message.conversation_id,
+                    message_id=message.id,
+                    token=token,
+                )
+                for message, text in zip(messages, texts)
+                for token in blind_tokens(text)
+            ],
+            ignore_conflicts=True,
+        )
+
+    def search(self, conversation_id, tokens, before=None, limit=50):
+        """
+        Ids of the messages of a conversation containing every token, newest
+        first, starting before message id ``before``
+        """
+        matches = self.filter(conversation_id=conversation_id, token__in=tokens)
+        if before is not None:
+            matches = matches.filter(message_id__lt=before)
+        return list(
+            matches.values("message_id")
+            .annotate(matched=Count("token", distinct=True))
+            .filter(matched=len(set(tokens)))
+            .order_by("-message_id")
+            .values_list("message_id", flat=True)[:limit]
+        )
+
+
+class MessageToken(models.Model):
+    """
+    Blind search index: one row per distinct word of a message, stored as a
+    keyed digest (see utils.blind_token) so the index reveals no plaintext.
+    """
+
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name="+"
+    )
+    message = models.ForeignKey(
+        PrivateMessage, on_delete=models.CASCADE, related_name="+", db_constraint=False
+    )
+    token = models.BigIntegerField()
+    objects = MessageTokenManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["message", "token"], name="unique_message_token"
+            ),
+        ]
+        indexes = [
+            # Candidates of a conversation for a word, newest first
+            models.Index(fields=["conversation", "token", "-message"]),
+        ]
+
+
+class UnreadCounterManager(models.Manager):
+    def add(self, deltas):
+        """
+        Apply ``{user_id: (messages, conversations)}`` deltas to the counters.
+        Must run inside the transaction that changed the conversation rows,
+        counters are locked in user order after them so writers cannot
+        deadlock.
+        """
+        for user_id, (messages, conversations) in sorted(deltas.items()):
+            if not messages and not conversations:
+                continue
+            values = {
+                "messages": Greatest(F("messages") + messages, 0),
+                "conversations": Greatest(F("conversations") + conversations, 0),
+            }
+            if self.filter(user_id=user_id).update(**values):
+                continue
+            _, created = self.get_or_create(
+                user_id=user_id,
+                defaults={
+                    "messages": max(messages, 0),
+                    "conversations": max(conversations, 0),
+                },
+            )
+            if not created:
+                self.filter(user_id=user_id).update(**values)
+
+    def totals(self, user_id):
+        counter = self.filter(user_id=user_id).values("messages", "conversations")
+        return counter.first() or {"messages": 0, "conversations": 0}
+
+    async def atotals(self, user_id):
+        counter = self.filter(user_id=user_id).values("messages", "conversations")
+        return await counter.afirst() or {"messages": 0, "conversations": 0}
+
+
+class UnreadCounter(models.Model):
+    """
+    Unread totals of a user over all conversations, kept in step with
+    Conversation.unread_a/unread_b. reconcile_unread fixes any drift.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="unread_counter"
+    )
+    messages = models.PositiveIntegerField(default=0)  # Unread messages
+    conversations = models.PositiveIntegerField(default=0)  # With unread messages
+    objects = UnreadCounterManager()
+
+
+class Presence(models.Model):
+    """Server-side online state of a user, kept alive by WebSocket heartbeats"""
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="presence"
+    )
+    connections = models.PositiveIntegerField(default=0)  # Open sockets
+    last_seen = models.DateTimeField()  # Last connect, heartbeat or disconnect
+
+    def is_online(self, timeout):
+        """Online while a socket is open and its heartbeat has not expired"""
+        fresh = self.last_seen >= timezone.now() - timedelta(seconds=timeout)
+        return self.connections > 0 and fresh
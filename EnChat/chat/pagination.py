@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta, timezone
+from django.db.models import Q
+from django.utils.timezone import now
+
+PAGE_SIZE = 50
+# Pages are first looked up this far back, so that on the partitioned
+# message table (chat.partitions) the common case scans the newest
+# partitions only
+RECENT = timedelta(days=31)
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# A message can carry an earlier timestamp than one with a lower id, by up
+# to the time between taking its id and committing. Lower bounds derived
+# from the timestamp of another message leave this much room.
+TIMESTAMP_SLACK = timedelta(minutes=5)
+
+
+def encode_cursor(message):
+    """Cursor pointing at a message, ordered by (timestamp, id)"""
+    return cursor_of(message.timestamp, message.id)
+
+
+def cursor_of(timestamp, message_id):
+    micros = (timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{message_id}"
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, id) of a cursor, or None if it is malformed"""
+    try:
+        micros, message_id = cursor.split("_")
+        return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _windows(messages, cursor):
+    """The messages before ``cursor``, newest first: recent ones, then older ones"""
+    if cursor:
+        timestamp, message_id = cursor
+        messages = messages.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    since = (cursor[0] if cursor else now()) - RECENT
+    messages = messages.order_by("-timestamp", "-id")
+    return messages.filter(timestamp__gte=since), messages.filter(timestamp__lt=since)
+
+
+def _finish(page, size):
+    has_older = len(page) > size
+    page = page[:size]
+    page.reverse()
+    return page, encode_cursor(page[0]) if has_older else None
+
+
+def page_before(messages, cursor=None, size=PAGE_SIZE):
+    """
+    Return the ``size`` messages right before ``cursor`` (the latest ones
+    when no cursor is given) in chronological order, plus the cursor of the
+    next older page or None when there is nothing older.
+    """
+    recent, older = _windows(messages, cursor)
+    page = list(recent[: size + 1])
+    if len(page) <= size:
+        page += older[: size + 1 - len(page)]
+    return _finish(page, size)
+
+
+async def apage_before(messages, cursor=None, size=PAGE_SIZE):
+    """page_before() for async views"""
+    recent, older = _windows(messages, cursor)
+    page = [message async for message in recent[: size + 1]]
+    if len(page) <= size:
+        page += [message async for message in older[: size + 1 - len(page)]]
+    return _finish(page, size)
+
+
+def after(messages, cursor):
+    """
+    The messages with an id past the one of ``cursor``, (timestamp, id),
+    bounded by its timestamp so that only the partitions from its month on
+    are scanned
+    """
+    timestamp, message_id = cursor
+    return messages.filter(
+        id__gt=message_id, timestamp__gte=timestamp - TIMESTAMP_SLACK
+    )
+
+
+def _by_id(messages, message_id):
+    since = now() - RECENT
+    return (
+        messages.filter(id=message_id, timestamp__gte=since),
+        messages.filter(id=message_id, timestamp__lt=since),
+    )
+
+
+def find(messages, message_id):
+    """
+    The message ``message_id`` of ``messages``, or None. Looked up in the
+    recent partitions first: an id alone is in any of them.
+    """
+    recent, older = _by_id(messages, message_id)
+    message = recent.first()
+    return message if message is not None else older.first()
+
+
+async def afind(messages, message_id):
+    """find() for async views"""
+    recent, older = _by_id(messages, message_id)
+    message = await recent.afirst()
+    return message if message is not None else await older.afirst()
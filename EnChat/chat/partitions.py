@@ -0,0 +1,354 @@
+"""
+Monthly range partitioning of the PrivateMessage table on ``timestamp``
+(PostgreSQL declarative partitioning).
+
+The existing table is converted in place: it becomes the first partition,
+covering everything before the next month, and new months get partitions
+of their own, named ``chat_privatemessage_pYYYYMM``. A partition has to
+include the partition key in its unique constraints, so the primary key
+becomes (id, timestamp) at the database level. Ids still come from one
+sequence and stay unique. Foreign keys cannot point at a partitioned
+table, so the references to messages are not enforced by the database.
+Expiring old messages detaches and drops (or archives) whole partitions
+instead of deleting rows. A default partition catches rows of months
+that have no partition yet, should partition_messages fall behind; it
+moves them out once it catches up.
+"""
+import gzip
+import json
+from datetime import datetime, timezone
+from django.db import connection, transaction
+from psycopg import sql
+from .models import PrivateMessage
+
+TABLE = PrivateMessage._meta.db_table
+LEGACY = f"{TABLE}_legacy"
+DEFAULT = f"{TABLE}_default"
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start:%Y%m}"
+
+
+def _fetchall(query, params=()):
+    with connection.cursor() as cursor:
+        if isinstance(query, sql.Composable):
+            query = query.as_string(cursor.connection)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+
+def _execute(statement):
+    with connection.cursor() as cursor:
+        cursor.execute(statement.as_string(cursor.connection))
+
+
+def _exists(name):
+    return _fetchall("SELECT to_regclass(%s)", [name])[0][0] is not None
+
+
+def is_partitioned():
+    return bool(
+        _fetchall(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [TABLE],
+        )
+    )
+
+
+def partitions():
+    """(name, start, end) of every partition, None for an open or default bound"""
+    rows = _fetchall(
+        """
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(%s)
+        ORDER BY child.relname
+        """,
+        [TABLE],
+    )
+    result = []
+    for name, bound in rows:
+        if bound == "DEFAULT":
+            result.append((name, None, None))
+            continue
+        # FOR VALUES FROM ('2026-10-01 00:00:00+00') TO ('2026-11-01 00:00:00+00')
+        start, end = bound.split("FROM (", 1)[1].split(") TO (")
+        result.append((name, _bound(start), _bound(end.rstrip(")"))))
+    return result
+
+
+def _bound(value):
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    (parsed,) = _fetchall("SELECT %s::timestamptz", [value.strip("'")])[0]
+    return parsed
+
+
+def _legacy(name):
+    return f"{name[:55]}_legacy"
+
+
+def convert(cutover):
+    """
+    Turn the plain message table into the partitioned one, the old table
+    becoming the partition of everything before ``cutover``. The slow
+    steps (a unique index, a CHECK constraint) run without blocking
+    writes; the swap itself holds an exclusive lock for a few catalog
+    updates only.
+    """
+    table, legacy = sql.Identifier(TABLE), sql.Identifier(LEGACY)
+    unique = sql.Identifier(f"{TABLE}_id_timestamp_uniq")
+    check = sql.Identifier(f"{TABLE}_before_cutover")
+    # must run outside of a transaction
+    _execute(
+        sql.SQL(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} (id, timestamp)"
+        ).format(unique, table)
+    )
+    _execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}").format(table, check))
+    _execute(
+        sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK (timestamp < {}) NOT VALID").format(
+            table, check, sql.Literal(cutover)
+        )
+    )
+    # scans the table, but only takes a SHARE UPDATE EXCLUSIVE lock
+    _execute(sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(table, check))
+
+    with transaction.atomic():
+        _execute(sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(table))
+        references = _fetchall(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE confrelid = to_regclass(%s)",
+            [TABLE],
+        )
+        foreign_keys = _fetchall(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+            [TABLE],
+        )
+        indexes = _fetchall(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename = %s",
+            [TABLE],
+        )
+        (last_id,) = _fetchall(
+            sql.SQL("SELECT coalesce(max(id), 0) FROM {}").format(table)
+        )[0]
+
+        # foreign keys cannot reference a partitioned table
+        for referencing, name in references:
+            _execute(
+                sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                    sql.Identifier(referencing), sql.Identifier(name)
+                )
+            )
+        _execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(table, legacy))
+        # index names are schema-wide, the parent takes over the originals
+        for name, _ in indexes:
+            _execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    sql.Identifier(name), sql.Identifier(_legacy(name))
+                )
+            )
+        # a partition's primary key must include the partition key
+        _execute(
+            sql.SQL(
+                "ALTER TABLE {} DROP CONSTRAINT {}, "
+                "ADD CONSTRAINT {} PRIMARY KEY USING INDEX {}"
+            ).format(
+                legacy,
+                sql.Identifier(_legacy(f"{TABLE}_pkey")),
+                sql.Identifier(f"{LEGACY}_pkey"),
+                sql.Identifier(_legacy(f"{TABLE}_id_timestamp_uniq")),
+            )
+        )
+        # the identity sequence belongs to the old table, move to a plain one
+        _execute(sql.SQL("ALTER TABLE {} ALTER COLUMN id DROP IDENTITY").format(legacy))
+        sequence = sql.Identifier(f"{TABLE}_id_seq")
+        _execute(sql.SQL("CREATE SEQUENCE {} START {}").format(sequence, sql.Literal(last_id + 1)))
+
+        _execute(
+            sql.SQL("CREATE TABLE {} (LIKE {}) PARTITION BY RANGE (timestamp)").format(
+                table, legacy
+            )
+        )
+        _execute(
+            sql.SQL("ALTER TABLE {} ALTER COLUMN id SET DEFAULT nextval({})").format(
+                table, sql.Literal(f"{TABLE}_id_seq")
+            )
+        )
+        _execute(sql.SQL("ALTER SEQUENCE {} OWNED BY {}.id").format(sequence, table))
+        _execute(
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (id, timestamp)").format(
+                table, sql.Identifier(f"{TABLE}_pkey")
+            )
+        )
+        for name, definition in indexes:
+            if name in (f"{TABLE}_pkey", f"{TABLE}_id_timestamp_uniq"):
+                continue
+            columns = definition.split(" USING ", 1)[1]
+            _execute(
+                sql.SQL("CREATE INDEX {} ON {} USING ").format(sql.Identifier(name), table)
+                + sql.SQL(columns)
+            )
+        for name, definition in foreign_keys:
+            _execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} ").format(table, sql.Identifier(name))
+                + sql.SQL(definition)
+            )
+        # the validated CHECK spares a scan, matching indexes are reused
+        _execute(
+            sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO ({})").format(
+                table, legacy, sql.Literal(cutover)
+            )
+        )
+        _execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(legacy, check))
+        _execute(
+            sql.SQL("CREATE TABLE {} PARTITION OF {} DEFAULT").format(
+                sql.Identifier(DEFAULT), table
+            )
+        )
+
+
+def create(start, lock_timeout="5s"):
+    """
+    Create the partition of the month starting at ``start``. Returns None
+    when it already exists, else the number of messages of that month moved
+    out of the default partition, where they landed while the month had no
+    partition of its own.
+
+    A partition cannot be added next to a default one holding rows of its
+    range, so in that case the default is detached, the month created, its
+    rows moved over and the default attached again, in one transaction.
+    Writes to the message table wait for it, hence ``lock_timeout``.
+    """
+    name = partition_name(start)
+    if _exists(name):
+        return None
+    end = add_months(start, 1)
+    table, default = sql.Identifier(TABLE), sql.Identifier(DEFAULT)
+    create_partition = sql.SQL(
+        "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})"
+    ).format(sql.Identifier(name), table, sql.Literal(start), sql.Literal(end))
+    if not _exists(DEFAULT) or not _fetchall(
+        sql.SQL("SELECT 1 FROM {} WHERE timestamp >= %s AND timestamp < %s LIMIT 1").format(
+            default
+        ),
+        [start, end],
+    ):
+        _execute(create_partition)
+        return 0
+
+    columns = sql.SQL(", ").join(
+        sql.Identifier(field.column) for field in PrivateMessage._meta.concrete_fields
+    )
+    with transaction.atomic():
+        _execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(lock_timeout)))
+        _execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(table, default))
+        _execute(create_partition)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    "WITH moved AS (DELETE FROM {} WHERE timestamp >= %s AND timestamp < %s "
+                    "RETURNING {}) INSERT INTO {} ({}) SELECT {} FROM moved"
+                )
+                .format(default, columns, sql.Identifier(name), columns, columns)
+                .as_string(cursor.connection),
+                [start, end],
+            )
+            moved = cursor.rowcount
+        # scans what is left in the default partition
+        _execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} DEFAULT").format(table, default))
+    return moved
+
+
+def last_id(name):
+    """Highest message id in partition ``name``, None when it is empty"""
+    return _fetchall(sql.SQL("SELECT max(id) FROM {}").format(sql.Identifier(name)))[0][0]
+
+
+def detach(name, lock_timeout="5s"):
+    """
+    Detach a partition. DETACH CONCURRENTLY is not allowed next to a
+    default partition, so this takes a short exclusive lock on the parent
+    instead, giving up after ``lock_timeout`` rather than stall every
+    query queued behind it.
+    """
+    with transaction.atomic():
+        _execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(lock_timeout)))
+        _execute(
+            sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                sql.Identifier(TABLE), sql.Identifier(name)
+            )
+        )
+
+
+def drop(name):
+    _execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+
+
+def archive(name, start, end, path):
+    """
+    Write a detached partition to ``path`` (binary COPY, gzipped) with a
+    ``.json`` sidecar describing it for restore()
+    """
+    columns = [field.column for field in PrivateMessage._meta.concrete_fields]
+    copy = sql.SQL("COPY {} ({}) TO STDOUT (FORMAT binary)").format(
+        sql.Identifier(name), sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    with gzip.open(path, "wb") as output, connection.cursor() as cursor:
+        with cursor.copy(copy) as stream:
+            for block in stream:
+                output.write(block)
+    (rows,) = _fetchall(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(name)))[0]
+    with open(f"{path}.json", "w") as sidecar:
+        json.dump(
+            {
+                "table": name,
+                "start": start.isoformat() if start else None,
+                "end": end.isoformat() if end else None,
+                "columns": columns,
+                "rows": rows,
+            },
+            sidecar,
+        )
+    return rows
+
+
+def restore(path):
+    """Load an archive written by archive() and attach it again"""
+    with open(f"{path}.json") as sidecar:
+        meta = json.load(sidecar)
+    name = sql.Identifier(meta["table"])
+    copy = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT binary)").format(
+        name, sql.SQL(", ").join(map(sql.Identifier, meta["columns"]))
+    )
+    start = sql.Literal(meta["start"]) if meta["start"] else sql.SQL("MINVALUE")
+    end = sql.Literal(meta["end"]) if meta["end"] else sql.SQL("MAXVALUE")
+    with transaction.atomic():
+        _execute(
+            sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(
+                name, sql.Identifier(TABLE)
+            )
+        )
+        with gzip.open(path, "rb") as source, connection.cursor() as cursor:
+            with cursor.copy(copy) as stream:
+                while block := source.read(1 << 20):
+                    stream.write(block)
+        _execute(
+            sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+                sql.Identifier(TABLE), name, start, end
+            )
+        )
+    return meta
@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Conversation, Presence
+
+# Seconds without a heartbeat after which a user counts as offline, clients
+# ping every 30 seconds
+PRESENCE_TIMEOUT = getattr(settings, "CHAT_PRESENCE_TIMEOUT", 75)
+
+
+def serialize(slug, presence):
+    online = presence is not None and presence.is_online(PRESENCE_TIMEOUT)
+    return {
+        "user": slug,
+        "online": online,
+        "last_seen": str(presence.last_seen) if presence is not None else None,
+    }
+
+
+def connect(user):
+    """
+    Count a new socket of ``user``. Returns the presence state when the user
+    just came online, None when they already were.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        presence, created = Presence.objects.select_for_update().get_or_create(
+            user_id=user.pk, defaults={"last_seen": now}
+        )
+        was_online = not created and presence.is_online(PRESENCE_TIMEOUT)
+        if not was_online:
+            # sockets of a crashed worker never disconnected, forget them
+            presence.connections = 0
+        presence.connections += 1
+        presence.last_seen = now
+        presence.save()
+    return None if was_online else serialize(user.slug, presence)
+
+
+def disconnect(user):
+    """
+    Forget a closed socket of ``user``. Returns the presence state when it was
+    their last one, None while other sockets are still open.
+    """
+    with transaction.atomic():
+        presence = Presence.objects.select_for_update().filter(user_id=user.pk).first()
+        if presence is None:
+            return None
+        presence.connections = max(presence.connections - 1, 0)
+        presence.last_seen = timezone.now()
+        presence.save()
+    return None if presence.connections else serialize(user.slug, presence)
+
+
+def heartbeat(user):
+    Presence.objects.filter(user_id=user.pk).update(last_seen=timezone.now())
+
+
+def snapshot(users):
+    """Presence state of a list of UserSummary"""
+    presences = Presence.objects.in_bulk([user.pk for user in users])
+    return [serialize(user.slug, presences.get(user.pk)) for user in users]
+
+
+def followable(user, users):
+    """
+    The UserSummary of ``users`` whose presence ``user`` may follow: public
+    directory users, and private ones they share a conversation with
+    """
+    private = [other.pk for other in users if other.is_private and other.pk != user.pk]
+    partners = set()
+    if private:
+        pairs = Conversation.objects.filter(
+            Q(user_a_id=user.pk, user_b_id__in=private)
+            | Q(user_b_id=user.pk, user_a_id__in=private)
+        ).values_list("user_a_id", "user_b_id")
+        for user_a, user_b in pairs:
+            partners.add(user_b if user_a == user.pk else user_a)
+    return [
+        other
+        for other in users
+        if not other.is_private or other.pk == user.pk or other.pk in partners
+    ]
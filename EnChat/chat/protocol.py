@@ -0,0 +1,149 @@
+"""
+EnChat WebSocket wire protocol.
+
+Version 1 frames sent by the server carry one or more events, coalesced
+within a short window: ``{"v": 1, "events": [{"t": "message", ...}, ...]}``.
+Client frames carry a single event: ``{"v": 1, "t": "message", ...}``.
+Read events are watermarks: ``{"t": "read", "id": 42}`` marks every
+message of the conversation up to id 42 as read, ``unread`` events carry
+the unread totals of the user. ``error`` events tell that a frame was
+refused: ``throttled`` (over the rate limit), ``too_large`` or
+``overloaded`` (with the ``ref`` of the frame when it had one), or
+``malformed`` (not a frame of this protocol).
+Heartbeats are the bare text frames ``ping`` and ``pong`` so they never
+go through a decoder.
+
+The encoding is negotiated with the WebSocket subprotocol: JSON by
+default, MessagePack when the client asks for it and ``msgpack`` is
+installed. Clients that offer no subprotocol get the legacy protocol of
+one JSON frame per event: LegacyCodec only decodes, the consumer sends
+those events itself.
+"""
+import json
+from .serializers import dumps
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for the binary subprotocol
+    msgpack = None
+
+VERSION = 1
+JSON_SUBPROTOCOL = "enchat.v1.json"
+MSGPACK_SUBPROTOCOL = "enchat.v1.msgpack"
+PING = "ping"
+PONG = "pong"
+LEGACY_PING = '{"type":"ping"}'
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class JSONCodec:
+    subprotocol = JSON_SUBPROTOCOL
+    legacy = False
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except ValueError as error:
+            raise ProtocolError("Malformed frame") from error
+        return check_version(data)
+
+    def encode(self, events):
+        return {"text_data": dumps({"v": VERSION, "events": events})}
+
+
+class MsgPackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+    legacy = False
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ProtocolError("Expected a binary frame")
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except ValueError as error:
+            raise ProtocolError("Malformed frame") from error
+        return check_version(data)
+
+    def encode(self, events):
+        return {"bytes_data": msgpack.packb({"v": VERSION, "events": events})}
+
+
+class LegacyCodec:
+    """Unversioned frames of the first chat.html client"""
+
+    subprotocol = None
+    legacy = True
+    types = {"read_message": "read", "ping": "ping"}
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except ValueError as error:
+            raise ProtocolError("Malformed frame") from error
+        if not isinstance(data, dict):
+            raise ProtocolError("Malformed frame")
+        kind = self.types.get(data.get("type"), "message")
+        if kind == "read":
+            return {"t": "read", "id": data.get("message_id")}
+        if kind == "ping":
+            return {"t": "ping"}
+        return {"t": "message", "text": data.get("message")}
+
+
+def check_version(data):
+    if not isinstance(data, dict) or data.get("v") != VERSION:
+        raise ProtocolError("Unsupported frame")
+    if not isinstance(data.get("t"), str):
+        raise ProtocolError("Malformed frame")
+    return data
+
+
+def negotiate(subprotocols):
+    """Pick the codec for the subprotocols offered by the client"""
+    for subprotocol in subprotocols:
+        if subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+            return MsgPackCodec()
+        if subprotocol == JSON_SUBPROTOCOL:
+            return JSONCodec()
+    return LegacyCodec()
+
+
+def to_event(event):
+    """Protocol event for a channel-layer event sent to a group"""
+    if event["type"] == "chat_message":
+        return {
+            "t": "message",
+            "id": event["message_id"],
+            "c": event["conversation"],
+            "from": event["sender_slug"],
+            "to": event["receiver_slug"],
+            "sender": event["sender"],
+            "text": event["message"],
+            "ts": event["timestamp"],
+        }
+    if event["type"] == "read_receipt":
+        # a read watermark, every message of "from" up to "id" was read by "to"
+        return {
+            "t": "read",
+            "id": event["message_id"],
+            "from": event["sender_slug"],
+            "to": event["receiver_slug"],
+            "read_at": event["read_at"],
+        }
+    if event["type"] == "unread":
+        return {
+            "t": "unread",
+            "messages": event["messages"],
+            "conversations": event["conversations"],
+        }
+    if event["type"] == "presence":
+        return {
+            "t": "presence",
+            "user": event["user"],
+            "online": event["online"],
+            "last_seen": event["last_seen"],
+        }
+    raise ProtocolError(f"Unknown event type {event['type']}")
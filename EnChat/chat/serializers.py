@@ -0,0 +1,112 @@
+"""
+Serialization of messages, shared by the chat views and the WebSocket
+consumer.
+
+Messages are read as projections: the columns a message needs plus the
+usernames of both users, joined in SQL, so a page costs one query
+whatever its size and no model instance is built. Ciphertexts are
+decrypted in one batch, and JSON is encoded with orjson when it is
+installed.
+"""
+import json
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.http import HttpResponse
+from utils import decrypt_many
+from .models import PrivateMessage
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is the fallback
+    orjson = None
+
+# Smaller batches decrypt faster than the hop to a worker thread
+OFFLOAD_ROWS = 200
+
+COLUMNS = (
+    "id",
+    "sender_id",
+    "receiver_id",
+    "timestamp",
+    "ciphertext",
+    "encrypted_message",
+    "sender_name",
+    "receiver_name",
+)
+
+
+def project(messages):
+    """A PrivateMessage queryset as named rows of COLUMNS"""
+    return messages.annotate(
+        sender_name=F("sender__username"), receiver_name=F("receiver__username")
+    ).values_list(*COLUMNS, named=True)
+
+
+def conversation_messages(user_id, other_id):
+    """Rows of all messages exchanged between two users"""
+    return project(
+        PrivateMessage.objects.filter(
+            Q(sender_id=user_id, receiver_id=other_id)
+            | Q(sender_id=other_id, receiver_id=user_id)
+        )
+    )
+
+
+def serialize(rows, conversation):
+    """
+    Message dicts of projected rows, decrypted in one batch. Read state
+    comes from the read watermarks of ``conversation``.
+    """
+    rows = list(rows)
+    texts = decrypt_many(
+        row.encrypted_message if row.ciphertext is None else row.ciphertext
+        for row in rows
+    )
+    serialized = []
+    for row, text in zip(rows, texts):
+        is_read = conversation is not None and conversation.is_read(row)
+        serialized.append(
+            {
+                "id": row.id,
+                "sender": row.sender_name,
+                "receiver": row.receiver_name,
+                "message": text,
+                "timestamp": row.timestamp,
+                "is_read": is_read,
+                "read_at": conversation.watermark(row.receiver_id)[1] if is_read else None,
+            }
+        )
+    return serialized
+
+
+async def aserialize(rows, conversation):
+    """serialize() for async views, decrypting large batches in a worker thread"""
+    rows = list(rows)
+    if len(rows) < OFFLOAD_ROWS:
+        return serialize(rows, conversation)
+    return await sync_to_async(serialize, thread_sensitive=False)(rows, conversation)
+
+
+def serialize_new(message, sender, receiver, text):
+    """The dict of a message just sent, from what the sender already knows"""
+    return {
+        "id": message.id,
+        "sender": sender.username,
+        "receiver": receiver.username,
+        "message": text,
+        "timestamp": message.timestamp,
+        "is_read": False,
+        "read_at": None,
+    }
+
+
+def dumps(data):
+    """JSON text of ``data``, datetimes included"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":"))
+
+
+def json_response(data, status=200):
+    return HttpResponse(dumps(data), content_type="application/json", status=status)
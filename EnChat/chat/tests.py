@@ -1,3 +1,799 @@
-from django.test import TestCase
+import asyncio
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import zlib
+from datetime import timedelta
+from unittest import mock, skipIf
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from users.cache import get_user_summary
+from users.models import User
+from utils import (
+    ASYNC_BATCH_THRESHOLD,
+    CODEC_NONE,
+    CODEC_ZLIB,
+    CODEC_ZSTD,
+    KEY,
+    adecrypt_many,
+    decrypt_cache,
+    decrypt_many,
+    decrypt_message,
+    encrypt_many,
+    key_id_of,
+    seal_many,
+    zstandard,
+)
+from . import export, partitions, presence, protocol, throttle
+from .layers import PostgresChannelLayer
+from .models import Conversation, MessageToken, PrivateMessage, UnreadCounter
+from .routing import websocket_urlpatterns
+from .pagination import PAGE_SIZE
 
-# Create your tests here.
+
+# sessions and users are cached in the shared tier, which Redis provides
+SHARED_LOCMEM = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "shared",
+    },
+}
+
+
+@override_settings(CACHES=SHARED_LOCMEM)
+class MessageQueryCountTests(TestCase):
+    """Serving a page of messages costs the same queries whatever its size"""
+
+    def setUp(self):
+        caches["shared"].clear()
+        self.alice = User.objects.create_user("alice", "alice@example.com", "pw12345!")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "pw12345!")
+        self.client.force_login(self.alice)
+
+    def send(self, count):
+        for i in range(count):
+            PrivateMessage.objects.create(
+                sender=self.alice, receiver=self.bob, encrypted_message=f"hello {i}"
+            )
+
+    def queries(self, url):
+        self.client.get(url)  # warm the session and user caches
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def assertFixedQueries(self, name, expected):
+        url = reverse(name, args=[self.bob.slug])
+        self.send(1)
+        self.assertEqual(self.queries(url), expected)
+        self.send(PAGE_SIZE - 1)
+        self.assertEqual(self.queries(url), expected)
+
+    def test_chat(self):
+        self.assertFixedQueries("chat", 3)
+
+    def test_get_messages(self):
+        self.assertFixedQueries("get_messages", 2)
+
+    def test_send_message(self):
+        url = reverse("send_message", args=[self.bob.slug])
+        self.client.post(url, {"message": "warm up"})
+        with self.assertNumQueries(8):
+            response = self.client.post(url, {"message": "hello"})
+        self.assertEqual(response.json()["message"]["message"], "hello")
+
+
+SECOND_KEY = base64.b64encode(bytes(range(32))).decode()
+
+
+def envelope(payload, codec=CODEC_NONE, key=KEY, header=(2, CODEC_NONE, 0)):
+    """A stored message built by hand, IV + CBC ciphertext behind ``header``"""
+    iv = bytes(16)
+    ciphertext = AES.new(key, AES.MODE_CBC, iv).encrypt(pad(payload, AES.block_size))
+    return bytes(header) + iv + ciphertext
+
+
+class MessageCryptoTests(SimpleTestCase):
+    """Every format ever stored decrypts, alone or in a batch, to the same text"""
+
+    text = "hello " * 50  # long enough to be compressed
+
+    def setUp(self):
+        decrypt_cache.clear()
+
+    def decrypt(self, encrypted_message):
+        decrypt_cache.clear()  # decrypt for real, not from the cache
+        return decrypt_message(encrypted_message)
+
+    def test_legacy_text(self):
+        legacy = base64.b64encode(envelope(b"from before envelopes", header=()))
+        self.assertEqual(self.decrypt(legacy.decode()), "from before envelopes")
+
+    def test_version_1_envelope(self):
+        sealed = envelope(zlib.compress(self.text.encode()), header=(1, CODEC_ZLIB))
+        self.assertEqual(key_id_of(sealed), 0)
+        self.assertEqual(self.decrypt(sealed), self.text)
+
+    def test_codecs(self):
+        codecs = {CODEC_NONE: lambda data: data, CODEC_ZLIB: zlib.compress}
+        if zstandard is not None:
+            codecs[CODEC_ZSTD] = zstandard.compress
+        for codec, compress in codecs.items():
+            with self.subTest(codec=codec):
+                payload = compress(self.text.encode())
+                sealed = envelope(payload, header=(2, codec, 0))
+                self.assertEqual(self.decrypt(sealed), self.text)
+
+    def test_round_trip(self):
+        for text in ("", "short", self.text, "ünïcødé ✓"):
+            with self.subTest(text=text):
+                (sealed,) = seal_many([text])
+                (encrypted,) = encrypt_many([text])
+                self.assertEqual(self.decrypt(sealed), text)
+                self.assertEqual(self.decrypt(encrypted), text)
+        (sealed,) = seal_many([self.text])
+        self.assertNotEqual(sealed[1], CODEC_NONE)
+
+    @skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd_is_preferred(self):
+        (sealed,) = seal_many([self.text])
+        self.assertEqual(sealed[1], CODEC_ZSTD)
+
+    @override_settings(CHAT_ENCRYPTION_KEYS={1: SECOND_KEY}, CHAT_ENCRYPTION_KEY_ID=1)
+    def test_active_key(self):
+        (sealed,) = seal_many(["under key 1"])
+        self.assertEqual(key_id_of(sealed), 1)
+        self.assertEqual(self.decrypt(sealed), "under key 1")
+
+    def test_unknown_key(self):
+        sealed = envelope(b"lost key", header=(2, CODEC_NONE, 7))
+        with self.assertRaisesMessage(ValueError, "Unknown encryption key 7"):
+            self.decrypt(sealed)
+
+    def test_unknown_codec_and_version(self):
+        with self.assertRaisesMessage(ValueError, "Unknown message codec"):
+            self.decrypt(envelope(b"text", header=(2, 9, 0)))
+        with self.assertRaisesMessage(ValueError, "Unsupported message envelope"):
+            self.decrypt(envelope(b"text", header=(9, CODEC_NONE, 0)))
+
+    def test_tampered(self):
+        sealed = bytearray(envelope(b"hello"))
+        # the IV is chained into the padding byte of the only block
+        sealed[3 + 15] ^= 0xFF
+        with self.assertRaises(ValueError):
+            self.decrypt(bytes(sealed))
+
+    def test_truncated(self):
+        (sealed,) = seal_many(["a message of a couple of blocks"])
+        (encrypted,) = encrypt_many(["a message of a couple of blocks"])
+        for broken in (sealed[:-5], sealed[:-16], sealed[:3], b"", encrypted[:-1]):
+            with self.subTest(broken=broken), self.assertRaises(ValueError):
+                self.decrypt(broken)
+
+    @override_settings(CHAT_ENCRYPTION_KEYS={1: SECOND_KEY})
+    def test_mixed_batch(self):
+        texts = [f"message {i} " * (i % 4 * 20) for i in range(12)]
+        batch = [
+            base64.b64encode(envelope(b"legacy", header=())).decode(),
+            envelope(zlib.compress(self.text.encode()), header=(1, CODEC_ZLIB)),
+            envelope(b"second key", key=base64.b64decode(SECOND_KEY), header=(2, 0, 1)),
+            *seal_many(texts[:6]),
+            *encrypt_many(texts[6:]),
+        ]
+        batch[3] = memoryview(batch[3])  # as read from a binary column
+        one_by_one = [self.decrypt(message) for message in batch]
+        self.assertEqual(one_by_one, ["legacy", self.text, "second key", *texts])
+        decrypt_cache.clear()
+        self.assertEqual(decrypt_many(batch), one_by_one)
+        self.assertEqual(decrypt_many(batch), one_by_one)  # from the cache
+
+    async def test_adecrypt_many(self):
+        texts = [f"message {i}" for i in range(ASYNC_BATCH_THRESHOLD)]
+        batch = seal_many(texts)
+        threads = []
+
+        def recording(encrypted_messages):
+            threads.append(threading.current_thread().name)
+            return decrypt_many(encrypted_messages)
+
+        with mock.patch("utils.decrypt_many", recording):
+            # small batches stay on the event loop, large ones leave it
+            self.assertEqual(await adecrypt_many(batch[:2]), texts[:2])
+            self.assertEqual(await adecrypt_many(iter(batch)), texts)
+        self.assertEqual(threads[0], threading.current_thread().name)
+        self.assertTrue(threads[1].startswith("decrypt"))
+
+
+class PresenceTests(TestCase):
+    """Presence is only shared with the public and with conversation partners"""
+
+    def test_followable(self):
+        users = {
+            name: User.objects.create_user(
+                name, f"{name}@example.com", "pw12345!", is_private=name != "dave"
+            )
+            for name in ("alice", "bob", "carol", "dave")
+        }
+        alice, bob = users["alice"], users["bob"]
+        user_a, user_b = Conversation.objects.pair(alice.pk, bob.pk)
+        Conversation.objects.create(user_a_id=user_a, user_b_id=user_b)
+        summaries = [get_user_summary(user.slug) for user in users.values()]
+        followable = presence.followable(alice, summaries)
+        # carol is private and never talked to alice
+        self.assertEqual(
+            [user.username for user in followable], ["alice", "bob", "dave"]
+        )
+        self.assertEqual(
+            [user.username for user in presence.followable(users["carol"], summaries)],
+            ["carol", "dave"],
+        )
+
+
+@override_settings(CACHES=SHARED_LOCMEM)
+class DeleteMessageTests(TestCase):
+    """Only the sender of a message can delete it"""
+
+    def setUp(self):
+        caches["shared"].clear()
+        self.alice = User.objects.create_user("alice", "alice@example.com", "pw12345!")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "pw12345!")
+        self.client.force_login(self.alice)
+        self.client.post(reverse("send_message", args=[self.bob.slug]), {"message": "hi"})
+        self.message = PrivateMessage.objects.get()
+
+    def test_others_message(self):
+        self.client.force_login(self.bob)
+        url = reverse("delete_message", args=[self.message.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertTrue(PrivateMessage.objects.filter(id=self.message.id).exists())
+        self.assertEqual(UnreadCounter.objects.totals(self.bob.pk)["messages"], 1)
+
+    def test_own_message(self):
+        url = reverse("delete_message", args=[self.message.id])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse(PrivateMessage.objects.exists())
+        self.assertFalse(Conversation.objects.exists())
+        self.assertEqual(UnreadCounter.objects.totals(self.bob.pk)["messages"], 0)
+
+
+@override_settings(CACHES=SHARED_LOCMEM)
+class SearchIndexTests(TestCase):
+    """The search index is keyed by a configured secret and rebuilt when it changes"""
+
+    def setUp(self):
+        caches["shared"].clear()
+        self.alice = User.objects.create_user("alice", "alice@example.com", "pw12345!")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "pw12345!")
+        self.client.force_login(self.alice)
+        url = reverse("send_message", args=[self.bob.slug])
+        self.client.post(url, {"message": "meet at noon"})
+        self.client.post(url, {"message": "lunch at noon"})
+
+    def search(self, query):
+        url = reverse("search_messages", args=[self.bob.slug])
+        messages = self.client.get(url, {"q": query}).json()["messages"]
+        return [message["message"] for message in messages]
+
+    def test_rebuild(self):
+        self.assertEqual(self.search("noon"), ["lunch at noon", "meet at noon"])
+        tokens = MessageToken.objects.count()
+        with override_settings(CHAT_SEARCH_KEY=base64.b64encode(b"s" * 32).decode()):
+            # entries made under the old key no longer match
+            self.assertEqual(self.search("noon"), [])
+            call_command(
+                "build_search_index", "--rebuild", "--batch-size=1", stdout=io.StringIO()
+            )
+            self.assertEqual(self.search("meet noon"), ["meet at noon"])
+            self.assertEqual(MessageToken.objects.count(), tokens)
+
+
+@skipIf(connection.vendor != "postgresql", "LISTEN/NOTIFY needs PostgreSQL")
+class PostgresChannelLayerTests(SimpleTestCase):
+    """Two layers stand for two worker processes sharing the database"""
+
+    databases = {"default"}
+
+    def setUp(self):
+        self.sender = PostgresChannelLayer()
+        self.receiver = PostgresChannelLayer()
+
+    def tearDown(self):
+        async def close():
+            await self.receiver.flush()
+            # also drops the connections of the loop the test ran in
+            for layer in (self.sender, self.receiver):
+                await layer.close()
+
+        async_to_sync(close)()
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 5)
+
+    async def listen(self, layer, channel):
+        """Start receiving on ``channel``, returns the pending receive"""
+        task = asyncio.ensure_future(self.receive(layer, channel))
+        state = await layer._state(listen=True)
+        while layer.route(channel) not in state.routes:
+            await asyncio.sleep(0.05)
+        return task
+
+    async def test_send_receive(self):
+        channel = await self.receiver.new_channel()
+        received = await self.listen(self.receiver, channel)
+        await self.sender.send(channel, {"type": "chat.message", "text": "hi"})
+        self.assertEqual(await received, {"type": "chat.message", "text": "hi"})
+
+    async def test_group_fan_out(self):
+        local = await self.sender.new_channel()
+        remote = [await self.receiver.new_channel() for _ in range(2)]
+        for channel in (local, *remote):
+            await self.sender.group_add("room", channel)
+        received = [await self.listen(self.receiver, channel) for channel in remote]
+        await self.sender.group_send("room", {"type": "chat.message"})
+        message = await self.receive(self.sender, local)
+        self.assertEqual(message, {"type": "chat.message"})
+        for message in received:
+            self.assertEqual(await message, {"type": "chat.message"})
+
+    async def test_spilled_envelope(self):
+        channel = await self.receiver.new_channel()
+        received = await self.listen(self.receiver, channel)
+        message = {"type": "chat.message", "text": "x" * 8000}
+        await self.sender.send(channel, message)
+        self.assertEqual(await received, message)
+        writer = await self.receiver._connection()
+        cursor = await writer.execute("SELECT count(*) FROM channels_payload")
+        self.assertEqual(await cursor.fetchone(), (0,))
+
+    async def test_reconnect(self):
+        self.receiver.reconnect_delay = 0.05
+        specific = await self.receiver.new_channel()
+        received = await self.listen(self.receiver, "plain")
+        state = await self.receiver._state(listen=True)
+        pids = [state.listener.info.backend_pid, state.writer.info.backend_pid]
+        writer = await self.sender._connection()
+        await writer.execute(
+            "SELECT pg_terminate_backend(pid) FROM unnest(%s::int[]) pid", (pids,)
+        )
+
+        # both connections are replaced and every route LISTENed on again
+        for _ in range(100):
+            listener = state.listener
+            if (
+                not listener.closed
+                and listener.info.backend_pid not in pids
+                and state.reconnecting is None
+                and not state.pending_listens
+            ):
+                break
+            await asyncio.sleep(0.05)
+        self.assertNotIn(state.writer.info.backend_pid, pids)
+        await self.sender.send("plain", {"type": "after.reconnect"})
+        self.assertEqual(await received, {"type": "after.reconnect"})
+        received = await self.listen(self.receiver, specific)
+        await self.sender.send(specific, {"type": "specific"})
+        self.assertEqual(await received, {"type": "specific"})
+
+
+@skipIf(connection.vendor != "postgresql", "Partitioning needs PostgreSQL")
+@override_settings(CACHES=SHARED_LOCMEM)
+class PartitionTests(TransactionTestCase):
+    """
+    The message table converts in place, months that fell behind leave the
+    default partition, and expired months come back from their archive.
+    Leaves the table partitioned, which the other tests run before.
+    """
+
+    def call(self, *args, **options):
+        output = io.StringIO()
+        call_command(*args, stdout=output, **options)
+        return output.getvalue()
+
+    def in_partition(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM "{name}"')
+            return cursor.fetchone()[0]
+
+    def test_convert_expire_restore(self):
+        caches["shared"].clear()
+        alice = User.objects.create_user("alice", "alice@example.com", "pw12345!")
+        bob = User.objects.create_user("bob", "bob@example.com", "pw12345!")
+        self.client.force_login(alice)
+        for text in ("one", "two", "three"):
+            self.client.post(reverse("send_message", args=[bob.slug]), {"message": text})
+        this_month = partitions.month_start(timezone.now())
+        PrivateMessage.objects.update(timestamp=this_month - timedelta(days=40))
+
+        self.call("partition_messages", convert=True)
+        self.assertTrue(partitions.is_partitioned())
+        self.assertEqual(self.in_partition(partitions.LEGACY), 3)
+
+        # partition_messages fell behind, a message lands in the default
+        late = partitions.add_months(this_month, 6)
+        message = PrivateMessage.objects.create(
+            sender=bob, receiver=alice, encrypted_message="late"
+        )
+        PrivateMessage.objects.filter(id=message.id).update(timestamp=late)
+        self.assertEqual(self.in_partition(partitions.DEFAULT), 1)
+        output = self.call("partition_messages", months_ahead=6)
+        self.assertIn(f"Moved 1 messages of {partitions.partition_name(late)}", output)
+        self.assertEqual(self.in_partition(partitions.DEFAULT), 0)
+        self.assertEqual(self.in_partition(partitions.partition_name(late)), 1)
+
+        expired_at = partitions.add_months(this_month, 2)
+        with tempfile.TemporaryDirectory() as archive_dir, mock.patch(
+            "django.utils.timezone.now", return_value=expired_at
+        ):
+            self.call("expire_messages", months=0, archive_dir=archive_dir)
+            self.assertEqual(
+                list(PrivateMessage.objects.values_list("timestamp", flat=True)), [late]
+            )
+            self.assertFalse(MessageToken.objects.exists())
+
+            archive = os.path.join(archive_dir, f"{partitions.LEGACY}.copy.gz")
+            self.call("restore_messages", archive)
+        self.assertEqual(
+            sorted(message.get_message() for message in PrivateMessage.objects.all()),
+            ["late", "one", "three", "two"],
+        )
+
+
+@override_settings(
+    CACHES=SHARED_LOCMEM,
+    CHAT_GROUP_COMMIT=True,
+    CHAT_GROUP_COMMIT_INTERVAL=0.2,
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class MessageDeliveryTests(TransactionTestCase):
+    """A message saved after its sender disconnected still reaches the room"""
+
+    async def connect(self, user, other):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/chat/{other.slug}/"
+        )
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @mock.patch("chat.writebehind._writer", None)
+    async def test_disconnect_before_commit(self):
+        create_user = database_sync_to_async(User.objects.create_user)
+        alice = await create_user("alice", "alice@example.com", "pw12345!")
+        bob = await create_user("bob", "bob@example.com", "pw12345!")
+        sender = await self.connect(alice, bob)
+        watcher = await self.connect(bob, alice)
+        await sender.send_json_to({"message": "bye"})
+        # gone while the message waits for its group commit
+        await sender.disconnect()
+        event = await watcher.receive_json_from(timeout=5)
+        self.assertEqual(event["message"], "bye")
+        await watcher.disconnect()
+
+
+class ProtocolTests(SimpleTestCase):
+    """Frames decode to events, whatever the codec, and other versions are refused"""
+
+    def test_negotiate(self):
+        codec = protocol.negotiate([protocol.JSON_SUBPROTOCOL])
+        self.assertIsInstance(codec, protocol.JSONCodec)
+        self.assertIsInstance(protocol.negotiate([]), protocol.LegacyCodec)
+        self.assertIsInstance(protocol.negotiate(["enchat.v2.json"]), protocol.LegacyCodec)
+        if protocol.msgpack is not None:
+            codec = protocol.negotiate(
+                [protocol.MSGPACK_SUBPROTOCOL, protocol.JSON_SUBPROTOCOL]
+            )
+            self.assertIsInstance(codec, protocol.MsgPackCodec)
+
+    def test_json(self):
+        codec = protocol.JSONCodec()
+        frame = '{"v": 1, "t": "message", "c": 7, "text": "hi", "ref": "a"}'
+        self.assertEqual(
+            codec.decode(text_data=frame),
+            {"v": 1, "t": "message", "c": 7, "text": "hi", "ref": "a"},
+        )
+        encoded = codec.encode([{"t": "ack", "ref": "a", "id": 3}])
+        self.assertEqual(
+            json.loads(encoded["text_data"]),
+            {"v": 1, "events": [{"t": "ack", "ref": "a", "id": 3}]},
+        )
+
+    @skipIf(protocol.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        codec = protocol.MsgPackCodec()
+        frame = protocol.msgpack.packb({"v": 1, "t": "read", "id": 42})
+        self.assertEqual(codec.decode(bytes_data=frame), {"v": 1, "t": "read", "id": 42})
+        encoded = codec.encode([{"t": "read", "id": 42}])
+        self.assertEqual(
+            protocol.msgpack.unpackb(encoded["bytes_data"]),
+            {"v": 1, "events": [{"t": "read", "id": 42}]},
+        )
+        with self.assertRaises(protocol.ProtocolError):
+            codec.decode(text_data='{"v": 1, "t": "read"}')
+        with self.assertRaises(protocol.ProtocolError):
+            codec.decode(bytes_data=b"\xc1")
+
+    def test_version_checks(self):
+        codec = protocol.JSONCodec()
+        for frame in (
+            '{"v": 2, "t": "message"}',
+            '{"t": "message"}',
+            '[{"v": 1, "t": "message"}]',
+            '{"v": 1, "t": 5}',
+            '{"v": 1',
+        ):
+            with self.subTest(frame=frame), self.assertRaises(protocol.ProtocolError):
+                codec.decode(text_data=frame)
+
+    def test_legacy(self):
+        codec = protocol.LegacyCodec()
+        self.assertEqual(
+            codec.decode(text_data='{"type": "read_message", "message_id": 5}'),
+            {"t": "read", "id": 5},
+        )
+        self.assertEqual(codec.decode(text_data=protocol.LEGACY_PING), {"t": "ping"})
+        self.assertEqual(
+            codec.decode(text_data='{"message": "hi"}'), {"t": "message", "text": "hi"}
+        )
+        with self.assertRaises(protocol.ProtocolError):
+            codec.decode(text_data='["hi"]')
+
+    def test_to_event(self):
+        event = {
+            "type": "read_receipt",
+            "message_id": 42,
+            "sender_slug": "alice",
+            "receiver_slug": "bob",
+            "read_at": "2026-01-01 00:00:00+00:00",
+        }
+        self.assertEqual(
+            protocol.to_event(event),
+            {
+                "t": "read",
+                "id": 42,
+                "from": "alice",
+                "to": "bob",
+                "read_at": "2026-01-01 00:00:00+00:00",
+            },
+        )
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.to_event({"type": "typing"})
+
+
+class ThrottleTests(SimpleTestCase):
+    """Buckets refill up to their burst, superseded outbound events are merged"""
+
+    @mock.patch("chat.throttle.time.monotonic")
+    def test_token_bucket(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = throttle.TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        monotonic.return_value = 100.5  # one token back
+        self.assertEqual([bucket.take(), bucket.take()], [True, False])
+        monotonic.return_value = 1000.0  # never more than the burst
+        self.assertEqual([bucket.take(3), bucket.take()], [True, False])
+
+    @override_settings(CHAT_USER_RATE=1, CHAT_USER_BURST=1)
+    def test_user_bucket(self):
+        bucket = throttle.user_bucket(-1)
+        self.assertIs(throttle.user_bucket(-1), bucket)
+        self.assertIsNot(throttle.user_bucket(-2), bucket)
+        self.assertEqual([bucket.take(), throttle.user_bucket(-1).take()], [True, False])
+
+    def test_coalesce(self):
+        events = [
+            {"t": "message", "id": 1},
+            {"t": "read", "id": 1, "from": "alice", "to": "bob"},
+            {"t": "unread", "messages": 2},
+            {"t": "presence", "user": "carol", "online": True},
+            {"t": "read", "id": 2, "from": "alice", "to": "bob"},
+            {"t": "read", "id": 9, "from": "carol", "to": "bob"},
+            {"t": "message", "id": 2},
+            {"t": "unread", "messages": 0},
+            {"t": "presence", "user": "carol", "online": False},
+        ]
+        kept = throttle.coalesce([(event, None) for event in events])
+        self.assertEqual(
+            [event for event, _ in kept],
+            [events[0], events[4], events[5], events[6], events[7], events[8]],
+        )
+
+
+@override_settings(
+    CACHES=SHARED_LOCMEM,
+    CHAT_CONNECTION_RATE=0.001,
+    CHAT_CONNECTION_BURST=2,
+    CHAT_THROTTLE_DISCONNECT_AFTER=3,
+    CHAT_COALESCE_WINDOW=0,
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class ThrottledSocketTests(TransactionTestCase):
+    """A flooding socket is told once, then closed"""
+
+    async def test_flood(self):
+        create_user = database_sync_to_async(User.objects.create_user)
+        alice = await create_user("alice", "alice@example.com", "pw12345!")
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            "/ws/user/",
+            subprotocols=[protocol.JSON_SUBPROTOCOL],
+        )
+        communicator.scope["user"] = alice
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # two frames of burst, then three strikes
+        for _ in range(5):
+            await communicator.send_json_to({"v": 1, "t": "read"})
+        frame = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(frame["events"], [{"t": "error", "error": "throttled"}])
+        output = await communicator.receive_output(timeout=5)
+        self.assertEqual(output, {"type": "websocket.close", "code": 1008})
+        await communicator.disconnect()
+
+
+@override_settings(CACHES=SHARED_LOCMEM)
+class ExportTests(TestCase):
+    """Exports stream every message of a mailbox, in order, in each format"""
+
+    texts = ['hi "there",\nbob', "ünïcode ✓", "to carol"]
+
+    def setUp(self):
+        caches["shared"].clear()
+        self.alice, self.bob, self.carol = (
+            User.objects.create_user(name, f"{name}@example.com", "pw12345!")
+            for name in ("alice", "bob", "carol")
+        )
+        senders = (self.alice, self.bob, self.alice)
+        receivers = (self.bob, self.alice, self.carol)
+        for sender, receiver, text in zip(senders, receivers, self.texts):
+            self.client.force_login(sender)
+            url = reverse("send_message", args=[receiver.slug])
+            self.client.post(url, {"message": text})
+        self.client.force_login(self.alice)
+
+    def download(self, *args, **params):
+        response = self.client.get(reverse("export_messages", args=args), params)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content)
+
+    def test_ndjson(self):
+        response, content = self.download(self.bob.slug)
+        filename = f"enchat-{self.alice.slug}-{self.bob.slug}.ndjson"
+        self.assertEqual(
+            response["Content-Disposition"], f'attachment; filename="{filename}"'
+        )
+        records = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(
+            [(row["sender"], row["receiver"], row["message"]) for row in records],
+            [("alice", "bob", self.texts[0]), ("bob", "alice", self.texts[1])],
+        )
+
+    def test_csv(self):
+        response, content = self.download(format="csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.DictReader(io.StringIO(content.decode())))
+        self.assertEqual([row["message"] for row in rows], self.texts)
+        self.assertEqual(list(rows[0]), export.FIELDS)
+
+    def test_gzip(self):
+        _, plain = self.download(format="csv")
+        response, content = self.download(format="csv", gzip=1)
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertTrue(response["Content-Disposition"].endswith('.csv.gz"'))
+        self.assertEqual(gzip.decompress(content), plain)
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse("export_messages"), {"format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_chunks(self):
+        chunks = list(export.records(export.mailbox(self.alice.pk), chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual([record["message"] for record in chunks[1]], self.texts[2:])
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            call_command(
+                "export_messages",
+                "alice",
+                "--gzip",
+                f"--output-dir={output_dir}",
+                stdout=io.StringIO(),
+            )
+            path = os.path.join(output_dir, f"enchat-{self.alice.slug}.ndjson.gz")
+            with gzip.open(path, "rt") as exported:
+                messages = [json.loads(line)["message"] for line in exported]
+        self.assertEqual(messages, self.texts)
+
+
+@override_settings(CACHES=SHARED_LOCMEM)
+class RotateKeysTests(TransactionTestCase):
+    """rotate_keys resumes from its checkpoint, for the key it was rotating to"""
+
+    def setUp(self):
+        caches["shared"].clear()
+        decrypt_cache.clear()
+        alice = User.objects.create_user("alice", "alice@example.com", "pw12345!")
+        bob = User.objects.create_user("bob", "bob@example.com", "pw12345!")
+        self.client.force_login(alice)
+        for i in range(10):
+            url = reverse("send_message", args=[bob.slug])
+            self.client.post(url, {"message": f"message {i}"})
+        self.ids = list(
+            PrivateMessage.objects.order_by("id").values_list("id", flat=True)
+        )
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, "checkpoint.json")
+
+    def rotate(self, *args):
+        output = io.StringIO()
+        with override_settings(
+            CHAT_ENCRYPTION_KEYS={1: SECOND_KEY}, CHAT_ENCRYPTION_KEY_ID=1
+        ):
+            call_command(
+                "rotate_keys",
+                "--workers=2",
+                "--chunk-size=3",
+                "--batch-size=2",
+                f"--checkpoint={self.checkpoint}",
+                *args,
+                stdout=output,
+            )
+            messages = PrivateMessage.objects.order_by("id")
+            self.assertEqual(
+                [message.get_message() for message in messages],
+                [f"message {i}" for i in range(10)],
+            )
+        return output.getvalue()
+
+    def key_ids(self):
+        ciphertexts = PrivateMessage.objects.order_by("id").values_list("ciphertext")
+        return [key_id_of(ciphertext) for (ciphertext,) in ciphertexts]
+
+    def write_checkpoint(self, key_id, last_id):
+        state = {"key_id": key_id, "last_id": last_id, "scanned": 0, "rotated": 0}
+        with open(self.checkpoint, "w") as checkpoint:
+            json.dump(state, checkpoint)
+
+    def test_complete_run(self):
+        output = self.rotate()
+        self.assertIn("Rotated 10 of 10 messages and 1 conversation previews", output)
+        self.assertEqual(self.key_ids(), [1] * 10)
+        with open(self.checkpoint) as checkpoint:
+            self.assertEqual(json.load(checkpoint)["last_id"], self.ids[-1])
+        # nothing left to do
+        self.assertIn("Rotated 10 of 10 messages and 0 conversation", self.rotate())
+
+    def test_resume(self):
+        self.write_checkpoint(1, self.ids[3])
+        self.assertIn(f"after message {self.ids[3]}", self.rotate())
+        self.assertEqual(self.key_ids(), [0] * 4 + [1] * 6)
+
+    def test_checkpoint_of_another_key(self):
+        self.write_checkpoint(2, self.ids[3])
+        self.assertIn("Checkpoint is for key 2, starting over", self.rotate())
+        self.assertEqual(self.key_ids(), [1] * 10)
+
+    def test_restart(self):
+        self.write_checkpoint(1, self.ids[-1])
+        self.rotate("--restart")
+        self.assertEqual(self.key_ids(), [1] * 10)
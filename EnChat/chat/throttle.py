@@ -0,0 +1,105 @@
+"""
+Rate limits and bounded queues for WebSocket connections.
+
+Every inbound frame takes a token from the bucket of its connection and
+from the bucket of its user, shared by all the connections of that user
+in this worker process. Buckets refill continuously at ``rate`` tokens a
+second up to ``burst``, so short bursts pass and sustained floods are
+throttled.
+
+Outbound events wait in a bounded outbox. When a client reads slower
+than events arrive, the overflow policy decides what happens:
+
+``drop``
+    new events are discarded;
+``coalesce``
+    events superseded by a later one (read watermarks, unread totals,
+    presence) are merged, then the oldest events are discarded;
+``disconnect``
+    the socket is closed. The client reconnects and catches up over HTTP.
+"""
+import time
+from django.conf import settings
+from utils import LRUCache, metrics
+
+DROP = "drop"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (DROP, COALESCE, DISCONNECT)
+
+throttled = metrics.Counter(
+    "enchat_ws_throttled_total", "Client frames over a rate limit", ["scope"]
+)
+dropped = metrics.Counter(
+    "enchat_ws_dropped_total", "Frames and events dropped", ["reason"]
+)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, tokens=1):
+        """Take ``tokens`` if available, return whether they were"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+# No TTL: a bucket must outlive any burst of its user. Only the least
+# recently active users are forgotten once there are maxsize of them.
+_user_buckets = LRUCache(maxsize=10000)
+metrics.watch_cache("user_buckets", _user_buckets)
+
+
+def connection_bucket():
+    return TokenBucket(
+        getattr(settings, "CHAT_CONNECTION_RATE", 5),
+        getattr(settings, "CHAT_CONNECTION_BURST", 20),
+    )
+
+
+def user_bucket(user_id):
+    bucket = _user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(
+            getattr(settings, "CHAT_USER_RATE", 10),
+            getattr(settings, "CHAT_USER_BURST", 40),
+        )
+        _user_buckets.put(user_id, bucket)
+    return bucket
+
+
+def _supersede_key(event):
+    """Events with the same key replace each other, None for those that never do"""
+    kind = event.get("t")
+    if kind == "unread":
+        return ("unread",)
+    if kind == "presence":
+        return ("presence", event["user"])
+    if kind == "read":
+        return ("read", event["from"], event["to"])
+    return None
+
+
+def coalesce(outbox):
+    """
+    Keep the last of each group of superseded events of an outbox, a list
+    of (protocol event, raw event) pairs, in order
+    """
+    keys = [_supersede_key(event) for event, _ in outbox]
+    last = {key: index for index, key in enumerate(keys) if key is not None}
+    kept = [
+        entry
+        for index, (entry, key) in enumerate(zip(outbox, keys))
+        if key is None or last[key] == index
+    ]
+    dropped.inc("coalesced", amount=len(outbox) - len(kept))
+    return kept
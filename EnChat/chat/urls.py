@@ -1,15 +1,35 @@
+from django.conf import settings
 from django.urls import path
-from . import views
-
-urlpatterns = [
-    path("", views.conversations, name="conversations"),
-    path("chat/<str:slug>/", views.chat, name="chat"),
-    path("send_message/<str:slug>/", views.send_message, name="send_message"),
-    path("read_message/<int:message_id>/", views.read_message, name="read_message"),
-    path("search/", views.search_user, name="search_user"),
-    path(
-        "delete_message/<int:message_id>/", views.delete_message, name="delete_message"
-    ),
-    path("users/", views.get_users, name="users"),
-    path("get_messages/<str:slug>/", views.get_messages, name="get_messages"),
-]
+from . import async_views, views
+
+
+def patterns(polled):
+    """The chat URLs, with the views of chat.async_views taken from ``polled``"""
+    return [
+        path("", polled.conversations, name="conversations"),
+        path("chat/<str:slug>/", polled.chat, name="chat"),
+        path("send_message/<str:slug>/", polled.send_message, name="send_message"),
+        path("read_message/<int:message_id>/", polled.read_message, name="read_message"),
+        path("search/", views.search_user, name="search_user"),
+        path(
+            "delete_message/<int:message_id>/", views.delete_message, name="delete_message"
+        ),
+        path("users/", views.get_users, name="users"),
+        path("get_messages/<str:slug>/", polled.get_messages, name="get_messages"),
+        path(
+            "older_messages/<str:slug>/", views.older_messages, name="older_messages"
+        ),
+        path("unread/", views.unread_counts, name="unread_counts"),
+        path("export/", views.export_messages, name="export_messages"),
+        path("export/<str:slug>/", views.export_messages, name="export_messages"),
+        path(
+            "search_messages/<str:slug>/",
+            views.search_messages,
+            name="search_messages",
+        ),
+    ]
+
+
+urlpatterns = patterns(
+    async_views if getattr(settings, "CHAT_ASYNC_VIEWS", False) else views
+)
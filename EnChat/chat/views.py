@@ -1,191 +1,376 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
-from django.db.models import Q, F, Subquery, OuterRef, Max, Case, When
-from django.utils import timezone
-from .models import PrivateMessage
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    Http404,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Q
+from . import export, serializers
+from .events import message_event, publish, read_event, unread_event
+from .models import PrivateMessage, Conversation, MessageToken, UnreadCounter
+from .pagination import (
+    PAGE_SIZE,
+    after,
+    cursor_of,
+    decode_cursor,
+    encode_cursor,
+    find,
+    page_before,
+)
 from users.models import User
-from utils import encrypt_message, decrypt_message
+from users import directory
+from users.cache import UserSummary, get_user_summary_or_404
+from utils import blind_token, decrypt_many, tokenize
 
 
 @login_required
 def conversations(request):
     """
-    Retrieve unique conversations with properly formatted latest messages
+    Retrieve the user's conversations with properly formatted latest messages
     """
     user = request.user
 
-    # Get all conversations where the user is either sender or receiver
-    subquery = PrivateMessage.objects.filter(
-        Q(sender=OuterRef("sender"), receiver=OuterRef("receiver"))
-        | Q(sender=OuterRef("receiver"), receiver=OuterRef("sender"))
-    ).order_by("-timestamp")
-
-    # Get unique conversations with latest message
-    conversations = (
-        PrivateMessage.objects.filter(Q(sender=user) | Q(receiver=user))
-        .annotate(
-            latest_id=Subquery(subquery.values("id")[:1]),
-            other_user_id=Case(
-                When(sender=user, then="receiver_id"),
-                default="sender_id",
-            ),
+    conversations = list(Conversation.objects.for_user(user))
+    # resolve the other participant and decrypt the previews in one batch
+    previews = iter(
+        decrypt_many(
+            conversation.preview
+            for conversation in conversations
+            if conversation.preview
         )
-        .filter(id=F("latest_id"))
-        .select_related("sender", "receiver")
-        .order_by("sender", "receiver", "-timestamp")
-        .distinct("sender", "receiver")
     )
-    # decrypt the messages
     for conversation in conversations:
-        conversation.encrypted_message = decrypt_message(conversation.encrypted_message)
+        conversation.other = conversation.other_user(user)
+        conversation.unread = conversation.unread_for(user)
+        conversation.message = next(previews) if conversation.preview else ""
     return render(
         request,
         "chat/conversations.html",
         {
             "conversations": conversations,
-            "no_conversations": not conversations.exists(),
+            "no_conversations": not conversations,
         },
     )
 
 
+def last_received(messages, user):
+    """Id of the last message of a page received by ``user``, or None"""
+    return max(
+        (message.id for message in messages if message.receiver_id == user.pk),
+        default=None,
+    )
+
+
+def poll_cursor(request, messages):
+    """
+    The (timestamp, id) that get_messages polls after: the ``after``
+    cursor, or for older clients the message ``last_id`` of ``messages``.
+    None polls from the first message.
+    """
+    cursor = decode_cursor(request.GET.get("after", ""))
+    if cursor is None:
+        last_id = request.GET.get("last_id", "")
+        last = find(messages, int(last_id)) if last_id.isdigit() else None
+        cursor = (last.timestamp, last.id) if last is not None else None
+    return cursor
+
+
+def next_poll_cursor(cursor, messages):
+    """The cursor the client polls after next time"""
+    if messages:
+        return encode_cursor(messages[-1])
+    return cursor_of(*cursor) if cursor else None
+
+
+def mark_read(user, other, up_to, since=None):
+    """Move the read watermark of ``user`` and tell both users when it moved"""
+    if not up_to:
+        return
+    read_at = Conversation.objects.mark_read(user, other, up_to, since)
+    if read_at is not None:
+        async_to_sync(publish)(
+            get_channel_layer(),
+            read_event(up_to, read_at, other, user),
+            user.slug,
+            other.slug,
+        )
+        publish_unread(user)
+
+
+def publish_unread(user):
+    """Send the unread totals of ``user`` to all of their sockets"""
+    totals = UnreadCounter.objects.totals(user.pk)
+    async_to_sync(publish)(get_channel_layer(), unread_event(totals), user.slug)
+
+
 @login_required
 def chat(request, slug):
-    """Retrieve all messages between the user and the selected user"""
+    """Retrieve the latest page of messages between the user and the selected user"""
     user = request.user
-    receiver = get_object_or_404(User, slug=slug)
+    receiver = get_user_summary_or_404(slug)
 
-    messages = PrivateMessage.objects.filter(
-        Q(sender=user, receiver=receiver) | Q(sender=receiver, receiver=user)
-    ).order_by("timestamp")
-    unread_messages = messages.filter(receiver=user, is_read=False)
-    unread_messages.update(is_read=True, read_at=timezone.now())
-    messages = [
+    page, older_cursor = page_before(
+        serializers.conversation_messages(user.pk, receiver.pk)
+    )
+    # the latest page is on screen, everything received up to its end is read
+    mark_read(user, receiver, last_received(page, user))
+    conversation = Conversation.objects.between(user.pk, receiver.pk)
+    messages = serializers.serialize(page, conversation)
+
+    return render(
+        request,
+        "chat/chat.html",
+        {"receiver": receiver, "messages": messages, "older_cursor": older_cursor},
+    )
+
+
+@login_required
+def older_messages(request, slug):
+    """AJAX endpoint for loading the page of messages before a cursor"""
+    user = request.user
+    receiver = get_user_summary_or_404(slug)
+    cursor = decode_cursor(request.GET.get("before", ""))
+    if cursor is None:
+        return JsonResponse({"success": False}, status=400)
+
+    page, older_cursor = page_before(
+        serializers.conversation_messages(user.pk, receiver.pk), cursor
+    )
+    conversation = Conversation.objects.between(user.pk, receiver.pk)
+    return serializers.json_response(
         {
-            "id": message.id,
-            "sender": message.sender.username,  # Convert to string
-            "receiver": message.receiver.username,  # Convert to string
-            "message": (
-                decrypt_message(message.encrypted_message)
-            ),  # Handle empty messages
-            "timestamp": message.timestamp,  # Format timestamp
-            "is_read": message.is_read,
-            "read_at": (message.read_at if message.read_at else None),
+            "messages": serializers.serialize(page, conversation),
+            "older_cursor": older_cursor,
         }
+    )
+
+
+@login_required
+def search_messages(request, slug):
+    """
+    AJAX endpoint for searching a conversation, newest matches first. Only
+    the candidates found in the blind index are decrypted.
+    """
+    user = request.user
+    receiver = get_user_summary_or_404(slug)
+    words = tokenize(request.GET.get("q", ""))
+    before = request.GET.get("before", "")
+    if not words or (before and not before.isdigit()):
+        return JsonResponse({"success": False}, status=400)
+
+    conversation = Conversation.objects.between(user.pk, receiver.pk)
+    if conversation is None:
+        return JsonResponse({"messages": [], "next": None})
+    ids = MessageToken.objects.search(
+        conversation.id,
+        [blind_token(word) for word in words],
+        before=int(before) if before else None,
+        limit=PAGE_SIZE + 1,
+    )
+    has_more = len(ids) > PAGE_SIZE
+    ids = ids[:PAGE_SIZE]
+    messages = serializers.serialize(
+        serializers.conversation_messages(user.pk, receiver.pk)
+        .filter(id__in=ids)
+        .order_by("-id"),
+        conversation,
+    )
+    # digests are truncated, drop the (unlikely) false positives
+    messages = [
+        message
         for message in messages
+        if set(words) <= set(tokenize(message["message"]))
     ]
-
-    return render(
-        request, "chat/chat.html", {"receiver": receiver, "messages": messages}
+    return serializers.json_response(
+        {"messages": messages, "next": ids[-1] if has_more else None}
     )
 
 
 @login_required
 def get_messages(request, slug):
-    """AJAX endpoint for getting messages"""
+    """
+    AJAX endpoint for getting messages, after the ``after`` cursor that the
+    previous poll returned (or, for older clients, after message ``last_id``)
+    """
     user = request.user
-    receiver = get_object_or_404(User, slug=slug)
-    last_id = request.GET.get("last_id", 0)
-
-    # Get messages after last_id
-    messages = PrivateMessage.objects.filter(
-        Q(
-            Q(sender=user) & Q(receiver=receiver)
-            | Q(sender=receiver) & Q(receiver=user)
-        ),
-        id__gt=last_id,
-    ).order_by("timestamp")
-
-    # Mark unread messages as read
-    unread_messages = messages.filter(receiver=user, is_read=False)
-    unread_messages.update(is_read=True, read_at=timezone.now())
-
-    # Refresh messages to get updated read status
-    messages = messages.all()
-
-    # Serialize messages
-    serialized = [
+    receiver = get_user_summary_or_404(slug)
+    conversation_messages = serializers.conversation_messages(user.pk, receiver.pk)
+
+    # Get at most one page of messages after the cursor, the client polls
+    # again from the returned one
+    cursor = poll_cursor(request, conversation_messages)
+    polled = after(conversation_messages, cursor) if cursor else conversation_messages
+    messages = list(polled.order_by("timestamp", "id")[:PAGE_SIZE])
+
+    # Everything received up to the last message served is read
+    mark_read(user, receiver, last_received(messages, user))
+    conversation = Conversation.objects.between(user.pk, receiver.pk)
+    return serializers.json_response(
         {
-            "id": m.id,
-            "sender": m.sender.username,
-            "message": decrypt_message(m.encrypted_message),
-            "timestamp": m.timestamp,
-            "is_read": m.is_read,
-            "read_at": m.read_at if m.read_at else None,
+            "messages": serializers.serialize(messages, conversation),
+            "cursor": next_poll_cursor(cursor, messages),
         }
-        for m in messages
-    ]
-
-    return JsonResponse({"messages": serialized})
+    )
 
 
 @login_required
 def send_message(request, slug):
     """Handle message sending via AJAX"""
     if request.method == "POST":
-        receiver = get_object_or_404(User, slug=slug)
+        receiver = get_user_summary_or_404(slug)
         message_text = request.POST.get("message", "").strip()
 
-        # Create and save message
-
-        message = PrivateMessage.objects.create(
-            sender=request.user, receiver=receiver, encrypted_message=message_text
+        # Create and save message, keeping the inbox row in the same transaction
+        with transaction.atomic():
+            message = PrivateMessage.objects.create(
+                sender=request.user,
+                receiver_id=receiver.pk,
+                encrypted_message=message_text,
+            )
+            Conversation.objects.record_message(message, message_text)
+        record = serializers.serialize_new(message, request.user, receiver, message_text)
+        async_to_sync(publish)(
+            get_channel_layer(),
+            message_event(
+                record, request.user, receiver, getattr(message, "conversation_id", None)
+            ),
+            request.user.slug,
+            receiver.slug,
         )
+        publish_unread(receiver)
 
         # Return created message data
-        return JsonResponse(
-            {
-                "success": True,
-                "message": {
-                    "id": message.id,
-                    "sender": request.user.username,
-                    "message": message_text,
-                    "timestamp": message.timestamp,
-                    "is_read": False,
-                },
-            }
-        )
+        return serializers.json_response({"success": True, "message": record})
     return JsonResponse({"success": False}, status=405)
 
 
 @login_required
 def read_message(request, message_id):
-    """Mark a message as read"""
-    message = get_object_or_404(PrivateMessage, id=message_id)
-    if message.receiver == request.user and not message.is_read:
-        message.is_read = True
-        message.read_at = timezone.now()
-        message.save()
-    return JsonResponse({"success": True, "is_read": message.is_read})
+    """Mark a message, and every message before it, as read"""
+    message = find(PrivateMessage.objects.select_related("sender"), message_id)
+    if message is None:
+        raise Http404("No message matches the given query.")
+    if message.receiver_id == request.user.pk:
+        mark_read(request.user, message.sender, message.id, message.timestamp)
+        return JsonResponse({"success": True, "is_read": True})
+    conversation = Conversation.objects.between(message.sender_id, message.receiver_id)
+    is_read = conversation is not None and conversation.is_read(message)
+    return JsonResponse({"success": True, "is_read": is_read})
 
 
 @login_required
 def delete_message(request, message_id):
-    """Delete a message"""
-    message = get_object_or_404(PrivateMessage, id=message_id)
-    message.delete()
+    """Delete a message of one's own"""
+    message = find(
+        PrivateMessage.objects.filter(sender=request.user).select_related("receiver"),
+        message_id,
+    )
+    if message is None:
+        raise Http404("No message matches the given query.")
+    with transaction.atomic():
+        Conversation.objects.discount_unread(message)
+        message.delete()
+        Conversation.objects.refresh(message.sender_id, message.receiver_id)
+    publish_unread(message.receiver)
     return JsonResponse({"success": True})
 
 
+@login_required
+def unread_counts(request):
+    """
+    AJAX endpoint for the unread badges, cheap enough to poll: a single
+    primary key lookup, plus the conversations with unread messages when
+    asked for with ``?conversations=1``
+    """
+    user = request.user
+    data = UnreadCounter.objects.totals(user.pk)
+    if request.GET.get("conversations"):
+        unread = Conversation.objects.filter(
+            Q(user_a=user, unread_a__gt=0) | Q(user_b=user, unread_b__gt=0)
+        ).values("id", "user_a_id", "unread_a", "unread_b")
+        data["by_conversation"] = {
+            row["id"]: row["unread_a" if row["user_a_id"] == user.pk else "unread_b"]
+            for row in unread
+        }
+    return JsonResponse(data)
+
+
+@login_required
+def export_messages(request, slug=None):
+    """
+    Download the user's messages, with one user or all of them, as
+    ``?format=ndjson`` (default) or ``csv``, gzipped with ``?gzip=1``
+    """
+    file_format = request.GET.get("format", "ndjson")
+    if file_format not in export.FORMATS:
+        return HttpResponseBadRequest("Unknown format")
+    compress = bool(request.GET.get("gzip"))
+    other = get_user_summary_or_404(slug) if slug else None
+    other_id = other.pk if other else None
+
+    # sync iterators would be read to the end before an ASGI response starts
+    stream = export.astream if isinstance(request, ASGIRequest) else export.stream
+    response = StreamingHttpResponse(
+        stream(request.user.pk, other_id, file_format, compress),
+        content_type="application/gzip" if compress else export.FORMATS[file_format],
+    )
+    filename = "-".join(["enchat", request.user.slug] + ([other.slug] if other else []))
+    filename += f".{file_format}" + (".gz" if compress else "")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
 @login_required
 def search_user(request):
-    """Search for a user"""
-    if request.method == "POST":
-        username = request.POST.get("username")
-        users = User.objects.filter(username__icontains=username)
-        return render(request, "chat/search_user.html", {"users": users})
-    # make sure it is not returning the id of the user signed in
-    users = User.objects.filter(is_private=False)
-    for user in users:
-        if user == request.user:
-            user.username = f"{user.username} (You)"
+    """Search for a user, or browse the public directory without a query"""
+    query = request.POST.get("username") or request.GET.get("q", "")
+    cursor = directory.decode_cursor(request.GET.get("cursor", ""))
+    if query:
+        users, next_cursor = directory.search(query, cursor)
+        # private users are not listed, but can be found by their exact name
+        exact = get_private_user(query.strip()) if cursor is None else None
+        if exact is not None:
+            users = [exact, *users]
+    else:
+        users, next_cursor = directory.browse(cursor)
+    return render(
+        request,
+        "chat/search_user.html",
+        {"users": users, "query": query, "next_cursor": next_cursor},
+    )
 
-    return render(request, "chat/search_user.html", {"users": users})
+
+def get_private_user(username):
+    row = (
+        User.objects.filter(username=username, is_private=True)
+        .values_list(*UserSummary._fields)
+        .first()
+    )
+    return UserSummary(*row) if row else None
 
 
 @login_required
 def get_users(request):
-    """Retrieve all users"""
-    users = User.objects.filter(is_private=False)
-    return render(request, "chat/users.html", {"users": users})
+    """AJAX endpoint for the user directory and typeahead, ``?q=`` searches"""
+    query = request.GET.get("q", "")
+    cursor = directory.decode_cursor(request.GET.get("cursor", ""))
+    if query:
+        users, next_cursor = directory.search(query, cursor)
+    else:
+        users, next_cursor = directory.browse(cursor)
+    return JsonResponse(
+        {
+            "users": [
+                {**user._asdict(), "profile_picture": user.profile_picture_url}
+                for user in users
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
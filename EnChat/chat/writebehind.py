@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from .models import PrivateMessage, Conversation
+from utils import seal_many
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Write-behind queue that group-commits incoming chat messages.
+
+    Messages submitted within ``interval`` seconds (or until ``batch_size``
+    are waiting) are encrypted as a batch and inserted with a single
+    ``bulk_create`` in one transaction. ``submit`` only returns once that
+    transaction has committed, so a message is never acknowledged to the
+    room before it is durable; a crash mid-flush rolls back the whole batch
+    and none of its messages has been acknowledged.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    async def submit(self, sender, receiver, text):
+        """Queue a message and return it, with its id, once it is committed"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((sender, receiver, text, future))
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            saved = await database_sync_to_async(self._persist)(batch)
+        except Exception:
+            # retry one by one so a single bad row cannot fail its neighbours
+            logger.exception("Group commit of %d messages failed", len(batch))
+            for item in batch:
+                try:
+                    (message,) = await database_sync_to_async(self._persist)([item])
+                except Exception as error:
+                    if not item[3].done():
+                        item[3].set_exception(error)
+                else:
+                    if not item[3].done():
+                        item[3].set_result(message)
+            return
+        for (_, _, _, future), message in zip(batch, saved):
+            if not future.done():
+                future.set_result(message)
+
+    @staticmethod
+    def _persist(batch):
+        texts = [text for _, _, text, _ in batch]
+        # bulk_create skips PrivateMessage.save, so encrypt here instead
+        messages = [
+            PrivateMessage(
+                sender=sender, receiver_id=receiver.pk, ciphertext=sealed
+            )
+            for (sender, receiver, _, _), sealed in zip(batch, seal_many(texts))
+        ]
+        with transaction.atomic():
+            messages = PrivateMessage.objects.bulk_create(messages)
+            Conversation.objects.record_messages(messages, texts)
+        return messages
+
+    async def drain(self):
+        """Flush everything that is queued and wait for in-flight flushes"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+_writer = None
+
+
+def get_writer():
+    """
+    The process-wide MessageWriter, or None when group commit is disabled
+    with ``CHAT_GROUP_COMMIT``.
+    """
+    global _writer
+    if not getattr(settings, "CHAT_GROUP_COMMIT", False):
+        return None
+    if _writer is None:
+        _writer = MessageWriter(
+            interval=getattr(settings, "CHAT_GROUP_COMMIT_INTERVAL", 0.005),
+            batch_size=getattr(settings, "CHAT_GROUP_COMMIT_BATCH_SIZE", 100),
+        )
+    return _writer
@@ -0,0 +1,111 @@
+"""
+Cached authentication for HTTP requests and WebSocket scopes. With a
+shared cache (CACHE_URL), a logged-in request needs no query in the
+steady state: the session comes from the cached_db engine and the user
+from the user cache, checked against its generation (see users/cache.py).
+"""
+from functools import partial
+from types import SimpleNamespace
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+from .cache import acache_user, aget_cached_user, cache_user, get_cached_user
+
+
+def _valid(user, backend_path, session_hash):
+    """Whether a cached user may be served: the checks of auth.get_user"""
+    if user is None:
+        return False
+    backend = auth.load_backend(backend_path)
+    can_authenticate = getattr(backend, "user_can_authenticate", None)
+    if can_authenticate is not None and not can_authenticate(user):
+        return False
+    return constant_time_compare(session_hash, user.get_session_auth_hash())
+
+
+def get_user(request):
+    """
+    django.contrib.auth.get_user, served from the user cache when the
+    session hash still matches the cached user
+    """
+    session = request.session
+    try:
+        user_id = auth.get_user_model()._meta.pk.to_python(session[auth.SESSION_KEY])
+        backend_path = session[auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        return auth.get_user(request)
+    generation = None
+    if backend_path in settings.AUTHENTICATION_BACKENDS:
+        user, generation = get_cached_user(user_id)
+        session_hash = session.get(auth.HASH_SESSION_KEY) or ""
+        if _valid(user, backend_path, session_hash):
+            return user
+
+    # a miss, or a session the full check may cycle or flush
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        cache_user(user, generation)
+    return user
+
+
+async def aget_user(request):
+    """get_user() for async views"""
+    session = request.session
+    user_id = await session.aget(auth.SESSION_KEY)
+    backend_path = await session.aget(auth.BACKEND_SESSION_KEY)
+    if user_id is None or backend_path is None:
+        return await auth.aget_user(request)
+    user_id = auth.get_user_model()._meta.pk.to_python(user_id)
+    generation = None
+    if backend_path in settings.AUTHENTICATION_BACKENDS:
+        user, generation = await aget_cached_user(user_id)
+        session_hash = await session.aget(auth.HASH_SESSION_KEY) or ""
+        if _valid(user, backend_path, session_hash):
+            return user
+
+    user = await auth.aget_user(request)
+    if user.is_authenticated:
+        await acache_user(user, generation)
+    return user
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """
+    AuthenticationMiddleware with request.user and request.auser() from the
+    user cache
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: self.get_user(request))
+        request.auser = partial(self.aget_user, request)
+
+    @staticmethod
+    def get_user(request):
+        if not hasattr(request, "_cached_user"):
+            request._cached_user = get_user(request)
+        return request._cached_user
+
+    @staticmethod
+    async def aget_user(request):
+        if not hasattr(request, "_cached_user"):
+            # request.user then resolves without a query, e.g. in templates
+            request._cached_user = await aget_user(request)
+        return request._cached_user
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """channels AuthMiddleware with scope["user"] from the user cache"""
+
+    async def resolve_scope(self, scope):
+        request = SimpleNamespace(session=scope["session"])
+        scope["user"]._wrapped = await database_sync_to_async(get_user)(request)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
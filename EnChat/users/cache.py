@@ -0,0 +1,176 @@
+import copy
+import secrets
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.http import Http404
+from utils import LRUCache, metrics
+
+
+class UserSummary(namedtuple("UserSummary", "id username slug profile_picture is_private")):
+    """The public fields of a user, enough to render and address a chat"""
+
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def profile_picture_url(self):
+        from .models import profile_picture_url
+
+        return profile_picture_url(self.profile_picture)
+
+    def __str__(self):
+        return self.username
+
+
+# Per-process slug -> UserSummary cache. User.save invalidates the local
+# process, the TTL bounds how long other processes can serve stale entries.
+user_cache = LRUCache(
+    maxsize=getattr(settings, "USER_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "USER_CACHE_TTL", 60),
+)
+metrics.watch_cache("user", user_cache)
+
+
+def _lookup(slug):
+    from .models import User
+
+    return User.objects.filter(slug=slug).values_list(*UserSummary._fields)
+
+
+def get_user_summary(slug):
+    """Return the UserSummary for a slug, or None if no such user exists"""
+    summary = user_cache.get(slug)
+    if summary is None:
+        row = _lookup(slug).first()
+        if row is None:
+            return None
+        summary = UserSummary(*row)
+        user_cache.put(slug, summary)
+    return summary
+
+
+def get_user_summary_or_404(slug):
+    summary = get_user_summary(slug)
+    if summary is None:
+        raise Http404("No user matches the given query.")
+    return summary
+
+
+async def aget_user_summary(slug):
+    summary = user_cache.get(slug)
+    if summary is None:
+        row = await _lookup(slug).afirst()
+        if row is None:
+            return None
+        summary = UserSummary(*row)
+        user_cache.put(slug, summary)
+    return summary
+
+
+# Per-process id -> User cache for request.user and scope["user"], in front
+# of the shared cache. Each user has a generation token in the shared cache,
+# replaced when the user is saved or deleted: cached copies are served only
+# while their token is current, so every process sees logouts, password
+# changes and deactivations at once. Without a shared cache there is no
+# token to check, and users are not cached at all.
+auth_user_cache = LRUCache(
+    maxsize=getattr(settings, "AUTH_USER_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "AUTH_USER_CACHE_TTL", 10),
+)
+metrics.watch_cache("auth_user", auth_user_cache)
+SHARED_CACHE = getattr(settings, "SHARED_CACHE_ALIAS", "shared")
+
+
+def _auth_key(user_id):
+    return f"enchat:user:{user_id}"
+
+
+def _generation_key(user_id):
+    return f"enchat:user-generation:{user_id}"
+
+
+def _shared():
+    """The shared cache, None when it is a DummyCache"""
+    cache = caches[SHARED_CACHE]
+    return None if isinstance(cache, DummyCache) else cache
+
+
+def _local(user_id, generation):
+    entry = auth_user_cache.get(user_id)
+    return entry[1] if entry is not None and entry[0] == generation else None
+
+
+def _from_shared(user_id, generation, entry):
+    if entry is None or entry[0] != generation:
+        return None
+    auth_user_cache.put(user_id, entry)
+    return entry[1]
+
+
+def get_cached_user(user_id):
+    """
+    (a private copy of the cached User or None, the current generation of
+    the user). Pass the generation to cache_user() after a miss: it was
+    read before the user was, so a save in between makes that entry stale.
+    """
+    shared = _shared()
+    if shared is None:
+        return None, None
+    generation = shared.get(_generation_key(user_id))
+    if generation is None:
+        generation = secrets.token_hex(8)
+        if not shared.add(_generation_key(user_id), generation, timeout=None):
+            generation = shared.get(_generation_key(user_id))
+        return None, generation
+    user = _local(user_id, generation) or _from_shared(
+        user_id, generation, shared.get(_auth_key(user_id))
+    )
+    # requests modify request.user, never hand out the cached instance
+    return copy.copy(user), generation
+
+
+async def aget_cached_user(user_id):
+    shared = _shared()
+    if shared is None:
+        return None, None
+    generation = await shared.aget(_generation_key(user_id))
+    if generation is None:
+        generation = secrets.token_hex(8)
+        if not await shared.aadd(_generation_key(user_id), generation, timeout=None):
+            generation = await shared.aget(_generation_key(user_id))
+        return None, generation
+    user = _local(user_id, generation) or _from_shared(
+        user_id, generation, await shared.aget(_auth_key(user_id))
+    )
+    return copy.copy(user), generation
+
+
+def cache_user(user, generation):
+    shared = _shared()
+    if shared is None or generation is None:
+        return
+    entry = (generation, copy.copy(user))
+    auth_user_cache.put(user.pk, entry)
+    shared.set(_auth_key(user.pk), entry)
+
+
+async def acache_user(user, generation):
+    shared = _shared()
+    if shared is None or generation is None:
+        return
+    entry = (generation, copy.copy(user))
+    auth_user_cache.put(user.pk, entry)
+    await shared.aset(_auth_key(user.pk), entry)
+
+
+def invalidate_user(user_id):
+    """Retire the generation of a user, and with it every cached copy"""
+    auth_user_cache.invalidate(user_id)
+    shared = _shared()
+    if shared is not None:
+        shared.delete_many([_generation_key(user_id), _auth_key(user_id)])
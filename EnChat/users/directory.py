@@ -0,0 +1,102 @@
+"""
+Public user directory: browsing and searching the users that are not
+private, served by the partial indexes on the lowercased username (see
+User.Meta). Searches rank prefix matches before substring matches and
+paginate with a cursor of ``<tier>.<id>.<name>``.
+"""
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.functions import Collate, Lower
+from utils import LRUCache, metrics
+from .cache import UserSummary
+from .models import User
+
+PAGE_SIZE = 20
+MIN_SUBSTRING = 3  # Shorter queries only match prefixes, trigrams need 3 letters
+PREFIX, SUBSTRING = 0, 1
+
+# (query, cursor, size) -> page, typeahead asks for the same prefixes a lot
+directory_cache = LRUCache(
+    maxsize=getattr(settings, "USER_DIRECTORY_CACHE_SIZE", 1000),
+    ttl=getattr(settings, "USER_DIRECTORY_CACHE_TTL", 30),
+)
+metrics.watch_cache("directory", directory_cache)
+
+
+def encode_cursor(tier, user_id, name):
+    return f"{tier}.{user_id}.{name}"
+
+
+def decode_cursor(cursor):
+    """Return the (tier, id, name) of a cursor, or None if it is malformed"""
+    try:
+        tier, user_id, name = cursor.split(".", 2)
+        return int(tier), int(user_id), name
+    except (AttributeError, ValueError):
+        return None
+
+
+def public_users():
+    # the expressions must match the indexes to use them
+    return User.objects.filter(is_private=False).annotate(
+        name=Collate(Lower("username"), "C"), lowered=Lower("username")
+    )
+
+
+def _page(users, after, size):
+    """``size`` + 1 users ordered by name, starting after an (id, name) position"""
+    if after is not None:
+        user_id, name = after
+        users = users.filter(Q(name__gt=name) | Q(name=name, id__gt=user_id))
+    rows = users.order_by("name", "id").values_list(*UserSummary._fields, "name")
+    return list(rows[: size + 1])
+
+
+def _paginate(tiers, cursor, size):
+    """Walk the querysets of ``tiers`` in order, resuming from ``cursor``"""
+    start, after = PREFIX, None
+    if cursor is not None:
+        start, user_id, name = cursor
+        after = (user_id, name)
+    results, next_cursor = [], None
+    for tier, users in enumerate(tiers):
+        if tier < start:
+            continue
+        rows = _page(users, after if tier == start else None, size - len(results))
+        if len(rows) > size - len(results):
+            rows = rows[: size - len(results)]
+            results.extend(rows)
+            next_cursor = encode_cursor(tier, rows[-1][0], rows[-1][-1])
+            break
+        results.extend(rows)
+        if len(results) == size and tier + 1 < len(tiers):
+            next_cursor = encode_cursor(tier + 1, 0, "")
+            break
+    return [UserSummary(*row[:-1]) for row in results], next_cursor
+
+
+def browse(cursor=None, size=PAGE_SIZE):
+    """A page of the public directory in name order, plus the next cursor"""
+    return _paginate([public_users()], cursor, size)
+
+
+def search(query, cursor=None, size=PAGE_SIZE):
+    """
+    A page of public users matching ``query``: names starting with it
+    first, then names containing it. Returns the page and the next cursor.
+    """
+    query = query.strip().lower()
+    if not query:
+        return [], None
+    key = (query, cursor, size)
+    page = directory_cache.get(key)
+    if page is None:
+        users = public_users()
+        tiers = [users.filter(name__startswith=query)]
+        if len(query) >= MIN_SUBSTRING:
+            tiers.append(
+                users.filter(lowered__contains=query).exclude(name__startswith=query)
+            )
+        page = _paginate(tiers, cursor, size)
+        directory_cache.put(key, page)
+    return page
@@ -0,0 +1,213 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from users.models import User, profile_picture_name
+
+TRUE = {"1", "true", "yes", "on"}
+
+
+def hash_passwords(passwords):
+    """Runs in a worker process, None gives an unusable password"""
+    return [make_password(password) for password in passwords]
+
+
+def read_rows(path, file_format):
+    """Yield (line number, row dict) from a CSV or JSONL file, streaming"""
+    with open(path, newline="", encoding="utf-8") as source:
+        if file_format == "csv":
+            reader = csv.DictReader(source)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for number, line in enumerate(source, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+
+class Command(BaseCommand):
+    help = (
+        "Create users in bulk from a CSV or JSONL file with username, email, "
+        "password and optional profile_picture and is_private columns. "
+        "Rejected rows are written to an error file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=["csv", "jsonl"])
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(), help="Hashing processes"
+        )
+        parser.add_argument(
+            "--errors", help="Rejects file, defaults to <path>.rejects.jsonl"
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or (
+            "jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv"
+        )
+        if not os.path.exists(path):
+            raise CommandError(f"No such file: {path}")
+        self.batch_size = options["batch_size"]
+        self.workers = max(options["workers"] or 1, 1)
+        self.seen_emails, self.seen_usernames, self.slugs = set(), set(), set()
+        self.imported = self.rejected = 0
+        self.started = time.monotonic()
+
+        errors_path = options["errors"] or f"{path}.rejects.jsonl"
+        with ProcessPoolExecutor(self.workers) as executor, open(
+            errors_path, "w"
+        ) as errors:
+            self.errors = errors
+            pending = None
+            for batch in self.batches(read_rows(path, file_format)):
+                # hash this batch while the previous one is being inserted
+                hashing = self.start_hashing(executor, batch)
+                if pending is not None:
+                    self.insert(*pending)
+                pending = (batch, hashing)
+            if pending is not None:
+                self.insert(*pending)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {self.imported} users, rejected {self.rejected} "
+                f"({self.rate():.0f} rows/s)"
+            )
+        )
+
+    def rate(self):
+        return (self.imported + self.rejected) / max(
+            time.monotonic() - self.started, 1e-9
+        )
+
+    def reject(self, number, row, reason):
+        self.rejected += 1
+        row = {key: value for key, value in (row or {}).items() if key != "password"}
+        self.errors.write(
+            json.dumps({"line": number, "reason": reason, "row": row}) + "\n"
+        )
+
+    def batches(self, rows):
+        """Validated rows, in batches free of duplicates within the file"""
+        batch = []
+        for number, row in rows:
+            user = self.clean(number, row)
+            if user is not None:
+                batch.append(user)
+            if len(batch) >= self.batch_size:
+                yield self.drop_existing(batch)
+                batch = []
+        if batch:
+            yield self.drop_existing(batch)
+
+    def clean(self, number, row):
+        if not isinstance(row, dict):
+            self.reject(number, None, "Malformed row")
+            return None
+        username = (row.get("username") or "").strip()
+        email = User.objects.normalize_email((row.get("email") or "").strip())
+        if not username or not email:
+            self.reject(number, row, "Username and email are required")
+            return None
+        if len(username) > User._meta.get_field("username").max_length:
+            self.reject(number, row, "Username is too long")
+            return None
+        try:
+            validate_email(email)
+        except ValidationError:
+            self.reject(number, row, "Invalid email")
+            return None
+        if email in self.seen_emails:
+            self.reject(number, row, "Duplicate email in file")
+            return None
+        if username in self.seen_usernames:
+            self.reject(number, row, "Duplicate username in file")
+            return None
+        self.seen_emails.add(email)
+        self.seen_usernames.add(username)
+
+        profile_picture = profile_picture_name(row.get("profile_picture"))
+        return {
+            "line": number,
+            "row": row,
+            "user": User(
+                username=username,
+                email=email,
+                profile_picture=profile_picture,
+                is_private=str(row.get("is_private", "")).lower() in TRUE,
+            ),
+            "password": row.get("password") or None,
+        }
+
+    def drop_existing(self, batch):
+        """Reject the rows whose email or username is already taken"""
+        emails = [item["user"].email for item in batch]
+        usernames = [item["user"].username for item in batch]
+        taken = User.objects.filter(
+            Q(email__in=emails) | Q(username__in=usernames)
+        ).values_list("email", "username")
+        taken_emails = {email for email, _ in taken}
+        taken_usernames = {username for _, username in taken}
+        kept = []
+        for item in batch:
+            if item["user"].email in taken_emails:
+                self.reject(item["line"], item["row"], "Email already exists")
+            elif item["user"].username in taken_usernames:
+                self.reject(item["line"], item["row"], "Username is taken")
+            else:
+                kept.append(item)
+        return kept
+
+    def start_hashing(self, executor, batch):
+        passwords = [item["password"] for item in batch]
+        size = -(-len(passwords) // self.workers) or 1
+        return [
+            executor.submit(hash_passwords, passwords[start : start + size])
+            for start in range(0, len(passwords), size)
+        ]
+
+    def insert(self, batch, hashing):
+        hashes = [password for future in hashing for password in future.result()]
+        slugs = User.slugify_many(len(batch), taken=self.slugs)
+        self.slugs.update(slugs)
+        for item, password, slug in zip(batch, hashes, slugs):
+            item["user"].password = password
+            item["user"].slug = slug
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create([item["user"] for item in batch])
+            self.imported += len(batch)
+        except IntegrityError:
+            # a concurrent signup took a name or slug, go one by one
+            for item in batch:
+                self.insert_one(item)
+        self.stdout.write(
+            f"{self.imported} imported, {self.rejected} rejected, "
+            f"{self.rate():.0f} rows/s"
+        )
+
+    def insert_one(self, item):
+        user = item["user"]
+        user.pk = None
+        if User.objects.filter(slug=user.slug).exists():
+            user.slug = User.slugify()
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create([user])
+        except IntegrityError:
+            self.reject(item["line"], item["row"], "Email or username taken")
+        else:
+            self.imported += 1
@@ -0,0 +1,45 @@
+import random
+import string
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def reslug_duplicates(apps, schema_editor):
+    """Give a fresh slug to all but the first user of every duplicate slug"""
+    User = apps.get_model("users", "User")
+    duplicates = (
+        User.objects.values("slug")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .values_list("slug", flat=True)
+    )
+    taken = set()
+    for slug in list(duplicates):
+        for user in User.objects.filter(slug=slug).order_by("id")[1:]:
+            while True:
+                candidate = "".join(
+                    random.choices(string.ascii_lowercase + string.digits, k=6)
+                )
+                if candidate not in taken and not User.objects.filter(
+                    slug=candidate
+                ).exists():
+                    break
+            taken.add(candidate)
+            User.objects.filter(pk=user.pk).update(slug=candidate)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0001_initial"),
+    ]
+
+    operations = [
+        # slugify() only retried once, so older rows may share a slug
+        migrations.RunPython(reslug_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="user",
+            name="slug",
+            field=models.SlugField(unique=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+import django.contrib.postgres.indexes
+import django.db.models.functions.comparison
+import django.db.models.functions.text
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without blocking sign-ups, which needs to run
+    # outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ("users", "0002_unique_slug"),
+    ]
+
+    operations = [
+        # pg_trgm provides gin_trgm_ops. CREATE EXTENSION needs the contrib
+        # package on the server and a role allowed to create extensions.
+        TrigramExtension(),
+        AddIndexConcurrently(
+            model_name="user",
+            index=models.Index(
+                django.db.models.functions.comparison.Collate(
+                    django.db.models.functions.text.Lower("username"), "C"
+                ),
+                condition=models.Q(("is_private", False)),
+                name="users_public_name_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="user",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Lower("username"),
+                    name="gin_trgm_ops",
+                ),
+                condition=models.Q(("is_private", False)),
+                name="users_public_trgm_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+from django.db import migrations, models
+from django.db.models import Case, Max, Value, When
+
+LOCAL = [f"assets/{number}.png" for number in range(1, 7)]
+REMOTE = {
+    f"https://r00tus34.me/EnChat/EnChat/assests/{number}.png": name
+    for number, name in enumerate(LOCAL, 1)
+}
+BATCH_SIZE = 10000  # User ids per UPDATE
+
+
+def update_in_batches(User, queryset, value):
+    last_id = User.objects.aggregate(last=Max("id"))["last"] or 0
+    for low in range(0, last_id, BATCH_SIZE):
+        queryset.filter(id__gt=low, id__lte=low + BATCH_SIZE).update(
+            profile_picture=value
+        )
+
+
+def localize(apps, schema_editor):
+    """Remote URLs become their local names, any other unknown value the default"""
+    User = apps.get_model("users", "User")
+    local = Case(
+        *[When(profile_picture=url, then=Value(name)) for url, name in REMOTE.items()],
+        default=Value(LOCAL[0]),
+    )
+    update_in_batches(User, User.objects.exclude(profile_picture__in=LOCAL), local)
+
+
+def delocalize(apps, schema_editor):
+    User = apps.get_model("users", "User")
+    remote = Case(
+        *[When(profile_picture=name, then=Value(url)) for url, name in REMOTE.items()],
+        default="profile_picture",
+    )
+    update_in_batches(User, User.objects.filter(profile_picture__in=LOCAL), remote)
+
+
+class Migration(migrations.Migration):
+    # one short UPDATE per batch of users rather than a single long one
+    atomic = False
+
+    dependencies = [
+        ("users", "0003_public_directory_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="user",
+            name="profile_picture",
+            field=models.CharField(
+                choices=[(name, name) for name in LOCAL], max_length=100
+            ),
+        ),
+        # cached users keep the old value until their TTL, which
+        # profile_picture_url renders the same
+        migrations.RunPython(localize, delocalize),
+    ]
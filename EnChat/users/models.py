@@ -1,18 +1,35 @@
-from django.db import models
+from functools import partial
+from django.db import models, transaction
+from django.templatetags.static import static
+from django.db.models import Q
+from django.db.models.functions import Collate, Lower
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
     PermissionsMixin,
 )
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from .cache import invalidate_user, user_cache
 
-DEFAULT_PROFILE_PICS = [
-    "https://r00tus34.me/EnChat/EnChat/assests/1.png",
-    "https://r00tus34.me/EnChat/EnChat/assests/2.png",
-    "https://r00tus34.me/EnChat/EnChat/assests/3.png",
-    "https://r00tus34.me/EnChat/EnChat/assests/4.png",
-    "https://r00tus34.me/EnChat/EnChat/assests/5.png",
-    "https://r00tus34.me/EnChat/EnChat/assests/6.png",
-]
+# Static file names (see STATICFILES_DIRS), rendered through profile_picture_url
+DEFAULT_PROFILE_PICS = [f"assets/{number}.png" for number in range(1, 7)]
+# The remote URLs stored before the pictures were served with the app,
+# rewritten by migration 0004_local_profile_pictures
+REMOTE_PROFILE_PICS = {
+    f"https://r00tus34.me/EnChat/EnChat/assests/{name.split('/')[-1]}": name
+    for name in DEFAULT_PROFILE_PICS
+}
+
+
+def profile_picture_name(value):
+    """The profile picture ``value`` stands for, the default one if none"""
+    value = REMOTE_PROFILE_PICS.get(value, value)
+    return value if value in DEFAULT_PROFILE_PICS else DEFAULT_PROFILE_PICS[0]
+
+
+def profile_picture_url(value):
+    """URL of the fingerprinted copy of a stored profile picture"""
+    return static(profile_picture_name(value))
 
 
 class UserManager(BaseUserManager):
@@ -24,10 +41,7 @@ class UserManager(BaseUserManager):
         user.set_password(password)
 
         # Assign default profile picture if not chosen
-        if profile_picture and profile_picture in DEFAULT_PROFILE_PICS:
-            user.profile_picture = profile_picture
-        else:
-            user.profile_picture = DEFAULT_PROFILE_PICS[0]  # Default to first image
+        user.profile_picture = profile_picture_name(profile_picture)
         if is_private is not None:
             user.is_private = is_private 
         user.save(using=self._db)
@@ -51,24 +65,72 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_staff = models.BooleanField(default=False)
     date_joined = models.DateTimeField(auto_now_add=True)
     is_private = models.BooleanField(default=False)
-    slug = models.SlugField(max_length=50)
+    slug = models.SlugField(max_length=50, unique=True)
     objects = UserManager()
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username"]
 
+    class Meta:
+        indexes = [
+            # Ordering and prefix search of the public directory, the "C"
+            # collation lets a plain btree serve LIKE 'prefix%'
+            models.Index(
+                Collate(Lower("username"), "C"),
+                condition=Q(is_private=False),
+                name="users_public_name_idx",
+            ),
+            # Substring search of the public directory, needs pg_trgm
+            GinIndex(
+                OpClass(Lower("username"), name="gin_trgm_ops"),
+                condition=Q(is_private=False),
+                name="users_public_trgm_idx",
+            ),
+        ]
+
+    @staticmethod
     def slugify():
+        return User.slugify_many(1)[0]
+
+    @staticmethod
+    def slugify_many(count, taken=()):
+        """
+        ``count`` distinct random slugs that are not in use nor in ``taken``,
+        checked against the database with one query per round
+        """
         import random, string
 
-        slug = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
-        if User.objects.filter(slug=slug).exists():
-            slug = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
-        return slug
+        def draw():
+            return "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
+
+        taken = set(taken)
+        slugs = set()
+        while len(slugs) < count:
+            candidates = {draw() for _ in range(count - len(slugs))} - taken - slugs
+            used = User.objects.filter(slug__in=candidates).values_list("slug", flat=True)
+            slugs |= candidates - set(used)
+        return list(slugs)
+
+    @property
+    def profile_picture_url(self):
+        return profile_picture_url(self.profile_picture)
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = self.slugify()
         super().save(*args, **kwargs)
+        user_cache.invalidate(self.slug)
+        self._invalidate_cached()
+
+    def delete(self, *args, **kwargs):
+        user_cache.invalidate(self.slug)
+        self._invalidate_cached()
+        return super().delete(*args, **kwargs)
+
+    def _invalidate_cached(self):
+        # once more on commit: a request may cache the old row in between
+        invalidate_user(self.pk)
+        transaction.on_commit(partial(invalidate_user, self.pk), using=self._state.db)
 
     def __str__(self):
         return self.username
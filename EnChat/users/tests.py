@@ -1,3 +1,132 @@
-from django.test import TestCase
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from . import directory
+from .cache import auth_user_cache, get_cached_user
+from .models import User
 
-# Create your tests here.
+
+# sessions and users are cached in the shared tier, which Redis provides
+SHARED_LOCMEM = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "shared",
+    },
+}
+
+
+class DirectoryTests(TestCase):
+    """Prefix matches come before substring matches, cursors walk both tiers"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ("Anna", "annabel", "Hannah", "joanna", "annex", "bob"):
+            User.objects.create_user(
+                name, f"{name}@example.com", "pw12345!", is_private=name == "annex"
+            )
+
+    def setUp(self):
+        directory.directory_cache.clear()
+
+    def names(self, users):
+        return [user.username for user in users]
+
+    def walk(self, page, *args, size):
+        """Every name of a listing, a page of ``size`` at a time"""
+        names, cursor = [], None
+        while True:
+            users, cursor = page(*args, cursor=cursor, size=size)
+            names.extend(self.names(users))
+            if cursor is None:
+                return names
+            cursor = directory.decode_cursor(cursor)
+
+    def test_tiers(self):
+        users, cursor = directory.search(" ANN ")
+        # private users are never listed
+        self.assertEqual(self.names(users), ["Anna", "annabel", "Hannah", "joanna"])
+        self.assertIsNone(cursor)
+        # too short for the substring tier
+        self.assertEqual(self.names(directory.search("an")[0]), ["Anna", "annabel"])
+        self.assertEqual(directory.search("  "), ([], None))
+
+    def test_cursors(self):
+        for size in (1, 2, 3):
+            with self.subTest(size=size):
+                self.assertEqual(
+                    self.walk(directory.search, "ann", size=size),
+                    ["Anna", "annabel", "Hannah", "joanna"],
+                )
+                self.assertEqual(
+                    self.walk(directory.browse, size=size),
+                    ["Anna", "annabel", "bob", "Hannah", "joanna"],
+                )
+
+    def test_decode_cursor(self):
+        cursor = directory.encode_cursor(directory.SUBSTRING, 7, "j.doe")
+        self.assertEqual(directory.decode_cursor(cursor), (1, 7, "j.doe"))
+        for malformed in (None, "", "1.x.name", "1.2"):
+            self.assertIsNone(directory.decode_cursor(malformed))
+
+    def test_cached_pages(self):
+        page = directory.search("ann")
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.search("ann"), page)
+
+
+@override_settings(CACHES=SHARED_LOCMEM)
+class AuthCacheTests(TestCase):
+    """Cached users are served until the user is saved, in every process"""
+
+    def setUp(self):
+        caches["shared"].clear()
+        auth_user_cache.clear()
+        self.user = User.objects.create_user("alice", "alice@example.com", "pw12345!")
+        self.client.force_login(self.user)
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse("profile")).status_code, 200)
+        return [query for query in queries if '"users_user"' in query["sql"]]
+
+    def test_cached(self):
+        self.user_queries()
+        self.assertEqual(get_cached_user(self.user.pk)[0], self.user)
+        self.assertEqual(self.user_queries(), [])
+
+    def test_password_change(self):
+        self.user_queries()
+        self.user.set_password("new-pw12345!")
+        self.user.save()
+        self.assertIsNone(get_cached_user(self.user.pk)[0])
+        response = self.client.get(reverse("profile"))
+        self.assertRedirects(response, f"{reverse('login')}?next={reverse('profile')}")
+
+    def test_deactivation(self):
+        self.user_queries()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse("profile")).status_code, 302)
+
+    def test_other_process(self):
+        self.user_queries()
+        stale = auth_user_cache.get(self.user.pk)
+        self.user.save()
+        # another process still holds the copy cached under the old generation
+        auth_user_cache.put(self.user.pk, stale)
+        self.assertIsNone(get_cached_user(self.user.pk)[0])
+
+    @override_settings(
+        CACHES={
+            **SHARED_LOCMEM,
+            "shared": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        },
+        SESSION_ENGINE="django.contrib.sessions.backends.db",
+    )
+    def test_without_shared_cache(self):
+        self.client.force_login(self.user)
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(get_cached_user(self.user.pk), (None, None))
@@ -1,4 +1,4 @@
-from .models import User, DEFAULT_PROFILE_PICS
+from .models import User, DEFAULT_PROFILE_PICS, profile_picture_name
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
@@ -13,9 +13,7 @@ def register(request):
         email = request.POST.get("email")
         password = request.POST.get("password")
         is_private = request.POST.get("is_private")
-        profile_picture = request.POST.get("profile_picture")
-        if not profile_picture or profile_picture not in DEFAULT_PROFILE_PICS:
-            profile_picture = DEFAULT_PROFILE_PICS[0]
+        profile_picture = profile_picture_name(request.POST.get("profile_picture"))
         if not username or not email or not password:
             return render(request, "users/register.html", {"error": "All fields are required", "profile_pics": DEFAULT_PROFILE_PICS})
         if User.objects.filter(username=username).exists():
@@ -60,7 +58,7 @@ def edit_profile(request):
         profile_picture = request.POST.get("profile_picture")
         private = request.POST.get("is_private")
         request.user.username = username
-        request.user.profile_picture = profile_picture
+        request.user.profile_picture = profile_picture_name(profile_picture)
         request.user.is_private = private if private else False
         request.user.save()
 
@@ -1,23 +1,368 @@
+import asyncio
 import base64
+import hashlib
+import hmac
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
+from Crypto.Util.strxor import strxor
 from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from . import metrics
 
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used instead
+    zstandard = None
+
+# Key of every message stored before key ids, key 0 of the keyring
 KEY = b"TgRUDNSaa0sMPllMTKwEBA=="
+LEGACY_KEY_ID = 0
+
+# Keyed digests of the words of a message for the blind search index, under
+# a key of their own (see Keyring.index_key)
+MAX_TOKENS = 256  # Distinct words indexed per message
+_WORD = re.compile(r"\w{2,64}")
+
+# Binary envelope of stored messages: version, codec, key id, IV, CBC
+# ciphertext. Version 1 envelopes have no key id and are under key 0.
+# Plaintexts of COMPRESS_MIN_SIZE bytes or more are compressed before
+# encryption when that makes them smaller.
+ENVELOPE_VERSION = 2
+CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD = 0, 1, 2
+COMPRESS_MIN_SIZE = 128
+
+DECRYPT_CACHE_SIZE = 4096  # Plaintexts kept in memory, keyed by ciphertext digest
+ASYNC_BATCH_THRESHOLD = 32  # Batches at least this big leave the event loop
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="decrypt")
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache, entries optionally expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl and entry[1] < time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+class PlaintextCache(LRUCache):
+    """Bounded LRU cache of plaintexts keyed by the digest of their ciphertext"""
+
+    @staticmethod
+    def digest(encrypted_message):
+        if isinstance(encrypted_message, str):
+            encrypted_message = encrypted_message.encode()
+        return hashlib.blake2b(encrypted_message, digest_size=16).digest()
+
+
+decrypt_cache = PlaintextCache(DECRYPT_CACHE_SIZE)
+metrics.watch_cache("decrypt", decrypt_cache)
+
+
+class Keyring:
+    """
+    The AES keys of stored messages by one byte id. New messages are
+    encrypted with the active key, any key of the ring decrypts.
+
+    Keys come from the CHAT_ENCRYPTION_KEYS setting, {id: base64 key}, and
+    the active one from CHAT_ENCRYPTION_KEY_ID. KEY is key 0 unless the
+    setting replaces it. A key can only leave the ring once rotate_keys has
+    re-encrypted everything stored under it.
+
+    The key of the search index is derived from the CHAT_SEARCH_KEY setting,
+    base64, else from SECRET_KEY. Once it changes, build_search_index
+    --rebuild must redo the index.
+    """
+
+    def __init__(self):
+        self._keys = None
+
+    def _load(self):
+        if self._keys is None:
+            keys = {LEGACY_KEY_ID: KEY}
+            for key_id, key in getattr(settings, "CHAT_ENCRYPTION_KEYS", {}).items():
+                keys[int(key_id)] = base64.b64decode(key)
+            active = getattr(settings, "CHAT_ENCRYPTION_KEY_ID", LEGACY_KEY_ID)
+            for key_id, key in keys.items():
+                if not 0 <= key_id <= 255 or len(key) not in AES.key_size:
+                    raise ImproperlyConfigured(f"Invalid encryption key {key_id}")
+            if active not in keys:
+                raise ImproperlyConfigured(f"Unknown active encryption key {active}")
+            # CBC decryption is D(C[i]) xor C[i - 1], so a single ECB cipher
+            # (and key schedule) per key can decrypt the blocks of any number
+            # of messages in one call
+            ciphers = {key_id: AES.new(key, AES.MODE_ECB) for key_id, key in keys.items()}
+            search_key = getattr(settings, "CHAT_SEARCH_KEY", None)
+            if search_key:
+                secret = base64.b64decode(search_key)
+            else:
+                secret = settings.SECRET_KEY.encode()
+            index_key = hmac.new(secret, b"enchat search index", hashlib.sha256).digest()
+            self._keys = (keys, ciphers, active, index_key)
+        return self._keys
+
+    @property
+    def active(self):
+        return self._load()[2]
+
+    @property
+    def index_key(self):
+        return self._load()[3]
+
+    def key(self, key_id):
+        try:
+            return self._load()[0][key_id]
+        except KeyError:
+            raise ValueError(f"Unknown encryption key {key_id}") from None
+
+    def ecb(self, key_id):
+        self.key(key_id)
+        return self._load()[1][key_id]
+
+    def reload(self):
+        self._keys = None
+
+
+keyring = Keyring()
+
+
+@receiver(setting_changed)
+def _reload_keyring(setting, **kwargs):
+    if setting in (
+        "CHAT_ENCRYPTION_KEYS",
+        "CHAT_ENCRYPTION_KEY_ID",
+        "CHAT_SEARCH_KEY",
+        "SECRET_KEY",
+    ):
+        keyring.reload()
+
+
+def _encrypt_blocks(payloads, key_id):
+    """IV + CBC ciphertext of each payload, drawing all the IVs in one call"""
+    key = keyring.key(key_id)
+    ivs = get_random_bytes(16 * len(payloads))  # Generate secure IVs
+    encrypted = []
+    for index, payload in enumerate(payloads):
+        iv = ivs[16 * index : 16 * (index + 1)]
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        encrypted.append(iv + cipher.encrypt(pad(payload, AES.block_size)))
+    return encrypted
+
+
+def compress(data):
+    """(codec, payload) for a plaintext, compressed only when that pays off"""
+    if len(data) < COMPRESS_MIN_SIZE:
+        return CODEC_NONE, data
+    if zstandard is not None:
+        codec, compressed = CODEC_ZSTD, zstandard.compress(data, 3)
+    else:
+        codec, compressed = CODEC_ZLIB, zlib.compress(data, 6)
+    # padding rounds up to a block, smaller by less than that saves nothing
+    if len(compressed) // AES.block_size >= len(data) // AES.block_size:
+        return CODEC_NONE, data
+    return codec, compressed
+
+
+def decompress(codec, data):
+    if codec == CODEC_NONE:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstandard is required to decrypt this message")
+        return zstandard.decompress(data)
+    raise ValueError("Unknown message codec")
+
+
 def encrypt_message(message):
-    iv = get_random_bytes(16)  # Generate a secure IV
-    cipher = AES.new(KEY, AES.MODE_CBC, iv)
-    ciphertext = cipher.encrypt(pad(message.encode(), AES.block_size))
-    return base64.b64encode(iv + ciphertext).decode()  # Store IV with encrypted text
+    return encrypt_many([message])[0]
+
+
+def _seal(messages):
+    """Binary envelopes of a list of strings, under the active key"""
+    key_id = keyring.active
+    compressed = [compress(message.encode()) for message in messages]
+    payloads = _encrypt_blocks([payload for _, payload in compressed], key_id)
+    return [
+        bytes((ENVELOPE_VERSION, codec, key_id)) + data
+        for (codec, _), data in zip(compressed, payloads)
+    ]
+
+
+def encrypt_many(messages):
+    """Encrypt an iterable of strings to base64 envelopes, for text columns"""
+    start = time.perf_counter()
+    messages = list(messages)
+    encrypted = []
+    for message, envelope in zip(messages, _seal(messages)):
+        encrypted_message = base64.b64encode(envelope).decode()
+        # recently sent messages are the ones read next
+        decrypt_cache.put(decrypt_cache.digest(encrypted_message), message)
+        encrypted.append(encrypted_message)
+    metrics.crypto_seconds.observe(time.perf_counter() - start, "encrypt")
+    metrics.crypto_messages.inc("encrypt", amount=len(messages))
+    return encrypted
+
+
+def seal_message(message):
+    return seal_many([message])[0]
+
+
+def seal_many(messages):
+    """
+    Encrypt an iterable of strings to binary envelopes, for binary columns:
+    a third smaller than base64 before any compression
+    """
+    start = time.perf_counter()
+    messages = list(messages)
+    sealed = []
+    for message, envelope in zip(messages, _seal(messages)):
+        decrypt_cache.put(decrypt_cache.digest(envelope), message)
+        sealed.append(envelope)
+    metrics.crypto_seconds.observe(time.perf_counter() - start, "encrypt")
+    metrics.crypto_messages.inc("encrypt", amount=len(messages))
+    return sealed
+
+
+def _unwrap(encrypted_message):
+    """(key id, codec, IV + ciphertext) of a base64 text or a binary envelope"""
+    if isinstance(encrypted_message, str):
+        envelope = base64.b64decode(encrypted_message)  # Decode from base64
+        # texts written before envelopes are a bare IV + ciphertext, a whole
+        # number of blocks where an envelope has its header on top
+        if len(envelope) % AES.block_size == 0:
+            return LEGACY_KEY_ID, CODEC_NONE, envelope
+    else:
+        envelope = bytes(encrypted_message)
+    if len(envelope) >= 3 and envelope[0] == ENVELOPE_VERSION:
+        return envelope[2], envelope[1], envelope[3:]
+    if len(envelope) >= 2 and envelope[0] == 1:
+        return LEGACY_KEY_ID, envelope[1], envelope[2:]
+    raise ValueError("Unsupported message envelope")
+
+
+def key_id_of(encrypted_message):
+    """Id of the key a stored message is encrypted with"""
+    return _unwrap(encrypted_message)[0]
 
 
 def decrypt_message(encrypted_message):
-    data = base64.b64decode(encrypted_message)  # Decode from base64
-    iv, ciphertext = data[:16], data[16:]  # Extract IV and ciphertext
-    cipher = AES.new(KEY, AES.MODE_CBC, iv)
-    decrypted = unpad(
-                cipher.decrypt(ciphertext), AES.block_size
-            )  # Unpad and decode
-    encrypted_message = decrypted.decode()
-        
-    return decrypted.decode()
+    return decrypt_many([encrypted_message])[0]
+
+
+def decrypt_many(encrypted_messages):
+    """
+    Decrypt an iterable of encrypted messages, base64 texts or binary
+    envelopes, returning the plaintexts in the same order. Cached
+    plaintexts are reused and every other message is decrypted in a single
+    AES call per key.
+    """
+    start = time.perf_counter()
+    encrypted_messages = list(encrypted_messages)
+    decrypted = [None] * len(encrypted_messages)
+    pending = {}  # by key id
+    for index, encrypted_message in enumerate(encrypted_messages):
+        if isinstance(encrypted_message, memoryview):
+            encrypted_message = bytes(encrypted_message)
+        digest = decrypt_cache.digest(encrypted_message)
+        plaintext = decrypt_cache.get(digest)
+        if plaintext is not None:
+            decrypted[index] = plaintext
+            continue
+        key, codec, data = _unwrap(encrypted_message)
+        if len(data) < 32 or len(data) % AES.block_size:
+            raise ValueError("Invalid encrypted message")
+        pending.setdefault(key, []).append((index, digest, codec, data))
+
+    for key, batch in pending.items():
+        blocks = keyring.ecb(key).decrypt(b"".join(data[16:] for _, _, _, data in batch))
+        # each block is chained with the previous ciphertext block (or the IV)
+        plain = strxor(blocks, b"".join(data[:-16] for _, _, _, data in batch))
+        offset = 0
+        for index, digest, codec, data in batch:
+            size = len(data) - 16
+            payload = unpad(plain[offset : offset + size], AES.block_size)
+            plaintext = decompress(codec, payload).decode()
+            offset += size
+            decrypt_cache.put(digest, plaintext)
+            decrypted[index] = plaintext
+    metrics.crypto_seconds.observe(time.perf_counter() - start, "decrypt")
+    metrics.crypto_messages.inc("decrypt", amount=len(encrypted_messages))
+    return decrypted
+
+
+async def adecrypt_many(encrypted_messages):
+    """decrypt_many for async code, large batches run in a thread pool"""
+    encrypted_messages = list(encrypted_messages)
+    if len(encrypted_messages) < ASYNC_BATCH_THRESHOLD:
+        return decrypt_many(encrypted_messages)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, decrypt_many, encrypted_messages)
+
+
+def tokenize(text):
+    """Distinct normalized words of a text, in order of appearance"""
+    return list(dict.fromkeys(_WORD.findall(text.casefold())))[:MAX_TOKENS]
+
+
+def blind_token(word):
+    """64-bit keyed digest of a normalized word, as a signed integer column value"""
+    digest = hmac.new(keyring.index_key, word.encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def blind_tokens(text):
+    return [blind_token(word) for word in tokenize(text)]
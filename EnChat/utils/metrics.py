@@ -0,0 +1,291 @@
+"""
+In-process runtime metrics, exposed in the Prometheus text format at
+/metrics.
+
+Recording is a dictionary update under an uncontended lock, so the
+instrumented paths pay next to nothing when nobody scrapes; values that
+are expensive to gather (queue depths, cache sizes) are computed by
+callbacks at scrape time only. Every worker process keeps its own
+registry: scrape each worker, or put them behind a per-process port.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from a cached AES call to a slow page
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# Queue lengths, up to past the default WebSocket queue limits
+QUEUE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Request methods recorded by name, any other one is recorded as "other"
+METHODS = frozenset(
+    ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "TRACE", "CONNECT")
+)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            lines.extend(self.samples(labels, value))
+        return lines
+
+    def samples(self, labels, value):
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or a ``function`` evaluated at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        if self.function is not None:
+            # function returns {label values: value}, or a bare value
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            with self._lock:
+                self._values = dict(values)
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # per-bucket counts (the last one is +Inf), sum
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += count
+            le = (("le", bound),)
+            lines.append(
+                f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            )
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Requests, recorded by MetricsMiddleware
+request_seconds = Histogram(
+    "enchat_http_request_seconds", "Time spent in a view", ["view", "method"]
+)
+request_queries = Histogram(
+    "enchat_http_request_queries",
+    "Database queries per request",
+    ["view"],
+    buckets=COUNT_BUCKETS,
+)
+request_db_seconds = Histogram(
+    "enchat_http_request_db_seconds", "Database time per request", ["view"]
+)
+# Crypto, recorded in utils
+crypto_seconds = Histogram(
+    "enchat_crypto_seconds", "Time spent per encryption call", ["operation"]
+)
+crypto_messages = Counter(
+    "enchat_crypto_messages_total", "Messages encrypted or decrypted", ["operation"]
+)
+
+
+_caches = {}
+
+
+def watch_cache(name, cache):
+    """Export the hit, miss and size counts of an LRUCache"""
+    _caches[name] = cache
+
+
+def _cache_stats():
+    return {
+        (name, stat): value
+        for name, cache in _caches.items()
+        for stat, value in cache.stats().items()
+    }
+
+
+lru_caches = Gauge("enchat_cache", "LRU cache statistics", ["cache", "stat"], _cache_stats)
+
+
+class QueryTimer:
+    """Counts the queries of a request and their time"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+# The timer of the current request. A context variable follows the request
+# into the threads of sync_to_async, where async views run their queries.
+_query_timer = contextvars.ContextVar("query_timer", default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    timer = _query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.seconds += time.perf_counter() - start
+        timer.queries += 1
+
+
+@receiver(connection_created)
+def _install_query_timer(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+class MetricsMiddleware:
+    """Latency, query count and database time of every request, per view"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        token = _query_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_timer.reset(token)
+        self.record(request, time.perf_counter() - start, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        token = _query_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_timer.reset(token)
+        self.record(request, time.perf_counter() - start, timer)
+        return response
+
+    @staticmethod
+    def record(request, elapsed, timer):
+        # label by route name, never by path, to bound the number of series
+        match = request.resolver_match
+        view = (match.view_name or match._func_path) if match else "unresolved"
+        method = request.method if request.method in METHODS else "other"
+        request_seconds.observe(elapsed, view, method)
+        request_queries.observe(timer.queries, view)
+        request_db_seconds.observe(timer.seconds, view)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint, behind METRICS_TOKEN, open only with DEBUG"""
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponseForbidden()
+    elif not constant_time_compare(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,245 @@
+"""
+Static files served by the app itself, see STORAGES and EnChat/asgi.py.
+
+collectstatic copies every file to STATIC_ROOT under a name with a hash
+of its content, and writes .gz (and .br, with the brotli package)
+variants of text files next to them. StaticFiles serves STATIC_ROOT in
+front of the ASGI application from an in-memory cache: hashed names
+never change and are cached by browsers for a year, everything else
+revalidates with its ETag.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import urlsplit
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import (
+    ManifestStaticFilesStorage,
+    staticfiles_storage,
+)
+from . import LRUCache, metrics
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip variants are written
+    brotli = None
+
+COMPRESSIBLE = {".css", ".js", ".map", ".json", ".svg", ".txt", ".html", ".xml"}
+# Variants by preference, kept only when at most this share of the original
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+MAX_RATIO = 0.95
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Per-process name -> StaticFile cache, filled on first request or by preload()
+static_cache = LRUCache(maxsize=getattr(settings, "STATIC_CACHE_SIZE", 1000))
+metrics.watch_cache("static", static_cache)
+STATIC_CACHE_MAX_FILE = getattr(settings, "STATIC_CACHE_MAX_FILE", 1024 * 1024)
+STATIC_MAX_AGE = getattr(settings, "STATIC_MAX_AGE", 3600)  # Unhashed names
+
+StaticFile = namedtuple("StaticFile", "body variants content_type etag cache_control")
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage that also writes compressed variants"""
+
+    def stored_name(self, name):
+        # not collected yet (development, tests): serve the unhashed names
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files) | set(self.hashed_files.values()):
+            if os.path.splitext(name)[1] in COMPRESSIBLE:
+                self.compress(name)
+
+    def compress(self, name):
+        path = self.path(name)
+        with open(path, "rb") as original:
+            body = original.read()
+        variants = {".gz": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(body)
+        for suffix, data in variants.items():
+            if len(data) <= len(body) * MAX_RATIO:
+                with open(path + suffix, "wb") as variant:
+                    variant.write(data)
+            elif os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+@lru_cache(maxsize=None)
+def immutable_names():
+    """The hashed names of the manifest, whose content never changes"""
+    return frozenset(getattr(staticfiles_storage, "hashed_files", {}).values())
+
+
+def _path(name):
+    """Path of ``name`` under STATIC_ROOT, None if it points outside"""
+    if not settings.STATIC_ROOT or not name or "\0" in name or "\\" in name:
+        return None
+    name = posixpath.normpath(name)
+    if name.startswith(("/", "../")) or name in (".", ".."):
+        return None
+    return os.path.join(settings.STATIC_ROOT, *name.split("/"))
+
+
+def load(name):
+    """The StaticFile collected as ``name``, None if there is none"""
+    path = _path(name)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as original:
+        body = original.read()
+    variants = {}
+    for encoding, suffix in ENCODINGS:
+        try:
+            with open(path + suffix, "rb") as variant:
+                variants[encoding] = variant.read()
+        except FileNotFoundError:
+            pass
+    content_type, _ = mimetypes.guess_type(name)
+    content_type = content_type or "application/octet-stream"
+    if content_type.startswith("text/") or content_type.endswith(("script", "json")):
+        content_type += "; charset=utf-8"
+    if name in immutable_names():
+        cache_control = IMMUTABLE
+    else:
+        cache_control = f"public, max-age={STATIC_MAX_AGE}"
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    return StaticFile(body, variants, content_type, etag, cache_control)
+
+
+def get(name):
+    static_file = static_cache.get(name)
+    if static_file is None:
+        static_file = load(name)
+        if static_file is not None and len(static_file.body) <= STATIC_CACHE_MAX_FILE:
+            static_cache.put(name, static_file)
+    return static_file
+
+
+def preload():
+    """Read the collected files into the cache, return how many were"""
+    if not settings.STATIC_ROOT or not os.path.isdir(settings.STATIC_ROOT):
+        return 0
+    loaded = 0
+    for root, _, files in os.walk(settings.STATIC_ROOT):
+        for filename in files:
+            if filename.endswith((".gz", ".br")) or loaded >= static_cache.maxsize:
+                continue
+            name = os.path.relpath(os.path.join(root, filename), settings.STATIC_ROOT)
+            if get(name.replace(os.sep, "/")) is not None:
+                loaded += 1
+    return loaded
+
+
+def accepted_encodings(header):
+    """The content codings an Accept-Encoding header accepts"""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        params = params.strip()
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1
+        except ValueError:
+            quality = 1
+        if quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def byte_range(header, size):
+    """The (start, end) of a single "bytes=" Range header, None to send all"""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    return (start, end) if start <= end else None
+
+
+class StaticFiles:
+    """
+    ASGI middleware serving GET and HEAD requests under STATIC_URL from
+    STATIC_ROOT, and passing everything else, missing files included, to
+    ``application``
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.prefix = "/" + urlsplit(settings.STATIC_URL or "").path.lstrip("/")
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or self.prefix == "/"
+            or scope["method"] not in ("GET", "HEAD")
+            or not scope["path"].startswith(self.prefix)
+        ):
+            return await self.application(scope, receive, send)
+        name = scope["path"][len(self.prefix):]
+        static_file = static_cache.get(name)
+        if static_file is None:
+            static_file = await sync_to_async(get, thread_sensitive=False)(name)
+            if static_file is None:
+                return await self.application(scope, receive, send)
+        await self.respond(scope, send, static_file)
+
+    async def respond(self, scope, send, static_file):
+        request = {
+            key.decode("latin-1").lower(): value.decode("latin-1")
+            for key, value in scope["headers"]
+        }
+        accepted = accepted_encodings(request.get("accept-encoding", ""))
+        encoding = next(
+            (coding for coding in static_file.variants if coding in accepted), None
+        )
+        body = static_file.variants[encoding] if encoding else static_file.body
+        etag = f'"{static_file.etag}-{encoding}"' if encoding else f'"{static_file.etag}"'
+        headers = [
+            (b"content-type", static_file.content_type.encode()),
+            (b"cache-control", static_file.cache_control.encode()),
+            (b"etag", etag.encode()),
+        ]
+        if static_file.variants:
+            headers.append((b"vary", b"Accept-Encoding"))
+        if encoding:
+            headers.append((b"content-encoding", encoding.encode()))
+        else:
+            headers.append((b"accept-ranges", b"bytes"))
+
+        status = 200
+        matches = request.get("if-none-match", "")
+        if matches.strip() == "*" or etag in (
+            tag.strip().removeprefix("W/") for tag in matches.split(",")
+        ):
+            status, body = 304, b""
+        elif not encoding and "range" in request:
+            span = byte_range(request["range"], len(body))
+            if span is not None:
+                start, end = span
+                headers.append(
+                    (b"content-range", f"bytes {start}-{end}/{len(body)}".encode())
+                )
+                status, body = 206, body[start : end + 1]
+        if status != 304:
+            headers.append((b"content-length", str(len(body)).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if scope["method"] == "HEAD":
+            body = b""
+        await send({"type": "http.response.body", "body": body})